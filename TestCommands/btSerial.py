@@ -3,9 +3,16 @@
 import time
 import threading
 import sys
+import os
+import collections
 
 import serial
 
+# armm shared modules : next to this file or at the top of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from armm.serialio import ChunkReader, open_port
+from armm.codec import FrameDecoder, checksum, encode
+
 # Commands
 # A2B : AIBOX to BT-01/11
 # B2A : BT-01 to AIBOX
@@ -32,56 +39,58 @@ class BtComm(object):
         self.recvCommand = bytearray()
         self.recvChecksumByte = bytearray()
         self.afterEscapeSequence = bytearray()
-        self.recvdataforescapesequence = bytearray()
-        # Tx
-        self.sendbytesnoescape = bytearray()
-        self.sendbytesescape = bytearray()
+        # frame decoder & decoded frames not yet returned by recv
+        self.decoder = FrameDecoder()
+        self.recvFrames = collections.deque()
         # Generate event
         self.event = threading.Event()
 
         # Open Serial Port. wait til success
-        self.trycount = 0
-        while True:
-            print("try to open serial port 10 times.")
-            try:
-                self.trycount += 1
-                self.comm = serial.Serial(
+        #   10 attempts, waiting for the tty to appear with back-off (0.1 sec. doubled) between them
+        print("try to open serial port 10 times.")
+        try:
+            self.comm, self.trycount, seconds = open_port(tty, lambda: serial.Serial(
                     port=tty,
                     baudrate=baudratevalue,
                     bytesize=serial.EIGHTBITS,
                     parity=serial.PARITY_NONE,
                     stopbits=serial.STOPBITS_ONE,
                     timeout=timeoutvalue
-                    )
-                self.isPortOpen = True              # opened successfully
-                print("Serial port opened successfully.")
-                break
-            except serial.SerialException:
-                self.isPortOpen = False             # failed
-                print("failed to open serial port.  Retry.")
-                if self.trycount == 10 :
-                    print("Can't open serial port. Please reboot system.")
-                    sys.exit()
-                
+                    ), max_attempts=10)
+        except serial.SerialException:
+            self.isPortOpen = False             # failed
+            print("Can't open serial port. Please reboot system.")
+            sys.exit()
+        self.isPortOpen = True              # opened successfully
+        self.reader = ChunkReader(self.comm)      # bulk Rx reads
+        print("Serial port opened successfully : {0} attempts, {1:.1f} sec.".format(self.trycount, seconds))
 
         return
 
     # Receiving Data with time out setting[sec]
     def recv(self, timeout=300):
-        # for time out
-        time_start = time.time()
+        # for time out (monotonic : not affected by system clock changes)
+        deadline = time.monotonic() + timeout
         # Clear event to wait thread
         self.event.clear()
         # Clear Rx Buffer
         self.recvData.clear()
         # Rx result : True (success) False (fault: time out)
         rx_result = False
+        frame = None
 
         # Wait for Rx
         while not self.event.is_set():
+            # frame already decoded ? (several frames can arrive at once)
+            if self.recvFrames:
+                # Stop receiving data (success)
+                frame = self.recvFrames.popleft()
+                rx_result = True
+                self.stop()
+                break
+
             # Check time out
-            time_end = time.time()
-            if time_end - time_start > timeout:
+            if time.monotonic() >= deadline:
                 # Time out process
                 rx_result = False
                 self.stop()
@@ -90,61 +99,34 @@ class BtComm(object):
                 print("Rx timeout:{0}sec".format(timeout))
                 break
 
-            # Received !  read Rx
-            buff = self.comm.read()
+            # Received !  read Rx (all bytes waiting, not beyond the deadline)
+            buff = self.reader.read(deadline)
 
             # Check Rx data 
             if len(buff) > 0:
-                # Read Rx
-                self.recvData.extend(buff)
-                # <DLE(0x10)><ETX(0x03) Received ? 
-                if (self.recvData.find(b'\x10\x03')) >= 0:
-                    # Stop receiving data (success)
-                    rx_result = True
-                    self.stop()
-                    break
+                # decode Rx : checksum, 0x10 escape & <DLE><STX>..<DLE><ETX> framing in one pass
+                self.recvFrames.extend(self.decoder.feed(buff))
 
         # Return Result
         if rx_result:
+            self.recvData.extend(frame.raw)
             # DEBUG
             print('self.recvData = ', self.recvData)
             print('self.recvData = ', self.recvData.hex())
 
-            #
-            # here, process checksum, 0x10 escape process, & discriminating the command
-            #
             # received command
-            self.recvCommand = self.recvData[2]
-            # extract data for checksum
-            # recvdataforchecksum = self.recvData[2:-3]
-            # extract payload for 0x10 escape sequence
-            self.recvdataforescapesequence = self.recvData[2:-3]
+            self.recvCommand = frame.command
             # received data checksum
-            self.recvChecksumByte = self.recvData[-3]
-            # extract escape sequence 0x10
-            self.afterEscapeSequence = bytearray()
-            self.afterEscapeSequence.clear()
-            pnum = 0  # non 0x10
-            for num in self.recvdataforescapesequence:
-                if pnum == 0x10 & num == 0x10:
-                    pnum = 0
-                    continue
-                else:
-                    pnum = num
-                    self.afterEscapeSequence.append(num)
+            self.recvChecksumByte = frame.checksum
+            # command & parameter after 0x10 escape removal
+            self.afterEscapeSequence = bytearray(frame.data())
 
             print("self.afterEscapeSequence = ", self.afterEscapeSequence)
 
-            # check checksum
-            num_sum = 0
-            for num in self.afterEscapeSequence:
-                num_sum += num
-            checksumbyte = num_sum & 0xFF
-
-            print("checksumbyte = ", hex(checksumbyte))
+            print("checksumbyte = ", hex(checksum(self.afterEscapeSequence)))
             print("self.recvChecksumByte = ", hex(self.recvChecksumByte))
 
-            if checksumbyte == self.recvChecksumByte:
+            if frame.valid:
                 print("received data check sum is correct")
             else:
                 print("received data check sum is not correct")
@@ -155,22 +137,8 @@ class BtComm(object):
 
     # Send Data
     def send(self, data):
-        # check sum
-        self.sendbytesnoescape.clear()
-        num_sum = 0
-        for i in data:
-            num_sum = num_sum + i
-            self.sendbytesnoescape.append(i)
-        csum = num_sum & 0xFF       # extract only lowest byte
-        self.sendbytesnoescape.append(csum)
-
-        # 0x10 escape
-        self.sendbytesescape.clear()
-        for i in self.sendbytesnoescape:
-            self.sendbytesescape.append(i)
-            if i == 0x10:
-                self.sendbytesescape.append(i)
-        senddata = DLE + STX + self.sendbytesescape + DLE + ETX
+        # check sum, 0x10 escape & <DLE><STX>..<DLE><ETX> (constant commands are pre-encoded)
+        senddata = encode(data)
 
         # print("debug: senddata = " + str(senddata))
 
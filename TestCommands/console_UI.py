@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import os
 import sys
 import time
 
@@ -58,7 +59,8 @@ class TestConsole(tk.Frame):
         # Serial communication parameters
         #
         # set /dev/tty & baud rate (should be 1200 because of generating stable signal of bt-11)
-        self.ttySerialPort = '/dev/ttyTHS0'     # Serial Port tty of Orin NX & nano UART1
+        #   ARMM_TTY overrides the tty, e.g. the pty of the ARMM simulator (python3 -m armm.simulator)
+        self.ttySerialPort = os.environ.get('ARMM_TTY', '/dev/ttyTHS0')     # Serial Port tty of Orin NX & nano UART1
         # self.ttySerialPort = '/dev/tty.usbmodem69A0933337381'     # mac tty serial port (example)
         self.serialBaudRate = "1200"
         # self.serialBaudrate = "115200"                            # mac baud rate to bt-01
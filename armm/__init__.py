@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+#
+# ARMM shared modules
+#
+# Modules used by the host sample programs (bt-01_host_sample, bt-11_host_sample),
+# bt-11_SerialTestAfterWrite and TestCommands.
+# Copy this armm folder next to BT-SerialCommunication.py (e.g. /home/nvidia/bt-11/armm)
+# when installing a host sample program on the Edge AI Box.
+#
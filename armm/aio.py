@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+import os
+import asyncio
+import datetime
+import logging
+import termios
+import time
+
+from armm import commands
+from armm.codec import FrameDecoder, encode
+from armm.link import UNSOLICITED_MAX, Correlator
+from armm.latency import LinkStats
+from armm.serialio import OPEN_RETRY_FIRST, OPEN_RETRY_MAX, DeviceWatcher
+
+#
+# asyncio transport for the ARMM serial protocol
+#
+# The serial port (or a pty for testing) is opened as a non-blocking file descriptor
+# and attached to the event loop; ArmmProtocol decodes received bytes and completes
+# the asyncio Future of the request waiting for the response (same correlation as
+# link.BtLink).  AsyncBtComm has one coroutine for every command in the command table.
+#
+# Python 3.6 (Jetpack4.4) compatible : no asyncio.run / get_running_loop.
+#
+BAUDRATES = {
+    1200: termios.B1200,
+    9600: termios.B9600,
+    19200: termios.B19200,
+    38400: termios.B38400,
+    57600: termios.B57600,
+    115200: termios.B115200,
+}
+
+
+#
+# open tty, raw 8N1 without flow control, non-blocking
+#
+def open_tty(path, baudrate=1200):
+    fd = os.open(path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    try:
+        attr = termios.tcgetattr(fd)
+        attr[0] = 0                                         # iflag
+        attr[1] = 0                                         # oflag
+        attr[2] = termios.CS8 | termios.CREAD | termios.CLOCAL     # cflag
+        attr[3] = 0                                         # lflag
+        speed = BAUDRATES[int(baudrate)]
+        attr[4] = speed                                     # ispeed
+        attr[5] = speed                                     # ospeed
+        attr[6][termios.VMIN] = 0
+        attr[6][termios.VTIME] = 0
+        termios.tcsetattr(fd, termios.TCSANOW, attr)
+    except termios.error:
+        # pty slave on some systems : keep its settings
+        pass
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+
+
+#
+# open the port, wait until success (same as serialio.open_port, without blocking the loop)
+#   opener : function opening the port, raises OSError if it fails
+# return (port, attempts, seconds until opened)
+#
+async def open_port_async(path, opener, first=OPEN_RETRY_FIRST, maximum=OPEN_RETRY_MAX):
+    started = time.monotonic()
+    attempts = 0
+    interval = first
+    watcher = None
+    try:
+        while True:
+            attempts += 1
+            try:
+                return opener(), attempts, time.monotonic() - started
+            except OSError as e:
+                if attempts == 1:
+                    logging.debug("can't open " + path + " : " + str(e) + ", wait for it")
+            if watcher is None:
+                watcher = DeviceWatcher(path)
+            if not await wait_device(watcher, interval):
+                interval = min(interval * 2, maximum)
+    finally:
+        if watcher is not None:
+            watcher.close()
+
+
+# wait until the tty node changes or timeout [sec] passes, True if woken up by the tty node
+async def wait_device(watcher, timeout):
+    if watcher.fd is None:
+        await asyncio.sleep(timeout)
+        return False
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return False
+        readable = loop.create_future()
+        loop.add_reader(watcher.fd, lambda: readable.done() or readable.set_result(True))
+        try:
+            await asyncio.wait_for(readable, remaining)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            loop.remove_reader(watcher.fd)
+        if watcher.changed():
+            return True
+
+
+#
+# seconds until the next HH:MM (local time)
+#
+def seconds_until(hhmm):
+    hour, minute = [int(x) for x in hhmm.split(':')]
+    now = datetime.datetime.now()
+    at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if at <= now:
+        at += datetime.timedelta(days=1)
+    return (at - now).total_seconds()
+
+
+#
+# Rx side : decode frames & answer waiting requests
+#
+class ArmmProtocol(asyncio.Protocol):
+    def __init__(self, on_frame=None, stats=None):
+        self.decoder = FrameDecoder()
+        self.waiting = Correlator()
+        self.unsolicited = asyncio.Queue(UNSOLICITED_MAX)     # frames nobody waits for
+        self.unexpected = 0
+        self.stats = stats if stats is not None else LinkStats()
+        self.on_frame = on_frame            # callback(frame) for every frame (log)
+        self.closed = None                  # Future, set when the fd is closed
+
+    def connection_made(self, transport):
+        self.closed = asyncio.get_event_loop().create_future()
+
+    def data_received(self, data):
+        broken = self.decoder.framing_errors
+        for frame in self.decoder.feed(data):
+            if self.on_frame is not None:
+                self.on_frame(frame)
+            future = self.waiting.match(frame)
+            self.stats.frame(frame, future is not None)
+            if future is None:
+                self.unexpected += 1
+                logging.debug("unexpected frame : " + commands.name(frame.command))
+                self.keep(frame)
+            elif not future.done():
+                self.stats.response(future.command, time.monotonic() - future.started)
+                future.set_result(frame)
+        self.stats.broken_frames(self.decoder.framing_errors - broken)
+
+    # frame nobody waits for : kept for recv(), the oldest is dropped when the queue is full
+    def keep(self, frame):
+        if self.unsolicited.full():
+            dropped = self.unsolicited.get_nowait()
+            self.stats.dropped_frame()
+            logging.info("unsolicited frame dropped : " + dropped.raw.hex())
+        self.unsolicited.put_nowait(frame)
+
+    def connection_lost(self, exc):
+        error = exc if exc is not None else IOError("serial port closed")
+        for future in self.waiting.clear():
+            if not future.done():
+                future.set_exception(error)
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(exc)
+
+
+#
+# AI BOX Serial Communication Class (asyncio)
+#
+class AsyncBtComm(object):
+    def __init__(self, tty, baudrate=1200, on_frame=None, on_send=None, stats=None):
+        self.tty = tty
+        self.baudrate = baudrate
+        self.on_send = on_send              # callback(senddata) for every Tx frame (log)
+        self.protocol = ArmmProtocol(on_frame, stats)
+        self.stats = self.protocol.stats    # latency.LinkStats
+        self.rtransport = None
+        self.wtransport = None
+        self.isPortOpen = False
+        self.attempts = 0                   # attempts & time [sec] the last open took
+        self.open_seconds = 0.0
+
+    # open serial port, wait until the tty appears & opens
+    async def open(self):
+        loop = asyncio.get_event_loop()
+        fd, self.attempts, self.open_seconds = await open_port_async(
+            self.tty, lambda: open_tty(self.tty, self.baudrate))
+        logging.info('opened {0} : {1} attempts, {2:.1f} sec.'.format(self.tty, self.attempts, self.open_seconds))
+        # read & write transports on their own fd (closing one does not close the other)
+        rfile = os.fdopen(fd, 'rb', buffering=0)
+        wfile = os.fdopen(os.dup(fd), 'wb', buffering=0)
+        self.rtransport, _ = await loop.connect_read_pipe(lambda: self.protocol, rfile)
+        self.wtransport, _ = await loop.connect_write_pipe(asyncio.Protocol, wfile)
+        self.isPortOpen = True
+
+    def close(self):
+        if self.rtransport is not None:
+            self.rtransport.close()
+        if self.wtransport is not None:
+            self.wtransport.close()
+        self.rtransport = None
+        self.wtransport = None
+        self.isPortOpen = False
+
+    # send command + parameter, no response wait
+    def send(self, data):
+        if self.wtransport is None or self.wtransport.is_closing():
+            self.isPortOpen = False
+            return False
+        senddata = encode(data)
+        self.wtransport.write(senddata)
+        if self.on_send is not None:
+            self.on_send(senddata)
+        return True
+
+    # send request & wait for its response frame [sec]
+    # return Frame, None if time out.  raise IOError if the port is not usable
+    async def request(self, data, timeout=30.0):
+        future = asyncio.get_event_loop().create_future()
+        future.command = data[0]
+        future.started = time.monotonic()
+        expected = self.protocol.waiting.add(future)
+        if not self.send(data):
+            self.protocol.waiting.remove(future)
+            self.stats.send_error(future.command)
+            raise IOError("Can't send data through serial port.")
+        if not expected:
+            return None
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.protocol.waiting.remove(future)
+            self.stats.timeout(future.command)
+            return None
+
+    # frame nobody waits for, None if time out
+    async def recv(self, timeout=300.0):
+        try:
+            return await asyncio.wait_for(self.protocol.unsolicited.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    #
+    # commands
+    #
+    async def alive(self, timeout=30.0):
+        return await self.request(bytes([commands.ALIVE_REQ]), timeout)
+
+    async def status(self, timeout=30.0):
+        return await self.request(bytes([commands.STATUS_REQ]), timeout)
+
+    # <YY><MM><DD><hh><mm><ss> in BCD
+    async def time_sync(self, dt=None, timeout=30.0):
+        if dt is None:
+            dt = datetime.datetime.now()
+        data = bytes([commands.TIME_SYNC_REQ] + [convert2bcd(x) for x in (
+            dt.year % 100, dt.month, dt.day, dt.hour, dt.minute, dt.second)])
+        return await self.request(data, timeout)
+
+    async def log(self, timeout=30.0):
+        return await self.request(bytes([commands.LOG_REQ]), timeout)
+
+    async def reboot(self, timeout=30.0):
+        return await self.request(bytes([commands.REBOOT_REQ]), timeout)
+
+    # 0 : 30 sec., 1-255 : min.
+    async def poweroff_time(self, value, timeout=30.0):
+        return await self.request(bytes([commands.POWEROFF_TIME_REQ, value]), timeout)
+
+    # 0-255 : 1-256 min.
+    async def heartbeat_period(self, value, timeout=30.0):
+        return await self.request(bytes([commands.HEARTBEAT_PERIOD_REQ, value]), timeout)
+
+    async def power_button(self, timeout=30.0):
+        return await self.request(bytes([commands.POWER_BUTTON_REQ]), timeout)
+
+    async def reset_button(self, timeout=30.0):
+        return await self.request(bytes([commands.RESET_BUTTON_REQ]), timeout)
+
+    async def temperature(self, timeout=30.0):
+        return await self.request(bytes([commands.TEMPERATURE_REQ]), timeout)
+
+    async def nop(self, timeout=30.0):
+        return await self.request(bytes([commands.NOP]), timeout)
+
+
+#
+# Convert hex int (one byte) to BCD format (one byte)
+#
+def convert2bcd(num):
+    return 0x10 * (num // 10) + num % 10
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+from armm import commands
+
+#
+# ARMM serial frame codec
+#
+# format : <DLE><STX>[command1byte][parameter0～128byte][checksum1byte]<DLE><ETX>
+# checksum : sum (lowest 8 bit) of command & parameter
+# if 0x10 appears in command & parameter (& checksum), 0x10 is doubled as escape of <DLE>
+#
+# Encoding & decoding use bytes builtins (sum, replace, find, slicing) instead of
+# Python loops over every byte.  Frames of constant commands (alive_req, status_req,
+# log_req ...) are encoded once and taken from FRAMES.
+#
+# FrameDecoder is a streaming state machine.  Bytes can be fed in any chunk size
+# (one byte, a part of a frame, or several frames at once) and every complete frame is
+# returned in received order.  Garbage between frames and broken frames are skipped
+# until the next <DLE><STX>.
+#
+DLE_BYTE = 0x10
+STX_BYTE = 0x02
+ETX_BYTE = 0x03
+
+DLE = b'\x10'
+ESCAPED_DLE = b'\x10\x10'
+FRAME_START = b'\x10\x02'
+FRAME_END = b'\x10\x03'
+
+MAX_PARAMETER_LENGTH = 128
+MAX_BODY_LENGTH = 1 + MAX_PARAMETER_LENGTH + 1     # command + parameter + checksum
+
+# decoder states
+_HUNT = 0           # wait for <DLE>
+_HUNT_DLE = 1       # <DLE> received, wait for <STX>
+_BODY = 2           # in frame : command, parameter, checksum
+_BODY_DLE = 3       # <DLE> received in frame : <DLE> (escape) or <ETX> (end of frame)
+
+
+#
+# checksum : lowest 8 bit of sum of command & parameter
+#
+def checksum(data):
+    return sum(data) & 0xFF
+
+
+#
+# command & parameter -> frame to send
+#
+def encode(data):
+    if len(data) == 1:
+        frame = FRAMES.get(data[0])
+        if frame is not None:
+            return frame
+    body = bytes(data) + bytes((sum(data) & 0xFF,))
+    if DLE in body:
+        body = body.replace(DLE, ESCAPED_DLE)
+    return b''.join((FRAME_START, body, FRAME_END))
+
+
+# pre-encoded frames of commands without parameter
+FRAMES = {}
+FRAMES.update((code, encode(bytes((code,)))) for code in commands.NAMES)
+
+
+#
+# one complete frame (bytes, bytearray or memoryview) -> (command, parameter, checksum, valid)
+#   parameter is a memoryview on frame (no copy) unless 0x10 escape has to be removed
+#   raise ValueError if frame is not <DLE><STX> ... <DLE><ETX>
+#
+def decode(frame):
+    view = memoryview(frame)
+    if len(view) < 6 or view[:2] != FRAME_START or view[-2:] != FRAME_END:
+        raise ValueError('not a frame : ' + bytes(view).hex())
+    body = view[2:-2]
+    if isinstance(frame, (bytes, bytearray)):
+        escaped = frame.find(DLE, 2, len(frame) - 2) >= 0
+    else:
+        escaped = DLE_BYTE in body
+    if escaped:
+        body = memoryview(body.tobytes().replace(ESCAPED_DLE, DLE))
+    command = body[0]
+    parameter = body[1:-1]
+    checksumbyte = body[-1]
+    valid = (sum(body[:-1]) & 0xFF) == checksumbyte
+    return command, parameter, checksumbyte, valid
+
+
+#
+# Received frame
+#
+class Frame(object):
+    __slots__ = ('command', 'parameter', 'checksum', 'valid', 'raw')
+
+    def __init__(self, command, parameter, checksumbyte, valid, raw):
+        self.command = command          # command (int)
+        self.parameter = parameter      # parameter after escape removal (bytes)
+        self.checksum = checksumbyte    # received checksum (int)
+        self.valid = valid              # True if checksum is correct
+        self.raw = raw                  # frame as received, <DLE><STX> ... <DLE><ETX> (bytes)
+
+    # command & parameter (same as the data given to BtComm.send)
+    def data(self):
+        return bytes((self.command,)) + self.parameter
+
+    def __repr__(self):
+        return 'Frame(command=0x{0:02x}, parameter={1!r}, valid={2})'.format(
+            self.command, self.parameter, self.valid)
+
+
+#
+# Streaming frame decoder
+#
+class FrameDecoder(object):
+    def __init__(self, max_body=MAX_BODY_LENGTH):
+        self.max_body = max_body
+        self.state = _HUNT
+        self.body = bytearray()         # command + parameter + checksum, escape removed
+        self.raw = bytearray()          # frame bytes as received
+        # statistics
+        self.frames = 0                 # decoded frames (including checksum errors)
+        self.checksum_errors = 0        # frames with wrong checksum
+        self.framing_errors = 0         # broken frames (bad escape, too short, too long)
+        self.discarded = 0              # bytes skipped while hunting for <DLE><STX>
+
+    # forget a partly received frame
+    def reset(self):
+        self.state = _HUNT
+        self.body.clear()
+        self.raw.clear()
+
+    # feed received bytes, return list of complete frames
+    #   runs without 0x10 are searched with find() and copied at once
+    def feed(self, data):
+        if not isinstance(data, (bytes, bytearray)):
+            data = bytes(data)
+        frames = []
+        view = memoryview(data)
+        size = len(data)
+        i = 0
+        while i < size:
+            state = self.state
+            if state == _BODY:
+                j = data.find(DLE, i)
+                end = size if j < 0 else j
+                if len(self.body) + end - i > self.max_body:
+                    # too long : lost <DLE><ETX>, resync (bytes up to <DLE> are not a frame)
+                    self.discarded += end - i
+                    self._broken()
+                    i = end
+                    continue
+                self.body += view[i:end]
+                self.raw += view[i:end]
+                if j < 0:
+                    break
+                self.raw.append(DLE_BYTE)
+                self.state = _BODY_DLE
+                i = j + 1
+            elif state == _HUNT:
+                j = data.find(DLE, i)
+                if j < 0:
+                    self.discarded += size - i
+                    break
+                self.discarded += j - i
+                self.state = _HUNT_DLE
+                i = j + 1
+            else:
+                frame = self.feed_byte(data[i])
+                if frame is not None:
+                    frames.append(frame)
+                i += 1
+        return frames
+
+    # feed one byte, return a complete frame or None
+    def feed_byte(self, byte):
+        state = self.state
+        if state == _BODY:
+            self.raw.append(byte)
+            if byte == DLE_BYTE:
+                self.state = _BODY_DLE
+            elif len(self.body) < self.max_body:
+                self.body.append(byte)
+            else:
+                # too long : lost <DLE><ETX>, resync
+                self._broken()
+            return None
+
+        if state == _BODY_DLE:
+            if byte == DLE_BYTE:
+                # escaped 0x10
+                self.raw.append(byte)
+                self.state = _BODY
+                if len(self.body) < self.max_body:
+                    self.body.append(byte)
+                else:
+                    self._broken()
+                return None
+            if byte == ETX_BYTE:
+                self.raw.append(byte)
+                return self._complete()
+            if byte == STX_BYTE:
+                # <DLE><STX> in frame : previous frame is broken, new frame starts here
+                self._broken()
+                self.state = _BODY
+                self.raw.extend((DLE_BYTE, STX_BYTE))
+                return None
+            # single <DLE> followed by other byte : broken frame
+            self._broken()
+            self.discarded += 1
+            return None
+
+        if state == _HUNT_DLE:
+            if byte == STX_BYTE:
+                self.state = _BODY
+                self.raw.extend((DLE_BYTE, STX_BYTE))
+                return None
+            self.discarded += 1
+            if byte != DLE_BYTE:
+                self.state = _HUNT
+            return None
+
+        # _HUNT
+        if byte == DLE_BYTE:
+            self.state = _HUNT_DLE
+        else:
+            self.discarded += 1
+        return None
+
+    def _broken(self):
+        self.framing_errors += 1
+        self.discarded += len(self.raw)
+        self.reset()
+
+    def _complete(self):
+        body = self.body
+        if len(body) < 2:
+            # no command or no checksum
+            self._broken()
+            return None
+        command = body[0]
+        parameter = bytes(body[1:-1])
+        checksumbyte = body[-1]
+        valid = (sum(body) - checksumbyte) & 0xFF == checksumbyte
+        frame = Frame(command, parameter, checksumbyte, valid, bytes(self.raw))
+        self.frames += 1
+        if not valid:
+            self.checksum_errors += 1
+        self.reset()
+        return frame
@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import sqlite3
+import signal
+import asyncio
+import logging
+import tarfile
+import argparse
+import itertools
+import http
+import urllib.parse
+import concurrent.futures
+
+from armm.logquery import EVENT_NAMES, EVENT_PATTERNS, line_time, parse_when
+
+#
+# Fleet log collector
+#
+# The Edge AI Boxes send their log by mail (bt_id.txt attached), so looking at the fleet
+# meant reading mailboxes.  The collector is an HTTP service the boxes push their log
+# deltas to (python3 -m armm.logship --post URL BT-log : the tar.gz stream of the bytes
+# added since the last push, see armm.logship) :
+#   POST /logs/<bt_id>      body : tar.gz delta (Content-Length or chunked) -> 202 {"delta": id}
+#   GET  /events?bt_id=&type=&since=&until=&limit=
+#   GET  /devices           per bt_id : deltas, bytes, last seen, events per type
+#   GET  /stats
+#
+#   - one asyncio event loop serves all connections (thousands of boxes at once), the body
+#     is streamed into <root>/devices/<bt_id>/<time>-<n>.tar.gz and fsynced (thread) before
+#     the 202, so the box advances its checkpoint only for stored deltas
+#   - the deltas are parsed in a process pool (parse_delta) : every line is classified
+#     (heartbeat_ok, heartbeat (lost), rxtimeout, coldboot, state, checksum, restart, wan,
+#     error : the event types of armm.logquery)
+#   - events go into sqlite (<root>/collector.db), written by one thread, one transaction
+#     per delta; deltas not parsed yet (stop, crash) are parsed again at the next start
+#
+# There is no authentication : the collector listens on the loopback interface by default,
+# --host 0.0.0.0 only behind a reverse proxy authenticating the boxes (e.g. TLS client
+# certificates).
+#
+#   python3 -m armm.collector --root /var/lib/armm-collector --port 8080
+#
+HOST = '127.0.0.1'
+PORT = 8080
+MAX_BODY = 64 << 20         # bytes of one delta
+BLOCK = 65536
+LINE_MAX = 300              # characters of a line kept in the store
+QUERY_LIMIT = 1000
+HEADER_LIMIT = 65536
+
+# event type -> pattern (bytes), the armm.logquery events & received heartbeats
+EVENT_TYPES = [('heartbeat_ok', re.compile(rb'Received HEARTBEAT Response'))] + list(zip(EVENT_NAMES, EVENT_PATTERNS))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS deltas (
+    id INTEGER PRIMARY KEY, bt_id TEXT, path TEXT, received REAL, bytes INTEGER,
+    lines INTEGER, events INTEGER, status TEXT, error TEXT);
+CREATE TABLE IF NOT EXISTS devices (
+    bt_id TEXT PRIMARY KEY, first_seen REAL, last_seen REAL, deltas INTEGER, bytes INTEGER);
+CREATE TABLE IF NOT EXISTS events (
+    bt_id TEXT, at REAL, type TEXT, source TEXT, offset INTEGER, line TEXT, delta INTEGER);
+CREATE INDEX IF NOT EXISTS events_device ON events (bt_id, type, at);
+CREATE INDEX IF NOT EXISTS events_type ON events (type, at);
+CREATE INDEX IF NOT EXISTS deltas_status ON deltas (status);
+'''
+
+
+class HttpError(Exception):
+    def __init__(self, status, text=None):
+        Exception.__init__(self, text or http.HTTPStatus(status).phrase)
+        self.status = status
+
+
+# Content-Length (base 10) / chunk size (base 16) -> bytes, HttpError 400 if malformed
+def body_size(value, base=10):
+    try:
+        size = int(value, base)
+    except ValueError:
+        raise HttpError(400, 'bad body size')
+    if size < 0:
+        raise HttpError(400, 'bad body size')
+    return size
+
+
+#
+# parse one delta (process pool) : return (lines, events)
+#   events : list of (time, type, member name, offset in the generation, line)
+#
+def parse_delta(path):
+    lines = 0
+    events = []
+    with tarfile.open(path, 'r|gz') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            offset = int(member.pax_headers.get('ARMM.offset', 0))
+            at = None
+            for raw in tar.extractfile(member):
+                lines += 1
+                stamp = line_time(raw)
+                if stamp is not None:
+                    at = stamp
+                for name, pattern in EVENT_TYPES:
+                    if pattern.search(raw):
+                        events.append((at, name, member.name, offset,
+                                       raw[:LINE_MAX].decode('utf-8', 'replace').rstrip('\r\n')))
+                offset += len(raw)
+    return lines, events
+
+
+# directory name of a bt_id (bt_id.txt is free format)
+def safe_name(bt_id):
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', bt_id)[:64].lstrip('.')
+    if name != bt_id:
+        name += '-{0:08x}'.format(zlib.crc32(bt_id.encode('utf-8')))
+    return name
+
+
+#
+# sqlite store (used by one thread only)
+#
+class EventStore(object):
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+
+    def add_delta(self, bt_id, path, size):
+        now = time.time()
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO deltas (bt_id, path, received, bytes, status) VALUES (?, ?, ?, ?, 'received')",
+                (bt_id, path, now, size))
+            self.db.execute('INSERT OR IGNORE INTO devices VALUES (?, ?, ?, 0, 0)', (bt_id, now, now))
+            self.db.execute('UPDATE devices SET last_seen = ?, deltas = deltas + 1, bytes = bytes + ? '
+                            'WHERE bt_id = ?', (now, size, bt_id))
+        return cursor.lastrowid
+
+    def add_events(self, delta, bt_id, lines, events):
+        # events & status in one transaction : a delta still 'received' has no events
+        with self.db:
+            self.db.executemany('INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                [(bt_id, at, name, source, offset, line, delta)
+                                 for at, name, source, offset, line in events])
+            self.db.execute("UPDATE deltas SET lines = ?, events = ?, status = 'parsed' WHERE id = ?",
+                            (lines, len(events), delta))
+
+    def failed(self, delta, error):
+        with self.db:
+            self.db.execute("UPDATE deltas SET status = 'failed', error = ? WHERE id = ?", (error, delta))
+
+    # deltas not parsed : list of (id, bt_id, path)
+    def pending(self):
+        return self.db.execute("SELECT id, bt_id, path FROM deltas WHERE status = 'received' ORDER BY id").fetchall()
+
+    def events(self, bt_id=None, type=None, since=None, until=None, limit=QUERY_LIMIT):
+        sql = 'SELECT bt_id, at, type, source, offset, line FROM events WHERE 1'
+        args = []
+        for condition, value in (('bt_id = ?', bt_id), ('type = ?', type), ('at >= ?', since), ('at < ?', until)):
+            if value is not None:
+                sql += ' AND ' + condition
+                args.append(value)
+        sql += ' ORDER BY at LIMIT ?'
+        args.append(limit)
+        return [dict(zip(('bt_id', 'at', 'type', 'source', 'offset', 'line'), row))
+                for row in self.db.execute(sql, args)]
+
+    def devices(self):
+        found = {}
+        for bt_id, first, last, deltas, size in self.db.execute('SELECT * FROM devices ORDER BY bt_id'):
+            found[bt_id] = {'bt_id': bt_id, 'first_seen': first, 'last_seen': last, 'deltas': deltas,
+                            'bytes': size, 'events': {}, 'last_heartbeat': None}
+        for bt_id, name, count, last in self.db.execute(
+                'SELECT bt_id, type, COUNT(*), MAX(at) FROM events GROUP BY bt_id, type'):
+            if bt_id in found:
+                found[bt_id]['events'][name] = count
+                if name == 'heartbeat_ok':
+                    found[bt_id]['last_heartbeat'] = last
+        return list(found.values())
+
+    def counts(self):
+        return dict(self.db.execute('SELECT status, COUNT(*) FROM deltas GROUP BY status').fetchall())
+
+    def close(self):
+        self.db.close()
+
+
+# file of a delta being received, its directory made
+def open_part(tmp):
+    os.makedirs(os.path.dirname(tmp), exist_ok=True)
+    return open(tmp, 'wb')
+
+
+# move the received delta in place, durable before the reply
+def store_file(tmp, path):
+    with open(tmp, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Collector(object):
+    def __init__(self, root, workers=None, max_body=MAX_BODY):
+        self.root = root
+        self.max_body = max_body
+        os.makedirs(os.path.join(root, 'devices'), exist_ok=True)
+        self.store = EventStore(os.path.join(root, 'collector.db'))
+        self.db_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)     # sqlite
+        self.io_threads = concurrent.futures.ThreadPoolExecutor(max_workers=8)    # delta files
+        self.workers = workers or os.cpu_count() or 1
+        self.parsers = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        self.sequence = itertools.count()
+        self.server = None
+        # statistics
+        self.connections = 0
+        self.requests = 0
+        self.received = 0           # deltas
+        self.received_bytes = 0
+        self.parsed = 0
+        self.parse_failures = 0
+        self.parsing = 0            # deltas in the process pool
+
+    async def db(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.db_thread, func, *args)
+
+    async def io(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.io_threads, func, *args)
+
+    async def start(self, host=HOST, port=PORT):
+        # worker processes started before the listening socket exists (they must not inherit it)
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.parsers, os.getpid) for _ in range(self.workers)])
+        for delta, bt_id, path in await self.db(self.store.pending):
+            self.parse(delta, bt_id, path)
+        self.server = await asyncio.start_server(self.handle, host, port, limit=HEADER_LIMIT, backlog=1024)
+        return self.server
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.parsers.shutdown(wait=True)
+        self.io_threads.shutdown(wait=True)
+        self.db_thread.submit(self.store.close)
+        self.db_thread.shutdown(wait=True)
+
+    #
+    # parse in the process pool, store the events
+    #
+    def parse(self, delta, bt_id, path):
+        self.parsing += 1
+        future = asyncio.get_event_loop().run_in_executor(self.parsers, parse_delta, path)
+        asyncio.ensure_future(self._parsed(future, delta, bt_id, path))
+
+    async def _parsed(self, future, delta, bt_id, path):
+        try:
+            lines, events = await future
+        except Exception as e:
+            self.parse_failures += 1
+            logging.warning('collector : delta {0} of {1} not parsed : {2}'.format(delta, bt_id, e))
+            await self.db(self.store.failed, delta, str(e))
+            return
+        finally:
+            self.parsing -= 1
+        await self.db(self.store.add_events, delta, bt_id, lines, events)
+        self.parsed += 1
+
+    #
+    # HTTP/1.1 connection (keep-alive)
+    #
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.respond(writer, 431, {'error': 'header too large'}, False)
+                    break
+                keep = await self.request(head, reader, writer)
+                if not keep:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # one request, return True to keep the connection
+    async def request(self, head, reader, writer):
+        self.requests += 1
+        try:
+            lines = head.decode('latin-1').split('\r\n')
+            method, target, version = lines[0].split(' ', 2)
+            headers = {}
+            for line in lines[1:]:
+                if ':' in line:
+                    name, value = line.split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+        except ValueError:
+            await self.respond(writer, 400, {'error': 'bad request'}, False)
+            return False
+        keep = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        url = urllib.parse.urlsplit(target)
+        path = urllib.parse.unquote(url.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            if method == 'POST' and url.path.startswith('/logs/'):
+                status, body = await self.post_logs(urllib.parse.unquote(url.path[6:]), headers, reader)
+            else:
+                if 'content-length' in headers or 'transfer-encoding' in headers:
+                    await self.discard_body(headers, reader)
+                if method != 'GET':
+                    raise HttpError(405)
+                status, body = await self.get(path, query)
+        except HttpError as e:
+            # the body may not have been read : close
+            await self.respond(writer, e.status, {'error': str(e)}, False)
+            return False
+        await self.respond(writer, status, body, keep)
+        return keep
+
+    async def respond(self, writer, status, body, keep):
+        data = json.dumps(body).encode('utf-8')
+        writer.write('HTTP/1.1 {0} {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n'
+                     'Connection: {3}\r\n\r\n'.format(status, http.HTTPStatus(status).phrase, len(data),
+                                                     'keep-alive' if keep else 'close').encode('latin-1') + data)
+        await writer.drain()
+
+    # body blocks of a request (Content-Length or chunked)
+    async def body(self, headers, reader):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = body_size((await self.chunk_line(reader)).split(b';')[0], 16)
+                if size == 0:
+                    while (await self.chunk_line(reader)) != b'\r\n':
+                        pass            # trailers
+                    return
+                while size > 0:
+                    data = await reader.readexactly(min(size, BLOCK))
+                    size -= len(data)
+                    yield data
+                await reader.readexactly(2)
+        elif 'content-length' in headers:
+            left = body_size(headers['content-length'])
+            while left > 0:
+                data = await reader.readexactly(min(left, BLOCK))
+                left -= len(data)
+                yield data
+        else:
+            raise HttpError(411)
+
+    # chunk size or trailer line, HttpError 400 if longer than the stream limit
+    async def chunk_line(self, reader):
+        try:
+            return await reader.readuntil(b'\r\n')
+        except asyncio.LimitOverrunError:
+            raise HttpError(400, 'chunk line too long')
+
+    async def discard_body(self, headers, reader):
+        async for _ in self.body(headers, reader):
+            pass
+
+    async def post_logs(self, bt_id, headers, reader):
+        if not bt_id or len(bt_id) > 256:
+            raise HttpError(400, 'bad bt_id')
+        if body_size(headers.get('content-length', '0')) > self.max_body:
+            raise HttpError(413)
+        directory = os.path.join(self.root, 'devices', safe_name(bt_id))
+        path = os.path.join(directory, '{0}-{1}.tar.gz'.format(time.strftime('%Y%m%d-%H%M%S'), next(self.sequence)))
+        tmp = path + '.part'
+        size = 0
+        f = None
+        try:
+            async for data in self.body(headers, reader):
+                if f is None:
+                    if not data.startswith(b'\x1f\x8b'):
+                        raise HttpError(415, 'tar.gz delta expected')
+                    f = await self.io(open_part, tmp)
+                size += len(data)
+                if size > self.max_body:
+                    raise HttpError(413)
+                await self.io(f.write, data)
+            if f is None:
+                raise HttpError(400, 'empty delta')
+            await self.io(f.close)
+            await self.io(store_file, tmp, path)
+        except BaseException:
+            if f is not None:
+                f.close()
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            raise
+        delta = await self.db(self.store.add_delta, bt_id, path, size)
+        self.received += 1
+        self.received_bytes += size
+        self.parse(delta, bt_id, path)
+        return 202, {'delta': delta, 'bytes': size}
+
+    async def get(self, path, query):
+        if path == '/events':
+            try:
+                since = parse_when(query['since']) if 'since' in query else None
+                until = parse_when(query['until']) if 'until' in query else None
+                limit = min(int(query.get('limit', QUERY_LIMIT)), QUERY_LIMIT * 10)
+            except ValueError as e:
+                raise HttpError(400, str(e))
+            return 200, await self.db(self.store.events, query.get('bt_id'), query.get('type'), since, until, limit)
+        if path == '/devices':
+            return 200, await self.db(self.store.devices)
+        if path == '/stats':
+            return 200, self.snapshot(await self.db(self.store.counts))
+        raise HttpError(404)
+
+    def snapshot(self, counts=None):
+        return {
+            'connections': self.connections,
+            'requests': self.requests,
+            'received': self.received,
+            'received_bytes': self.received_bytes,
+            'parsed': self.parsed,
+            'parse_failures': self.parse_failures,
+            'parsing': self.parsing,
+            'deltas': counts or {},
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='collect the BT log deltas of the Edge AI Boxes over HTTP')
+    parser.add_argument('--root', default='collector', help='directory of the deltas & collector.db')
+    parser.add_argument('--host', default=HOST,
+                        help='listen address (no authentication : 0.0.0.0 only behind an authenticating proxy)')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=None, help='parser processes (default : CPUs)')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+    collector = Collector(args.root, args.workers)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(collector.start(args.host, args.port))
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    logging.info('collector : listening on {0}:{1}, root {2}'.format(args.host, args.port, args.root))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(collector.close())
+        logging.info('collector : {0}'.format(collector.snapshot()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
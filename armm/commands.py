@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+#
+# ARMM command codes
+#
+# A2B : AIBOX to ARMM (BT-01/11)
+# B2A : ARMM to AIBOX
+# response code of A2B command 0x0N is 0x8N, alive_req 0x55 is answered by 0xAA
+# 0xFF is returned for an unknown command
+#
+NOP = 0x00                  # A2B   : Just test Tx
+STATUS_REQ = 0x01           # A2B   : Status request
+TIME_SYNC_REQ = 0x02        # A2B   : Sync Data & Time
+LOG_REQ = 0x03              # A2B   : LOG request
+REBOOT_REQ = 0x04           # A2B   : Cold reboot request
+POWEROFF_TIME_REQ = 0x05    # A2B   : bt-11 Only : Power Off time setting request
+HEARTBEAT_PERIOD_REQ = 0x06     # A2B   : bt-11 Only : heartbeat period setting request
+POWER_BUTTON_REQ = 0x07     # A2B   : bt-11 Only : press power button
+RESET_BUTTON_REQ = 0x08     # A2B   : bt-11 Only : press reset button
+TEMPERATURE_REQ = 0x09      # A2B   : bt-11 Only : read temperature
+ALIVE_REQ = 0x55            # A2B   : Notice AI BOX is alive
+
+NOP_RES = 0x80              # B2A   : Received NOP (test Rx)
+STATUS_RES = 0x81           # B2A   : Status response
+TIME_SYNC_RES = 0x82        # B2A   : Response to Sync req (return Data & Time)
+LOG_RES = 0x83              # B2A   : Response to LOG req
+REBOOT_RES = 0x84           # B2A   : Response to reboot req
+POWEROFF_TIME_RES = 0x85    # B2A   : bt-11 Only : Response to Power Off time setting request
+HEARTBEAT_PERIOD_RES = 0x86     # B2A   : bt-11 Only : Response to heartbeat period setting request
+POWER_BUTTON_RES = 0x87     # B2A   : bt-11 Only : Response to press power button
+RESET_BUTTON_RES = 0x88     # B2A   : bt-11 Only : Response to press reset button
+TEMPERATURE_RES = 0x89      # B2A   : bt-11 Only : Response to read temperature
+ALIVE_RES = 0xAA            # B2A   : Response to alive_req
+UNKNOWN_RES = 0xFF          # B2A/A2B   : Received unknown command
+
+# command name for logs
+NAMES = {
+    NOP: 'nop',
+    STATUS_REQ: 'status_req',
+    TIME_SYNC_REQ: 'time_sync_req',
+    LOG_REQ: 'log_req',
+    REBOOT_REQ: 'reboot_req',
+    POWEROFF_TIME_REQ: 'poweroff_time_req',
+    HEARTBEAT_PERIOD_REQ: 'heartbeat_period_req',
+    POWER_BUTTON_REQ: 'power_button_req',
+    RESET_BUTTON_REQ: 'reset_button_req',
+    TEMPERATURE_REQ: 'temperature_req',
+    ALIVE_REQ: 'alive_req',
+    NOP_RES: 'nop_res',
+    STATUS_RES: 'status_res',
+    TIME_SYNC_RES: 'time_sync_res',
+    LOG_RES: 'log_res',
+    REBOOT_RES: 'reboot_res',
+    POWEROFF_TIME_RES: 'poweroff_time_res',
+    HEARTBEAT_PERIOD_RES: 'heartbeat_period_res',
+    POWER_BUTTON_RES: 'power_button_res',
+    RESET_BUTTON_RES: 'reset_button_res',
+    TEMPERATURE_RES: 'temperature_res',
+    ALIVE_RES: 'alive_res',
+    UNKNOWN_RES: 'unknown_res',
+}
+
+# request -> response
+RESPONSES = {
+    NOP: NOP_RES,
+    STATUS_REQ: STATUS_RES,
+    TIME_SYNC_REQ: TIME_SYNC_RES,
+    LOG_REQ: LOG_RES,
+    REBOOT_REQ: REBOOT_RES,
+    POWEROFF_TIME_REQ: POWEROFF_TIME_RES,
+    HEARTBEAT_PERIOD_REQ: HEARTBEAT_PERIOD_RES,
+    POWER_BUTTON_REQ: POWER_BUTTON_RES,
+    RESET_BUTTON_REQ: RESET_BUTTON_RES,
+    TEMPERATURE_REQ: TEMPERATURE_RES,
+    ALIVE_REQ: ALIVE_RES,
+}
+
+
+# name of a command code
+def name(code):
+    return NAMES.get(code, '0x{0:02x}'.format(code))
+
+
+# response code expected for a request code (None : no response defined)
+def response_code(code):
+    return RESPONSES.get(code)
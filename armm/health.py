@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import collections
+
+#
+# Network health model : when is the WAN down ?
+#
+# The old decision was one counter, +1 for every failed host and reset by any host that
+# answered, so per-host and per-round failures were mixed.  NetworkHealth keeps for every
+# probe target (name of ProbeResult, e.g. ICMP 8.8.8.8, ICMP 1.1.1.1, DNS query) :
+#   - EWMA of the RTT (answered rounds) and of the loss ratio (every round)
+#   - a window of the last `window` rounds (answered / not)
+# A target is down when it did not answer in any round of a full window.  The WAN is down
+# when at least `quorum` targets are down at the same time.  Targets given as `evidence`
+# (e.g. the DNS query, down with the resolver while the WAN is up) are kept and logged but
+# never counted for the quorum.  Every state change of a target
+# and every WAN decision is logged with the evidence (numbers of all targets).
+#
+# With window 4 and a round every 5 min., a target is down after 20 min. without answer,
+# the time of PING_TIME_OUT x PING_TIME_OUT_COUNT of the old counter.
+#
+ALPHA = 0.3                 # EWMA weight of the newest round
+WINDOW = 4                  # rounds
+
+
+class TargetHealth(object):
+    def __init__(self, name, window=WINDOW, alpha=ALPHA):
+        self.name = name
+        self.alpha = alpha
+        self.rounds = collections.deque(maxlen=window)  # True : answered
+        self.rtt = None             # [sec] EWMA of answered rounds
+        self.loss = None            # EWMA of loss ratio (0.0 .. 1.0)
+        self.failures = 0           # consecutive rounds without answer
+        self.down = False
+        self.last = None            # last ProbeResult
+
+    def update(self, result):
+        self.last = result
+        self.rounds.append(result.ok)
+        loss = result.loss if result.loss is not None else (0.0 if result.ok else 1.0)
+        self.loss = loss if self.loss is None else self.alpha * loss + (1.0 - self.alpha) * self.loss
+        if result.rtt is not None:
+            self.rtt = result.rtt if self.rtt is None else self.alpha * result.rtt + (1.0 - self.alpha) * self.rtt
+        self.failures = 0 if result.ok else self.failures + 1
+        self.down = len(self.rounds) == self.rounds.maxlen and not any(self.rounds)
+
+    # one line of evidence
+    def evidence(self):
+        text = '{0} : {1}, {2}/{3} rounds answered, {4} failed in a row'.format(
+            self.name, 'DOWN' if self.down else 'up', sum(self.rounds), len(self.rounds), self.failures)
+        if self.loss is not None:
+            text += ', loss ewma {0:.0f}%'.format(self.loss * 100.0)
+        if self.rtt is not None:
+            text += ', rtt ewma {0:.1f} ms'.format(self.rtt * 1000.0)
+        if self.last is not None and self.last.error:
+            text += ', last error ' + self.last.error
+        return text
+
+    def to_dict(self):
+        return {
+            'down': self.down,
+            'answered': sum(self.rounds),
+            'rounds': len(self.rounds),
+            'failures': self.failures,
+            'loss_ewma': None if self.loss is None else round(self.loss, 3),
+            'rtt_ewma_ms': None if self.rtt is None else round(self.rtt * 1000.0, 3),
+        }
+
+
+class NetworkHealth(object):
+    #   quorum   : targets down at the same time for WAN down (None : all counted targets)
+    #   evidence : names of the targets not counted for the quorum
+    def __init__(self, quorum=None, window=WINDOW, alpha=ALPHA, evidence=()):
+        self.quorum = quorum
+        self.evidence = frozenset(evidence)
+        self.window = window
+        self.alpha = alpha
+        self.targets = collections.OrderedDict()    # name -> TargetHealth
+        self.wan_down = False
+        self.decisions = 0          # rounds decided WAN down
+
+    def reset(self):
+        self.targets.clear()
+        self.wan_down = False
+
+    # targets counted for the quorum
+    def counted(self):
+        return [target for name, target in self.targets.items() if name not in self.evidence]
+
+    # targets needed for WAN down
+    def needed(self):
+        counted = len(self.counted())
+        if self.quorum is None:
+            return max(1, counted)
+        return min(self.quorum, max(1, counted))
+
+    #
+    # one probe round (list of ProbeResult), return True if the WAN is down
+    #
+    def update(self, results):
+        for result in results:
+            target = self.targets.get(result.name)
+            if target is None:
+                target = self.targets[result.name] = TargetHealth(result.name, self.window, self.alpha)
+            was = target.down
+            target.update(result)
+            if target.down != was:
+                logging.info('network health : ' + target.evidence())
+        counted = self.counted()
+        down = [target for target in counted if target.down]
+        wan_down = bool(counted) and len(down) >= self.needed()
+        if wan_down != self.wan_down or wan_down:
+            logging.info('network health : WAN {0} ({1} of {2} targets down, quorum {3})'.format(
+                'DOWN' if wan_down else 'up', len(down), len(counted), self.needed()))
+            for line in self.lines():
+                logging.info('network health :   ' + line)
+        self.wan_down = wan_down
+        if wan_down:
+            self.decisions += 1
+        return wan_down
+
+    def lines(self):
+        return [target.evidence() for target in self.targets.values()]
+
+    def snapshot(self):
+        return {
+            'wan_down': self.wan_down,
+            'quorum': self.needed(),
+            'evidence': sorted(self.evidence),
+            'targets': dict((name, target.to_dict()) for name, target in self.targets.items()),
+        }
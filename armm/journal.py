@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import mmap
+import time
+import zlib
+import struct
+import argparse
+import datetime
+import threading
+
+from armm import commands
+
+#
+# Binary flight recorder of the serial frames
+#
+# Every frame sent and received is appended to a fixed size ring file, mapped with mmap :
+# writing a record is a memory copy (no system call, no formatting), and the records are
+# in the page cache at once, so they survive a crash of the program and, after the kernel
+# writes them back (or sync_interval), a cold boot.  When the ring is full the oldest
+# records are overwritten.
+#
+#   file   : header (HEADER_SIZE bytes) + ring (size bytes)
+#   header : magic, version, header size, ring size, head (next write offset), next sequence
+#   record : RECORD header + frame bytes as on the wire
+#            sync, length of the frame bytes, sequence, time.monotonic(), direction,
+#            command code, crc32 (record header without crc + frame bytes)
+# A record never wraps : if it does not fit before the end of the ring, the rest of the
+# ring is cleared and the record is written at offset 0.  A SESSION record (wall clock
+# time.time() as payload) is written at every open, and an ANCHOR record (same payload)
+# every ANCHOR_EVERY records, so monotonic times can be printed as dates also when the
+# SESSION record has been overwritten.  Records partly overwritten fail their crc and are
+# skipped by the reader.
+#
+#   python3 -m armm.journal /home/nvidia/bt-11/BT-frames.bin
+#
+MAGIC = b'ARMMJRNL'
+VERSION = 1
+HEADER = struct.Struct('<8sIIIIQ')
+HEADER_SIZE = 64
+RECORD = struct.Struct('<HHIdBBxxI')
+SYNC = 0xA55A
+SYNC_BYTES = struct.pack('<H', SYNC)
+JOURNAL_SIZE = 4 << 20      # ring bytes
+SYNC_INTERVAL = 60.0        # [sec] msync at most this often (None : never, left to the kernel)
+ANCHOR_EVERY = 256          # records between ANCHOR records
+
+RX = 0
+TX = 1
+SESSION = 2
+ANCHOR = 3
+DIRECTIONS = {RX: 'RX', TX: 'TX', SESSION: 'SESSION', ANCHOR: 'ANCHOR'}
+
+
+class FrameJournal(object):
+    def __init__(self, filename, size=JOURNAL_SIZE, sync_interval=SYNC_INTERVAL):
+        self.filename = filename
+        self.size = size
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()    # reader thread (Rx) & main thread (Tx)
+        self.f = None
+        self.map = None
+        self.head = 0
+        self.sequence = 0
+        self.last_sync = time.monotonic()
+        self.records = 0                # records written since open
+        self.unanchored = 0             # records since the last SESSION / ANCHOR record
+        self.wraps = 0
+
+    #
+    # open (create) the ring file & write a SESSION record
+    # a file of another format or size is started again
+    #
+    def open(self):
+        total = HEADER_SIZE + self.size
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        self.f = os.fdopen(fd, 'r+b')
+        if os.fstat(fd).st_size != total:
+            self.f.truncate(0)
+            self.f.truncate(total)
+        self.map = mmap.mmap(fd, total)
+        magic, version, header_size, size, head, sequence = HEADER.unpack_from(self.map, 0)
+        if magic == MAGIC and version == VERSION and header_size == HEADER_SIZE and size == self.size \
+                and head <= size:
+            self.head = head
+            self.sequence = sequence
+        else:
+            self.map[:total] = bytes(total)
+            self.head = 0
+            self.sequence = 0
+            self._write_header()
+        self.append(SESSION, 0, struct.pack('<d', time.time()))
+        return self
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.flush()
+                self.map.close()
+                self.map = None
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+    # received frame (armm.codec.Frame)
+    def rx(self, frame):
+        self.append(RX, frame.command, frame.raw)
+
+    # sent frame bytes (encoded), command code of the request
+    def tx(self, raw, command=None):
+        if command is None:
+            command = raw[2] if len(raw) > 2 else 0
+        self.append(TX, command, raw)
+
+    def append(self, direction, command, payload):
+        if self.map is None:
+            return
+        payload = bytes(payload)
+        if RECORD.size + len(payload) > self.size:
+            return
+        with self.lock:
+            if self.map is None:
+                return
+            if direction in (SESSION, ANCHOR):
+                self.unanchored = 0
+            elif self.unanchored >= ANCHOR_EVERY:
+                self._append(ANCHOR, 0, struct.pack('<d', time.time()))
+                self.unanchored = 0
+            self._append(direction, command, payload)
+            self.unanchored += 1
+            if self.sync_interval is not None and time.monotonic() - self.last_sync >= self.sync_interval:
+                self.map.flush()
+                self.last_sync = time.monotonic()
+
+    # write one record (lock held)
+    def _append(self, direction, command, payload):
+        need = RECORD.size + len(payload)
+        if self.head + need > self.size:
+            # clear the end of the ring & wrap
+            start = HEADER_SIZE + self.head
+            self.map[start:HEADER_SIZE + self.size] = bytes(self.size - self.head)
+            self.head = 0
+            self.wraps += 1
+        at = HEADER_SIZE + self.head
+        header = RECORD.pack(SYNC, len(payload), self.sequence & 0xFFFFFFFF, time.monotonic(),
+                             direction, command & 0xFF, 0)[:-4]
+        crc = zlib.crc32(payload, zlib.crc32(header))
+        self.map[at:at + RECORD.size] = header + struct.pack('<I', crc)
+        self.map[at + RECORD.size:at + need] = payload
+        self.head += need
+        self.sequence += 1
+        self.records += 1
+        self._write_header()
+
+    def _write_header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, HEADER_SIZE, self.size, self.head, self.sequence)
+
+    def __str__(self):
+        return '{0} records, {1} wraps, head {2} of {3} bytes'.format(
+            self.records, self.wraps, self.head, self.size)
+
+
+#
+# read all valid records of a journal file, oldest first
+# return list of (sequence, monotonic, direction, command, payload)
+#
+def read_records(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER_SIZE:
+        raise ValueError('not a frame journal : ' + filename)
+    magic, version, header_size, size, _, _ = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a frame journal : ' + filename)
+    ring = memoryview(data)[header_size:header_size + size]
+    records = []
+    pos = 0
+    while pos + RECORD.size <= size:
+        sync, length, sequence, monotonic, direction, command, crc = RECORD.unpack_from(ring, pos)
+        end = pos + RECORD.size + length
+        if sync == SYNC and end <= size and direction in DIRECTIONS and \
+                zlib.crc32(ring[pos + RECORD.size:end], zlib.crc32(ring[pos:pos + RECORD.size - 4])) == crc:
+            records.append((sequence, monotonic, direction, command, bytes(ring[pos + RECORD.size:end])))
+            pos = end
+            continue
+        # not a record (cleared or overwritten) : next sync word
+        found = data.find(SYNC_BYTES, header_size + pos + 1, header_size + size)
+        if found < 0:
+            break
+        pos = found - header_size
+    records.sort(key=lambda record: record[0])
+    return records
+
+
+#
+# records -> text lines, monotonic time converted to local date & time with the SESSION records
+#
+def format_records(records, directions=None):
+    base = None             # (monotonic, wall clock) of the session
+    # records before the first anchor : same session if it is an ANCHOR record
+    for _, monotonic, direction, _, payload in records:
+        if direction in (SESSION, ANCHOR):
+            if direction == ANCHOR:
+                base = (monotonic, struct.unpack('<d', payload)[0])
+            break
+    for _, monotonic, direction, command, payload in records:
+        if direction in (SESSION, ANCHOR):
+            base = (monotonic, struct.unpack('<d', payload)[0])
+            if direction == SESSION:
+                yield '---- session started {0} ----'.format(datetime.datetime.fromtimestamp(base[1]))
+            continue
+        if directions is not None and direction not in directions:
+            continue
+        if base is not None:
+            at = str(datetime.datetime.fromtimestamp(base[1] + monotonic - base[0]))
+        else:
+            at = 'monotonic {0:.6f}'.format(monotonic)
+        yield '{0} {1} {2:<22} {3}'.format(at, DIRECTIONS[direction], commands.name(command), payload.hex())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='print the ARMM frame journal (binary flight recorder) as text')
+    parser.add_argument('filename', help='journal file (e.g. /home/nvidia/bt-11/BT-frames.bin)')
+    parser.add_argument('--rx', action='store_true', help='received frames only')
+    parser.add_argument('--tx', action='store_true', help='sent frames only')
+    parser.add_argument('--last', type=int, default=0, help='print only the last N lines')
+    args = parser.parse_args()
+
+    directions = None
+    if args.rx or args.tx:
+        directions = set()
+        if args.rx:
+            directions.add(RX)
+        if args.tx:
+            directions.add(TX)
+    try:
+        lines = list(format_records(read_records(args.filename), directions))
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    if args.last > 0:
+        lines = lines[-args.last:]
+    try:
+        for line in lines:
+            print(line)
+    except BrokenPipeError:
+        # output closed (e.g. | head)
+        sys.stderr.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
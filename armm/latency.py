@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import datetime
+import threading
+import collections
+
+from armm import commands
+
+#
+# Round trip latency of every request / response, per command
+#
+# Latency is measured with time.monotonic() from sending the request to decoding its
+# response, and recorded in a log-linear histogram (HDR histogram style) : values below
+# 2^SUB_BUCKET_BITS [usec] are exact, larger values are counted in 2^(SUB_BUCKET_BITS-1)
+# buckets per power of 2 (relative error < 1.6 %).  Percentiles return the highest value
+# of the bucket.
+#
+# LinkStats also counts time outs, send errors, responses with a wrong checksum, broken
+# frames and unexpected frames.  One LinkStats is shared by the BtLink / AsyncBtComm
+# instances of a program (BtComm is re-created after a port error), so the numbers cover
+# the whole run.
+#
+SUB_BUCKET_BITS = 7
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+PERCENTILES = (50.0, 95.0, 99.0)
+
+
+# value [usec] -> bucket index
+def bucket_index(value):
+    if value < SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return SUB_BUCKET_COUNT + (shift - 1) * SUB_BUCKET_HALF + (value >> shift) - SUB_BUCKET_HALF
+
+
+# bucket index -> highest value [usec] counted in the bucket
+def bucket_high(index):
+    if index < SUB_BUCKET_COUNT:
+        return index
+    shift, top = divmod(index - SUB_BUCKET_COUNT, SUB_BUCKET_HALF)
+    shift += 1
+    return ((top + SUB_BUCKET_HALF + 1) << shift) - 1
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = collections.Counter()     # bucket index -> count
+        self.count = 0
+        self.total = 0                          # [usec] sum for mean
+        self.min = None
+        self.max = None
+
+    # record one latency [sec]
+    def record(self, seconds):
+        value = max(0, int(seconds * 1e6))
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    # latency [usec] below which percent of the values are, None if empty
+    def percentile(self, percent):
+        if self.count == 0:
+            return None
+        rank = max(1, int(self.count * percent / 100.0 + 0.5))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(bucket_high(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    # summary in msec.
+    def to_dict(self):
+        summary = {'count': self.count}
+        if self.count:
+            summary['min_ms'] = self.min / 1000.0
+            summary['mean_ms'] = round(self.mean() / 1000.0, 3)
+            for percent in PERCENTILES:
+                summary['p{0:g}_ms'.format(percent)] = self.percentile(percent) / 1000.0
+            summary['max_ms'] = self.max / 1000.0
+        return summary
+
+
+class LinkStats(object):
+    def __init__(self):
+        # RLock : write() may run in a signal handler while the main thread records
+        self.lock = threading.RLock()
+        self.started = time.time()
+        self.histograms = {}                        # request command code -> Histogram
+        self.timeouts = collections.Counter()       # request command code -> time outs
+        self.send_errors = collections.Counter()    # request command code -> send errors
+        self.checksum_errors = collections.Counter()    # received command code -> wrong checksum
+        self.unexpected = collections.Counter()     # received command code -> frames nobody waited for
+        self.framing_errors = 0
+        self.dropped = 0                            # unexpected frames dropped (queue full)
+
+    # response to request `command` received after `seconds`
+    def response(self, command, seconds):
+        with self.lock:
+            histogram = self.histograms.get(command)
+            if histogram is None:
+                histogram = self.histograms[command] = Histogram()
+            histogram.record(seconds)
+
+    def timeout(self, command):
+        with self.lock:
+            self.timeouts[command] += 1
+
+    def send_error(self, command):
+        with self.lock:
+            self.send_errors[command] += 1
+
+    # every received frame
+    def frame(self, frame, expected=True):
+        with self.lock:
+            if not frame.valid:
+                self.checksum_errors[frame.command] += 1
+            if not expected:
+                self.unexpected[frame.command] += 1
+
+    # unexpected frame dropped, nobody read it
+    def dropped_frame(self):
+        with self.lock:
+            self.dropped += 1
+
+    def broken_frames(self, count):
+        if count:
+            with self.lock:
+                self.framing_errors += count
+
+    # all numbers (JSON serializable)
+    def snapshot(self):
+        with self.lock:
+            codes = set(self.histograms) | set(self.timeouts) | set(self.send_errors)
+            per_command = {}
+            for code in sorted(codes):
+                histogram = self.histograms.get(code, Histogram())
+                entry = histogram.to_dict()
+                entry['timeouts'] = self.timeouts[code]
+                entry['send_errors'] = self.send_errors[code]
+                per_command[commands.name(code)] = entry
+            return {
+                'since': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                'at': datetime.datetime.now().isoformat(timespec='seconds'),
+                'commands': per_command,
+                'timeouts': sum(self.timeouts.values()),
+                'send_errors': sum(self.send_errors.values()),
+                'checksum_errors': dict((commands.name(k), v) for k, v in sorted(self.checksum_errors.items())),
+                'framing_errors': self.framing_errors,
+                'unexpected': dict((commands.name(k), v) for k, v in sorted(self.unexpected.items())),
+                'dropped': self.dropped,
+            }
+
+    # write snapshot as JSON, replaced at once (readers never see a partial file)
+    #   extra : other sections added to the snapshot (e.g. {'timers': TimerScheduler.snapshot()})
+    def write(self, filename, extra=None):
+        snapshot = self.snapshot()
+        if extra:
+            snapshot.update(extra)
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f, indent=1)
+            f.write('\n')
+        os.replace(tmp, filename)
+        return snapshot
+
+    # one line per command for the log
+    def lines(self):
+        snapshot = self.snapshot()
+        result = []
+        for name, entry in snapshot['commands'].items():
+            if entry['count']:
+                result.append('{0} : {1} responses, p50 {2:.1f} ms, p95 {3:.1f} ms, p99 {4:.1f} ms, '
+                              'max {5:.1f} ms, {6} time outs'.format(
+                                  name, entry['count'], entry['p50_ms'], entry['p95_ms'],
+                                  entry['p99_ms'], entry['max_ms'], entry['timeouts']))
+            else:
+                result.append('{0} : no response, {1} time outs, {2} send errors'.format(
+                    name, entry['timeouts'], entry['send_errors']))
+        result.append('checksum errors {0}, framing errors {1}, unexpected {2} ({3} dropped)'.format(
+            sum(snapshot['checksum_errors'].values()), snapshot['framing_errors'],
+            sum(snapshot['unexpected'].values()), snapshot['dropped']))
+        return result
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import collections
+import logging
+import queue
+from concurrent.futures import Future
+
+from armm import commands
+from armm.codec import FrameDecoder
+from armm.latency import LinkStats
+from armm.serialio import ChunkReader
+
+#
+# Background reader thread & request/response correlation
+#
+# One reader thread owns the Rx side of the serial port: it decodes frames and either
+# completes the Future of the request waiting for that response code, or puts the
+# frame on the unsolicited queue (UNSOLICITED_MAX frames, the oldest is dropped and logged
+# when nobody reads them).  Responses are matched by command code
+#   0x55 -> 0xAA, 0x0N -> 0x8N
+# and requests waiting for the same code are answered in order (FIFO).
+# 0xFF (unknown command) answers the oldest waiting request.
+# Round trip latency, time outs and Rx errors are counted in stats (latency.LinkStats).
+# Every received frame is recorded in journal (journal.FrameJournal) if given.
+#
+READER_POLL = 1.0       # reader thread checks the stop flag at least every 1 sec.
+UNSOLICITED_MAX = 64    # unsolicited frames kept for recv()
+
+
+#
+# Waiting requests, matched to received frames by command code
+#   future : any object with .command (request command code), e.g. Future
+#
+class Correlator(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}                       # response code -> deque of futures
+        self.order = collections.deque()        # all waiting futures in request order
+
+    # wait for the response of future.command
+    # return False if no response is defined for the command
+    def add(self, future):
+        code = commands.response_code(future.command)
+        if code is None:
+            return False
+        with self.lock:
+            self.pending.setdefault(code, collections.deque()).append(future)
+            self.order.append(future)
+        return True
+
+    # forget a waiting future (time out, send error)
+    def remove(self, future):
+        with self.lock:
+            waiting = self.pending.get(commands.response_code(future.command))
+            if waiting and future in waiting:
+                waiting.remove(future)
+                self.order.remove(future)
+
+    # future waiting for this frame (None : unsolicited frame)
+    def match(self, frame):
+        with self.lock:
+            waiting = self.pending.get(frame.command)
+            if waiting:
+                future = waiting.popleft()
+                self.order.remove(future)
+                return future
+            if frame.command == commands.UNKNOWN_RES and self.order:
+                future = self.order.popleft()
+                self.pending[commands.response_code(future.command)].remove(future)
+                return future
+        return None
+
+    # forget all waiting futures, return them
+    def clear(self):
+        with self.lock:
+            waiting = list(self.order)
+            self.order.clear()
+            self.pending.clear()
+        return waiting
+
+
+class BtLink(object):
+    def __init__(self, comm, decoder=None, stats=None, journal=None):
+        self.comm = comm                        # pyserial Serial (opened)
+        self.timeout = comm.timeout             # port timeout given at port open
+        self.reader = None
+        self.decoder = decoder if decoder is not None else FrameDecoder()
+        self.waiting = Correlator()             # requests waiting for response
+        self.unsolicited = queue.Queue(UNSOLICITED_MAX)     # frames nobody waits for
+        self.unexpected = 0                     # number of unsolicited frames
+        self.stats = stats if stats is not None else LinkStats()
+        self.journal = journal                  # FrameJournal or None
+        self.error = None                       # serial error stopped the reader thread
+        self.running = False
+        self.thread = None
+
+    # start reader thread
+    def start(self):
+        if self.running:
+            return
+        # reader thread wakes up at least every READER_POLL
+        self.comm.timeout = READER_POLL
+        self.reader = ChunkReader(self.comm)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='BtLink-reader')
+        self.thread.daemon = True
+        self.thread.start()
+
+    # stop reader thread (waits at most READER_POLL)
+    def stop(self):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(READER_POLL * 2)
+        self.thread = None
+        self.comm.timeout = self.timeout
+
+    #
+    # register a request & send it
+    #   data : command + parameter (given to send)
+    #   send : function sending data, returns True if sent (BtComm.send)
+    # return Future, result is the response Frame
+    #
+    def request(self, data, send):
+        future = Future()
+        future.command = data[0]
+        future.started = time.monotonic()
+        if self.error is not None:
+            future.set_exception(self.error)
+            return future
+        expected = self.waiting.add(future)
+        if not send(data):
+            self.waiting.remove(future)
+            self.stats.send_error(future.command)
+            future.set_exception(IOError("Can't send data through serial port."))
+        elif not expected:
+            # no response defined for this command
+            future.set_result(None)
+        return future
+
+    # forget a request (time out)
+    def cancel(self, future):
+        self.waiting.remove(future)
+        if future.cancel():
+            self.stats.timeout(future.command)
+
+    # unsolicited frame, wait at most timeout (None if nothing)
+    def get(self, timeout):
+        try:
+            return self.unsolicited.get(timeout=timeout)
+        except queue.Empty:
+            if self.error is not None:
+                raise self.error
+            return None
+
+    # received frame : answer a request or queue it
+    def dispatch(self, frame):
+        future = self.waiting.match(frame)
+        self.stats.frame(frame, future is not None)
+        if future is None:
+            self.unexpected += 1
+            logging.debug("unexpected frame : " + commands.name(frame.command))
+            self.keep(frame)
+        elif future.set_running_or_notify_cancel():
+            self.stats.response(future.command, time.monotonic() - future.started)
+            future.set_result(frame)
+
+    # frame nobody waits for : kept for get(), the oldest is dropped when the queue is full
+    def keep(self, frame):
+        while True:
+            try:
+                self.unsolicited.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    dropped = self.unsolicited.get_nowait()
+                except queue.Empty:
+                    continue
+                self.stats.dropped_frame()
+                logging.info("unsolicited frame dropped : " + dropped.raw.hex())
+
+    def _run(self):
+        try:
+            while self.running:
+                buff = self.reader.read(time.monotonic() + READER_POLL * 2)
+                if buff:
+                    broken = self.decoder.framing_errors
+                    for frame in self.decoder.feed(buff):
+                        if self.journal is not None:
+                            self.journal.rx(frame)
+                        self.dispatch(frame)
+                    self.stats.broken_frames(self.decoder.framing_errors - broken)
+        except OSError as e:     # serial.SerialException is an OSError
+            logging.error("serial port read error : " + str(e))
+            self._fail(e)
+        self.running = False
+
+    # reader stopped by an error : fail all waiting requests
+    def _fail(self, error):
+        self.error = error
+        for future in self.waiting.clear():
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error)
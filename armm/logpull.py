@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import time
+import asyncio
+import collections
+import logging
+import concurrent.futures
+
+from armm import commands
+
+#
+# Pipelined ARMM log retrieval
+#
+# ARMM returns one log record for each log_req, and 'NO LOG' after the last record.
+# Instead of log_req -> wait for log_res -> sleep 1 sec. -> log_req ..., the next
+# log_req is sent as soon as a record is decoded, keeping up to `window` requests
+# outstanding.  Records are written by the sink (LogWriter.sink : one writer thread).
+#
+LOG_END = b'NO LOG'
+LOG_REQ_DATA = bytes([commands.LOG_REQ])
+LOG_PULL_WINDOW = 2         # log_req outstanding at once
+LOG_PULL_TIMEOUT = 30.0     # [sec] wait for one log_res
+LOG_PULL_MAX_TIMEOUTS = 3   # give up after continuous time outs
+
+
+#
+# records / bytes counter & throughput
+#
+class LogPullStats(object):
+    def __init__(self):
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+        self.records = 0        # log records (not including 'NO LOG')
+        self.bytes = 0          # parameter bytes of the records
+        self.timeouts = 0
+        self.complete = False   # 'NO LOG' received
+
+    def add(self, frame):
+        self.records += 1
+        self.bytes += len(frame.parameter)
+
+    def finish(self):
+        self.elapsed = time.monotonic() - self.started
+
+    def records_per_sec(self):
+        return self.records / self.elapsed if self.elapsed > 0 else 0.0
+
+    def bytes_per_sec(self):
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return '{0} records, {1} bytes in {2:.1f} sec. : {3:.2f} records/s, {4:.1f} bytes/s{5}'.format(
+            self.records, self.bytes, self.elapsed, self.records_per_sec(), self.bytes_per_sec(),
+            '' if self.complete else ' (not complete)')
+
+
+def is_log_end(frame):
+    return frame.parameter.find(LOG_END) >= 0
+
+
+#
+# pull all logs, threaded version
+#   request : function data -> concurrent.futures.Future of the response frame (BtComm.request)
+#   sink    : write(frame) writes one log record (LogWriter.sink(line) of armm.logwriter)
+#
+def pull_logs(request, sink, window=LOG_PULL_WINDOW, timeout=LOG_PULL_TIMEOUT,
+              max_timeouts=LOG_PULL_MAX_TIMEOUTS, cancel=None):
+    stats = LogPullStats()
+    outstanding = collections.deque()
+    timeouts = 0
+    stop = False
+    try:
+        while True:
+            # keep `window` log_req outstanding
+            while not stop and len(outstanding) < window:
+                outstanding.append(request(LOG_REQ_DATA))
+            if not outstanding:
+                break
+
+            future = outstanding.popleft()
+            try:
+                frame = future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                if cancel is not None:
+                    cancel(future)
+                stats.timeouts += 1
+                timeouts += 1
+                logging.debug("not received log response")
+                if timeouts >= max_timeouts:
+                    stop = True
+                continue
+            except IOError:
+                # send error : stop requesting, collect what is outstanding
+                logging.debug("log request failed")
+                stop = True
+                continue
+            timeouts = 0
+
+            if stats.complete:
+                # response to a request sent before 'NO LOG' arrived
+                continue
+            sink.write(frame)
+            if is_log_end(frame):
+                stats.complete = True
+                stop = True
+            else:
+                stats.add(frame)
+    finally:
+        stats.finish()
+    return stats
+
+
+#
+# pull all logs, asyncio version
+#   request : coroutine function (data, timeout) -> response frame or None (AsyncBtComm.request)
+#   sink    : same as pull_logs
+#
+async def pull_logs_async(request, sink, window=LOG_PULL_WINDOW, timeout=LOG_PULL_TIMEOUT,
+                          max_timeouts=LOG_PULL_MAX_TIMEOUTS):
+    stats = LogPullStats()
+    outstanding = collections.deque()
+    timeouts = 0
+    stop = False
+    try:
+        while True:
+            while not stop and len(outstanding) < window:
+                outstanding.append(asyncio.ensure_future(request(LOG_REQ_DATA, timeout)))
+            if not outstanding:
+                break
+
+            try:
+                frame = await outstanding.popleft()
+            except IOError:
+                logging.debug("log request failed")
+                stop = True
+                continue
+            if frame is None:
+                stats.timeouts += 1
+                timeouts += 1
+                logging.debug("not received log response")
+                if timeouts >= max_timeouts:
+                    stop = True
+                continue
+            timeouts = 0
+
+            if stats.complete:
+                continue
+            sink.write(frame)
+            if is_log_end(frame):
+                stats.complete = True
+                stop = True
+            else:
+                stats.add(frame)
+    finally:
+        for task in outstanding:
+            task.cancel()
+        stats.finish()
+    return stats
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import gzip
+import json
+import zlib
+import bisect
+import argparse
+import datetime
+
+try:
+    import zstandard        # optional, for BT-log.N.zst
+except ImportError:
+    zstandard = None
+
+from armm.logrotate import generations, index_path
+
+#
+# Time indexed query of the BT log generations
+#
+# For every generation (BT-log.7[.gz|.zst] .. BT-log.1, BT-log) a sparse index is kept
+# next to the file, in .<file name>.idx : the time stamp, byte offset (uncompressed) and line
+# number of one line every INDEX_EVERY lines, and the time range of the file.  A query
+# for a time range skips the generations outside the range and starts reading at the last
+# index entry before the start time, instead of reading all files.  Every entry also has a
+# bit mask of the event types (EVENTS) found in its block of lines, so an event query reads
+# only the blocks containing the event.  The index of the live
+# BT-log is extended from where it stopped (the file only grows until it is rotated);
+# an index not matching its file (other inode, smaller file, other first bytes) is built again.
+# LogRotator renames the indexes with their generations, so a rotation does not make the
+# older generations be indexed again.
+#
+# Compressed generations are read through gzip / zstandard : the offset is in the
+# uncompressed data, so seeking still decompresses up to it, but the lines before it are
+# not parsed.
+#
+# Time stamps : logging lines '2023-11-16 02:00:00,123 : INFO : ...' and writelog lines
+# 'BT11 DEBUG: 2023-11-16 02:00:00.123456...'.  Lines without time stamp (ARMM log records)
+# get the time of the line before them.
+#
+#   python3 -m armm.logquery /home/nvidia/bt-11/BT-log --since '2023-11-16 01:50' --event coldboot
+#
+INDEX_VERSION = 1
+INDEX_EVERY = 256           # lines between index entries
+HEAD_BYTES = 4096           # first bytes checked to recognize the indexed file
+
+TIME_STAMP = re.compile(rb'^(?:BT\d\d [A-Z]+: )?(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)(?:[.,](\d{1,6}))?')
+
+# event type -> pattern of the log line
+EVENTS = {
+    'coldboot': r'(?i:cold ?boot)',
+    'rxtimeout': r'Rx timeout',
+    'checksum': r'check ?sum is not correct|checksum errors [1-9]',
+    'state': r'state = S[T]?ATE_|Start Shift ',
+    'restart': r'Program \(re-\)started',
+    'heartbeat': r'Nothing received from BT-\d\d after HEARTBEAT|Not received HEARTBEAT',
+    'wan': r'network health : WAN|ping does not reach',
+    'error': r' : (?:ERROR|CRITICAL) : ',
+}
+EVENT_NAMES = sorted(EVENTS)
+EVENT_PATTERNS = [re.compile(EVENTS[name].encode()) for name in EVENT_NAMES]
+
+
+# event names -> bit mask of the index entries
+def event_mask(events):
+    mask = 0
+    for event in events:
+        mask |= 1 << EVENT_NAMES.index(event)
+    return mask
+
+
+# bit mask of the events in a log line (bytes)
+def line_events(line):
+    mask = 0
+    for bit, pattern in enumerate(EVENT_PATTERNS):
+        if pattern.search(line):
+            mask |= 1 << bit
+    return mask
+
+
+# time stamp of a log line (bytes) -> seconds since epoch (local time), None : no time stamp
+def line_time(line):
+    match = TIME_STAMP.match(line)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction = match.groups()
+    try:
+        at = datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+    except ValueError:
+        return None
+    seconds = at.timestamp()
+    if fraction:
+        seconds += int(fraction) / 10.0 ** len(fraction)
+    return seconds
+
+
+def open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise OSError('zstandard module not installed : ' + path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+
+def head_crc(path):
+    with open_log(path) as f:
+        return zlib.crc32(f.read(HEAD_BYTES))
+
+
+#
+# sparse index of one file
+#   entries : [time, offset, line number, event mask] every INDEX_EVERY lines (lines with a
+#             time stamp), event mask of the lines up to the next entry
+#
+class LogIndex(object):
+    def __init__(self, path):
+        self.path = path
+        self.inode = None
+        self.size = 0               # file size indexed (compressed size for .gz / .zst)
+        self.head = None            # crc32 of the first HEAD_BYTES (uncompressed)
+        self.entries = []
+        self.offset = 0             # uncompressed bytes indexed (end of the last full line)
+        self.lines = 0
+        self.first = None           # first & last time stamp
+        self.last = None
+        self.head_mask = 0          # events of the lines before the first entry
+        self.built = 0              # lines parsed by the last update
+
+    #
+    # load the index & bring it up to date, return self
+    #
+    def update(self):
+        stat = os.stat(self.path)
+        head = head_crc(self.path)
+        self._load()
+        if self.inode != stat.st_ino or self.head != head or stat.st_size < self.size or \
+                (self.compressed() and stat.st_size != self.size):
+            # other file (rotated, replaced, truncated) : start again
+            self.entries = []
+            self.offset = self.lines = 0
+            self.first = self.last = None
+            self.head_mask = 0
+        self.inode = stat.st_ino
+        self.head = head
+        if stat.st_size != self.size or not self.entries:
+            self._extend()
+            self.size = stat.st_size
+            self._save()
+        return self
+
+    def compressed(self):
+        return self.path.endswith(('.gz', '.zst'))
+
+    # offset to start reading for lines at or after `since` (seconds), 0 : from the start
+    def seek_offset(self, since):
+        if since is None or not self.entries:
+            return 0
+        times = [entry[0] for entry in self.entries]
+        # entry before since : lines between two entries may have older time stamps
+        position = bisect.bisect_left(times, since) - 1
+        if position < 0:
+            return 0
+        return self.entries[position][1]
+
+    #
+    # blocks to read : list of (offset, end offset or None, line number at offset)
+    #   since : seconds or None, mask : events wanted (0 : every line)
+    #
+    def blocks(self, since=None, mask=0):
+        start = self.seek_offset(since)
+        if not mask:
+            number = 0
+            for entry in self.entries:
+                if entry[1] == start:
+                    number = entry[2]
+            return [(start, None, number)]
+        found = []
+        if self.head_mask & mask and start == 0:
+            found.append((0, self.entries[0][1] if self.entries else None, 0))
+        for position, entry in enumerate(self.entries):
+            if entry[1] < start or not entry[3] & mask:
+                continue
+            end = self.entries[position + 1][1] if position + 1 < len(self.entries) else self.offset
+            if found and found[-1][1] == entry[1]:
+                found[-1] = (found[-1][0], end, found[-1][2])       # next block : one read
+            else:
+                found.append((entry[1], end, entry[2]))
+        return found
+
+    def _extend(self):
+        self.built = 0
+        with open_log(self.path) as f:
+            skip(f, self.offset)
+            offset = self.offset
+            pending = self.lines % INDEX_EVERY == 0     # next line with a time stamp is indexed
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break                               # line being written : next update
+                at = line_time(line)
+                if at is not None:
+                    if self.first is None:
+                        self.first = at
+                    self.last = at
+                    if pending:
+                        self.entries.append([at, offset, self.lines, 0])
+                        pending = False
+                events = line_events(line)
+                if events:
+                    if self.entries:
+                        self.entries[-1][3] |= events
+                    else:
+                        self.head_mask |= events
+                self.lines += 1
+                self.built += 1
+                if self.lines % INDEX_EVERY == 0:
+                    pending = True
+                offset += len(line)
+            self.offset = offset
+
+    def _load(self):
+        try:
+            with open(index_path(self.path)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != INDEX_VERSION or data.get('every') != INDEX_EVERY or \
+                data.get('events') != EVENT_NAMES:
+            return
+        self.inode = data['inode']
+        self.size = data['size']
+        self.head = data['head']
+        self.entries = data['entries']
+        self.offset = data['offset']
+        self.lines = data['lines']
+        self.first = data['first']
+        self.last = data['last']
+        self.head_mask = data['head_mask']
+
+    def _save(self):
+        data = {
+            'version': INDEX_VERSION,
+            'every': INDEX_EVERY,
+            'events': EVENT_NAMES,
+            'inode': self.inode,
+            'size': self.size,
+            'head': self.head,
+            'offset': self.offset,
+            'lines': self.lines,
+            'first': self.first,
+            'last': self.last,
+            'head_mask': self.head_mask,
+            'entries': self.entries,
+        }
+        tmp = index_path(self.path) + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp, index_path(self.path))
+        except OSError:
+            pass            # read only directory : the index is built again next time
+
+
+# go forward from position to offset of f (seek if possible, else read & drop)
+def skip(f, offset, position=0):
+    if offset <= position:
+        return
+    try:
+        f.seek(offset)
+        return
+    except (OSError, ValueError):
+        pass
+    left = offset - position
+    while left > 0:
+        data = f.read(min(left, 1 << 20))
+        if not data:
+            return
+        left -= len(data)
+
+
+# generations of logname, oldest first, the live file last
+def log_files(logname):
+    files = [path for _, path in sorted(generations(logname), reverse=True)]
+    if os.path.exists(logname):
+        files.append(os.path.abspath(logname))
+    return files
+
+
+# remove the index files of generations which no longer exist
+def prune_indexes(logname):
+    directory, base = os.path.split(os.path.abspath(logname))
+    for name in os.listdir(directory):
+        if name.startswith('.' + base) and name.endswith('.idx'):
+            if not os.path.exists(os.path.join(directory, name[1:-4])):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    pass
+
+
+#
+# lines of the generations of logname in [since, until) of the event types & matching pattern
+# yield (path, line number, line (str))
+#   since, until : seconds since epoch or None
+#   events : event names (EVENTS), a line of any of them is printed, empty : every line
+#   pattern : compiled regular expression (str) or None
+#
+def query(logname, since=None, until=None, events=(), pattern=None, stats=None):
+    prune_indexes(logname)
+    mask = event_mask(events)
+    wanted = [EVENT_PATTERNS[EVENT_NAMES.index(event)] for event in events]
+    for path in log_files(logname):
+        index = LogIndex(path).update()
+        if stats is not None:
+            stats['files'] += 1
+            stats['indexed_lines'] += index.built
+        if index.first is None:
+            continue
+        if (since is not None and index.last < since) or (until is not None and index.first >= until):
+            continue
+        with open_log(path) as f:
+            position = 0
+            for offset, end, number in index.blocks(since, mask):
+                if offset < position:
+                    raise OSError('index of {0} does not match the file'.format(path))
+                skip(f, offset, position)
+                position = offset
+                at = None
+                for raw in f:
+                    position += len(raw)
+                    number += 1
+                    if stats is not None:
+                        stats['read_lines'] += 1
+                    stamp = line_time(raw)
+                    if stamp is not None:
+                        at = stamp
+                    if until is not None and at is not None and at >= until:
+                        return
+                    if not (at is None or (since is not None and at < since)) and \
+                            (not wanted or any(p.search(raw) for p in wanted)):
+                        line = raw.decode('utf-8', 'replace').rstrip('\n')
+                        if pattern is None or pattern.search(line):
+                            yield path, number, line
+                    if end is not None and position >= end:
+                        break
+
+
+# 'YYYY-mm-dd HH:MM[:SS]', 'HH:MM' (today) or '2h' / '30m' / '1d' (ago) -> seconds since epoch
+def parse_when(text, now=None):
+    now = now if now is not None else datetime.datetime.now()
+    match = re.match(r'^(\d+)([smhd])$', text)
+    if match:
+        seconds = int(match.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+        return (now - datetime.timedelta(seconds=seconds)).timestamp()
+    for form in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(text, form).timestamp()
+        except ValueError:
+            pass
+    for form in ('%H:%M:%S', '%H:%M'):
+        try:
+            at = datetime.datetime.strptime(text, form)
+            return now.replace(hour=at.hour, minute=at.minute, second=at.second, microsecond=0).timestamp()
+        except ValueError:
+            pass
+    raise ValueError('bad time : ' + text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='query the BT log generations by time & event type')
+    parser.add_argument('logname', help='live log file (e.g. /home/nvidia/bt-11/BT-log)')
+    parser.add_argument('--since', help="start time : 'YYYY-mm-dd HH:MM[:SS]', 'HH:MM' or '2h' ago")
+    parser.add_argument('--until', help='end time (not included), same formats')
+    parser.add_argument('--event', action='append', choices=sorted(EVENTS),
+                        help='event type (repeatable)')
+    parser.add_argument('--grep', help='regular expression')
+    parser.add_argument('--files', action='store_true', help='print file name & line number')
+    parser.add_argument('--stats', action='store_true', help='print lines indexed & read')
+    args = parser.parse_args()
+
+    try:
+        since = parse_when(args.since) if args.since else None
+        until = parse_when(args.until) if args.until else None
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        pattern = re.compile(args.grep) if args.grep else None
+    except re.error as e:
+        parser.error('--grep : ' + str(e))
+
+    stats = {'files': 0, 'indexed_lines': 0, 'read_lines': 0}
+    try:
+        for path, number, line in query(args.logname, since, until, args.event or (), pattern, stats):
+            if args.files:
+                print('{0}:{1}: {2}'.format(os.path.basename(path), number, line))
+            else:
+                print(line)
+    except BrokenPipeError:
+        sys.stderr.close()
+        return 0
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if args.stats:
+        print('{files} files, {indexed_lines} lines indexed, {read_lines} lines read'.format(**stats),
+              file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
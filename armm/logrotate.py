@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import gzip
+import time
+import shutil
+import logging
+import threading
+
+try:
+    import zstandard        # optional : python3 -m pip install zstandard
+except ImportError:
+    zstandard = None
+
+#
+# Rename based BT log rotation with background compression
+#
+# shiftlogfile() copied the whole live BT-log into BT-log.1 and truncated it : the day's
+# log was written twice, and lines written between the copy and the truncate were lost.
+# LogRotator.rotate() only renames : BT-log.N -> BT-log.N+1 (oldest removed), then the live
+# BT-log -> BT-log.1, and the log writer opens a new BT-log (LogWriter.rotate).  The rotated
+# files are then compressed by a background thread, streaming in blocks (gzip, or zstd if
+# the zstandard module is installed) : BT-log.1 -> BT-log.1.gz (.zst), and the total size of
+# the generations is kept under max_bytes by removing the oldest ones.
+#
+# Generations : logname.N, logname.N.gz, logname.N.zst (N = 1 .. keep)
+#
+# The sparse index of a file (armm.logquery, .<file name>.idx) is renamed and removed with
+# its file, so the indexes of the renamed generations stay valid (same inode & contents).
+# The index of a compressed file is removed : the compressed generation is indexed again.
+#
+KEEP = 7                    # generations BT-log.1 .. BT-log.7
+MAX_BYTES = None            # total bytes of the generations (None : no limit)
+COMPRESSION = 'auto'        # 'zstd' if available else 'gzip', None : no compression
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+BLOCK = 1 << 20             # streaming block size
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+# compression used for 'auto' / given name
+def compression_method(name=COMPRESSION):
+    if name == 'auto':
+        return 'zstd' if zstandard is not None else 'gzip'
+    if name == 'zstd' and zstandard is None:
+        logging.warning('zstandard module not installed, rotated logs are compressed with gzip')
+        return 'gzip'
+    return name
+
+
+# existing generations of logname : list of (N, path), N ascending
+def generations(logname):
+    directory, base = os.path.split(os.path.abspath(logname))
+    pattern = re.compile(re.escape(base) + r'\.(\d+)(\.gz|\.zst)?$')
+    found = []
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(directory, name)))
+    found.sort()
+    return found
+
+
+# sparse index of a log file (armm.logquery)
+def index_path(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, '.' + name + '.idx')
+
+
+# rename path & its index
+def rename_log(path, target):
+    os.rename(path, target)
+    try:
+        os.rename(index_path(path), index_path(target))
+    except FileNotFoundError:
+        pass
+
+
+# remove path & its index
+def remove_log(path):
+    os.remove(path)
+    try:
+        os.remove(index_path(path))
+    except FileNotFoundError:
+        pass
+
+
+# path of generation N with the suffix (compression) of path
+def renumber(logname, path, number):
+    suffix = ''
+    for ext in SUFFIXES.values():
+        if path.endswith(ext):
+            suffix = ext
+    return os.path.abspath(logname) + '.' + str(number) + suffix
+
+
+# compress path to path + suffix block by block, return compressed size
+def compress_file(path, method):
+    target = path + SUFFIXES[method]
+    tmp = target + '.tmp'
+    with open(path, 'rb') as src, open(tmp, 'wb') as raw:
+        if method == 'zstd':
+            zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(src, raw, read_size=BLOCK, write_size=BLOCK)
+        else:
+            with gzip.GzipFile(filename=os.path.basename(path), mode='wb', compresslevel=GZIP_LEVEL,
+                               fileobj=raw) as dst:
+                shutil.copyfileobj(src, dst, BLOCK)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp, target)
+    remove_log(path)
+    return os.path.getsize(target)
+
+
+# temporary files of a compression stopped by a power off
+def glob_leftovers(logname):
+    directory, base = os.path.split(os.path.abspath(logname))
+    return [os.path.join(directory, name) for name in os.listdir(directory)
+            if name.startswith(base + '.') and name.endswith('.tmp')]
+
+
+class LogRotator(object):
+    def __init__(self, logname, keep=KEEP, max_bytes=MAX_BYTES, compression=COMPRESSION):
+        self.logname = logname
+        self.keep = keep
+        self.max_bytes = max_bytes
+        self.method = compression_method(compression) if compression else None
+        self.thread = None
+        # statistics of the last rotation
+        self.rotated = 0                # rotations
+        self.raw_bytes = 0              # compressed generations : size before
+        self.compressed_bytes = 0       #                          size after
+        self.removed = 0                # generations removed by retention
+
+    #
+    # rotate by renames (called with the log file not written, see LogWriter.rotate)
+    #   logname : live log file (default : self.logname)
+    #
+    def rotate(self, logname=None):
+        logname = logname if logname is not None else self.logname
+        # the previous compression must not see its file renamed
+        self.join()
+        for number, path in reversed(generations(logname)):
+            if number >= self.keep:
+                remove_log(path)
+            else:
+                rename_log(path, renumber(logname, path, number + 1))
+        if os.path.exists(logname):
+            rename_log(logname, logname + '.1')
+        self.rotated += 1
+        self.thread = threading.Thread(target=self._background, args=(logname,), name='logrotate')
+        self.thread.daemon = True
+        self.thread.start()
+
+    # wait for the background compression
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+            if not self.thread.is_alive():
+                self.thread = None
+
+    #
+    # background : compress every uncompressed generation (also ones left by a power off)
+    # and remove the oldest generations over max_bytes
+    #
+    def _background(self, logname):
+        started = time.monotonic()
+        raw = packed = 0
+        try:
+            for path in glob_leftovers(logname):
+                os.remove(path)
+            if self.method is not None:
+                for _, path in generations(logname):
+                    if path.endswith(tuple(SUFFIXES.values())):
+                        continue
+                    size = os.path.getsize(path)
+                    packed += compress_file(path, self.method)
+                    raw += size
+            removed = self._retention(logname)
+        except OSError as e:
+            logging.error('log rotation : ' + str(e))
+            return
+        self.raw_bytes = raw
+        self.compressed_bytes = packed
+        self.removed = removed
+        logging.info('log rotation : {0} {1} bytes -> {2} bytes in {3:.1f} sec., {4} generations removed'.format(
+            self.method or 'no compression', raw, packed, time.monotonic() - started, removed))
+
+    # remove the oldest generations (not .1) while the total is over max_bytes
+    def _retention(self, logname):
+        if self.max_bytes is None:
+            return 0
+        found = [(number, path, os.path.getsize(path)) for number, path in generations(logname)]
+        total = sum(size for _, _, size in found)
+        removed = 0
+        while total > self.max_bytes and len(found) > 1:
+            _, path, size = found.pop()
+            remove_log(path)
+            total -= size
+            removed += 1
+        return removed
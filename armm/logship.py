@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import json
+import zlib
+import tarfile
+import argparse
+import collections
+import http.client
+import urllib.parse
+
+from armm.logquery import open_log, skip, log_files
+
+#
+# Incremental BT log shipping
+#
+# send_bt-logs.sh archived every BT-log generation on every run, so each mail repeated the
+# whole week of logs.  In the incremental mode only the bytes appended since the last sent
+# mail are archived :
+#   - a checkpoint file (.<log name>.sendlog.json) keeps, for every generation sent, its
+#     inode & size, the crc32 of its first bytes and the offset (uncompressed bytes) sent
+#   - a generation is recognized by the crc of its first bytes, so BT-log sent up to
+#     offset N is still known after it was renamed to BT-log.1 and compressed to
+#     BT-log.1.gz (new inode) : only the bytes after N are sent.  A compressed generation
+#     sent completely is recognized by inode & size without decompressing it
+#   - the live BT-log is sent up to its last complete line
+#   - the parts are written as a tar.gz stream (one member per generation, the offset of
+#     the part in the pax header ARMM.offset), read in blocks, directly into the mail
+#     (armm.mailer) : nothing is loaded into memory or written to a temporary file
+#   - the checkpoint is saved only after the server accepted the mail
+#
+# The same delta can be pushed to the fleet log collector (armm.collector) over HTTP
+# instead of mail, streamed with chunked transfer encoding, with its own checkpoint
+# (.<log name>.post.json) :
+#
+#   python3 -m armm.logship --post http://collector:8080 --bt-id-file bt_id.txt BT-log
+#
+HEAD_BYTES = 4096           # first bytes identifying a generation
+BLOCK = 1 << 20
+CHUNK = 65536               # HTTP chunk size
+POST_TIMEOUT = 60.0         # [sec]
+
+Part = collections.namedtuple('Part', 'path name start end inode size head_len head_crc')
+
+
+def checkpoint_path(logname, kind='sendlog'):
+    directory, name = os.path.split(os.path.abspath(logname))
+    return os.path.join(directory, '.' + name + '.' + kind + '.json')
+
+
+# crc32 of the first length bytes (uncompressed) of path
+def head_crc(path, length):
+    with open_log(path) as f:
+        return zlib.crc32(f.read(length))
+
+
+# name of the generation without the compression suffix (BT-log.1.gz -> BT-log.1)
+def plain_name(path):
+    name = os.path.basename(path)
+    for suffix in ('.gz', '.zst'):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def compressed(path):
+    return path.endswith(('.gz', '.zst'))
+
+
+# uncompressed size of a compressed generation (decompressed in blocks)
+def uncompressed_size(path):
+    size = 0
+    with open_log(path) as f:
+        while True:
+            data = f.read(BLOCK)
+            if not data:
+                return size
+            size += len(data)
+
+
+# end of the last complete line of the live log (offset after its '\n')
+def complete_end(path, size):
+    with open(path, 'rb') as f:
+        end = size
+        while end > 0:
+            start = max(0, end - 65536)
+            f.seek(start)
+            data = f.read(end - start)
+            found = data.rfind(b'\n')
+            if found >= 0:
+                return start + found + 1
+            end = start
+    return 0
+
+
+class Checkpoint(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = []           # dict per generation sent
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                self.entries = json.load(f).get('files', [])
+        except (OSError, ValueError):
+            self.entries = []
+        return self
+
+    # offset already sent of path (0 : not sent)
+    def sent(self, path, stat):
+        for entry in self.entries:
+            if entry['inode'] == stat.st_ino and entry['size'] == stat.st_size and \
+                    (entry['complete'] or not compressed(path)):
+                return entry['offset'], entry
+        for entry in self.entries:
+            if entry['head_len'] and head_crc(path, entry['head_len']) == entry['head_crc']:
+                return entry['offset'], entry
+        return 0, None
+
+    # parts sent -> new checkpoint
+    def save(self, parts):
+        self.entries = [{
+            'name': part.name,
+            'inode': part.inode,
+            'size': part.size,
+            'offset': part.end,
+            'complete': compressed(part.path),
+            'head_len': part.head_len,
+            'head_crc': part.head_crc,
+        } for part in parts]
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'files': self.entries}, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.filename)
+
+
+#
+# parts of the generations of logname not sent yet, oldest first
+# (also the parts without new bytes : they are the next checkpoint)
+#
+def collect(logname, checkpoint):
+    parts = []
+    for path in log_files(logname):
+        stat = os.stat(path)
+        start, entry = checkpoint.sent(path, stat)
+        if entry is not None and entry['complete'] and entry['inode'] == stat.st_ino and \
+                entry['size'] == stat.st_size:
+            parts.append(Part(path, plain_name(path), start, start, stat.st_ino, stat.st_size,
+                              entry['head_len'], entry['head_crc']))
+            continue
+        end = uncompressed_size(path) if compressed(path) else complete_end(path, stat.st_size)
+        if start > end:
+            start = 0           # not the file sent before
+        head_len = min(HEAD_BYTES, end)
+        parts.append(Part(path, plain_name(path), start, end, stat.st_ino, stat.st_size,
+                          head_len, head_crc(path, head_len)))
+    return parts
+
+
+def new_bytes(parts):
+    return sum(part.end - part.start for part in parts)
+
+
+#
+# write the new bytes of parts as a tar.gz stream into fileobj (only written, never seeked)
+#
+def write_archive(parts, fileobj):
+    with tarfile.open(fileobj=fileobj, mode='w|gz', format=tarfile.PAX_FORMAT) as tar:
+        for part in parts:
+            if part.end <= part.start:
+                continue
+            info = tarfile.TarInfo(part.name)
+            info.size = part.end - part.start
+            info.mtime = os.path.getmtime(part.path)
+            info.mode = 0o644
+            info.pax_headers = {'ARMM.offset': str(part.start)}
+            with open_log(part.path) as f:
+                skip(f, part.start)
+                tar.addfile(info, f)
+
+
+# one line per part for the mail text
+def describe(parts):
+    return ['{0} : bytes {1} .. {2} ({3} new)'.format(part.name, part.start, part.end, part.end - part.start)
+            for part in parts if part.end > part.start]
+
+
+# bt_id.txt : 'bt_id = "..."' or free text
+def read_bt_id(filename):
+    with open(filename, encoding='utf-8') as f:
+        text = f.read().strip()
+    match = re.match(r'^bt_id\s*=\s*"([^"]*)"', text)
+    return match.group(1) if match else text
+
+
+#
+# file like object : bytes written -> HTTP chunks of at least CHUNK bytes
+#
+class ChunkedWriter(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(bytes(data))
+        self.buffered += len(data)
+        if self.buffered >= CHUNK:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffered:
+            data = b''.join(self.buffer)
+            self.connection.send(b'%x\r\n' % len(data) + data + b'\r\n')
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.connection.send(b'0\r\n\r\n')
+
+
+#
+# POST the new bytes of parts to the collector : return the reply (dict)
+#
+def post_archive(url, bt_id, parts, timeout=POST_TIMEOUT):
+    split = urllib.parse.urlsplit(url)
+    if split.scheme == 'https':
+        connection = http.client.HTTPSConnection(split.hostname, split.port or 443, timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection(split.hostname, split.port or 80, timeout=timeout)
+    try:
+        connection.putrequest('POST', split.path.rstrip('/') + '/logs/' + urllib.parse.quote(bt_id, safe=''))
+        connection.putheader('Content-Type', 'application/gzip')
+        connection.putheader('Transfer-Encoding', 'chunked')
+        connection.endheaders()
+        writer = ChunkedWriter(connection)
+        write_archive(parts, writer)
+        writer.close()
+        response = connection.getresponse()
+        body = response.read()
+        if response.status != 202:
+            raise OSError('collector : {0} {1} {2}'.format(response.status, response.reason,
+                                                           body.decode('utf-8', 'replace')))
+        return json.loads(body.decode('utf-8'))
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='push the BT log added since the last push to the collector')
+    parser.add_argument('logname', help='live log file (e.g. /home/nvidia/bt-11/BT-log)')
+    parser.add_argument('--post', required=True, help='collector URL (e.g. http://collector:8080)')
+    parser.add_argument('--bt-id-file', default='bt_id.txt')
+    parser.add_argument('--checkpoint', help='checkpoint file (default .BT-log.post.json)')
+    args = parser.parse_args()
+
+    try:
+        bt_id = read_bt_id(args.bt_id_file)
+        checkpoint = Checkpoint(args.checkpoint or checkpoint_path(args.logname, 'post')).load()
+        parts = collect(args.logname, checkpoint)
+        if new_bytes(parts) == 0:
+            print('no new log since the last push')
+            return 0
+        reply = post_archive(args.post, bt_id, parts)
+        # only after the collector stored the delta
+        checkpoint.save(parts)
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        print('[ERROR] {0}'.format(e), file=sys.stderr)
+        return 1
+    print('pushed {0} new bytes, delta {1}'.format(new_bytes(parts), reply.get('delta')))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
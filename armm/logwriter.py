@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import atexit
+import logging
+import datetime
+import threading
+import collections
+
+#
+# Queue backed BT log writer
+#
+# writelog() opened BT-log, wrote one line and closed it for every call (recv / send call it
+# twice per frame), and logging wrote to the same file through its own handle.  LogWriter
+# is the only writer of the file :
+#   - producers (writelog, the logging handler, log record sinks) append a record to a
+#     queue and return; nothing is formatted or written on their thread
+#   - the writer thread wakes up every flush_interval (or at once for errors, a full batch,
+#     flush() and rotate()), formats the queued records and writes them with one write()
+#   - fsync policy : fsync_interval None : never, 0 : after every batch, N : at most every
+#     N sec.
+#   - one file handle, opened in append mode (a truncated file is written from its start);
+#     rotate(func) runs func with the queue written and nothing else writing, and opens the
+#     file again if func renamed or removed it
+#
+FLUSH_INTERVAL = 1.0        # [sec] queued records are written at least this often
+FSYNC_INTERVAL = None       # [sec] None : no fsync (page cache), 0 : every batch
+MAX_BATCH = 512             # records : wake up the writer at once
+BUFFERING = 65536
+
+
+class LogWriter(object):
+    def __init__(self, filename, flush_interval=FLUSH_INTERVAL, fsync_interval=FSYNC_INTERVAL,
+                 max_batch=MAX_BATCH):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.max_batch = max_batch
+        self.queue = collections.deque()    # records, appended by any thread
+        self.wakeup = threading.Event()
+        self.lock = threading.RLock()       # file handle (writer thread / rotate)
+        self.f = None
+        self.thread = None
+        self.running = False
+        self.last_fsync = time.monotonic()
+        # statistics
+        self.batches = 0
+        self.lines = 0
+        self.bytes = 0
+        self.fsyncs = 0
+        self.reopens = 0
+        self.errors = 0
+
+    # open the file & start the writer thread
+    def start(self):
+        with self.lock:
+            if self.f is None:
+                self.f = open(self.filename, 'a', buffering=BUFFERING)
+        if self.thread is None:
+            self.running = True
+            self.thread = threading.Thread(target=self._run, name='logwriter')
+            self.thread.daemon = True
+            self.thread.start()
+            atexit.register(self.close)
+        return self
+
+    #
+    # producers (any thread)
+    #
+    # writelog line : prefix + time stamp + text
+    def write(self, prefix, text):
+        self._put((time.time(), prefix, text))
+
+    # line written as it is
+    def line(self, text):
+        self._put((None, None, text))
+
+    # logging.LogRecord, formatted by formatter on the writer thread
+    def record(self, record, formatter, urgent=False):
+        self._put((record, formatter, None), urgent)
+
+    def _put(self, entry, urgent=False):
+        self.queue.append(entry)
+        if urgent or len(self.queue) >= self.max_batch:
+            self.wakeup.set()
+
+    # wait until everything queued so far is in the file (timeout [sec])
+    def flush(self, timeout=5.0):
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                self._drain()
+            return True
+        # marker in the queue, set by the writer after the batch containing it
+        written = threading.Event()
+        self._put((written, None, None), True)
+        return written.wait(timeout)
+
+    #
+    # run func(filename) with every queued record written and the file not written meanwhile,
+    # the file is opened again if func moved it away
+    #
+    def rotate(self, func):
+        with self.lock:
+            self._drain()
+            try:
+                return func(self.filename)
+            finally:
+                self._reopen_if_moved()
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(5.0)
+        with self.lock:
+            self._drain()
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+    # logging handler writing through this writer
+    def handler(self, level=logging.NOTSET):
+        return LogWriterHandler(self, level)
+
+    # log record sink (armm.logpull) writing through this writer
+    #   line : function frame -> log line (without '\n')
+    def sink(self, line):
+        return WriterSink(self, line)
+
+    # statistics for the log
+    def __str__(self):
+        return ('{0} lines, {1} bytes in {2} writes ({3:.1f} lines/write), {4} fsyncs, '
+                '{5} reopens, {6} errors, {7} queued').format(
+            self.lines, self.bytes, self.batches, self.lines / self.batches if self.batches else 0.0,
+            self.fsyncs, self.reopens, self.errors, len(self.queue))
+
+    #
+    # writer thread
+    #
+    def _run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            with self.lock:
+                self._drain()
+
+    # write all queued records (lock held)
+    def _drain(self):
+        entries = []
+        markers = []
+        while self.queue:
+            entry = self.queue.popleft()
+            if isinstance(entry[0], threading.Event):
+                markers.append(entry[0])
+            else:
+                entries.append(entry)
+        if entries:
+            text = ''.join(self._format(entry) for entry in entries)
+            try:
+                if self.f is None:
+                    self.f = open(self.filename, 'a', buffering=BUFFERING)
+                self.f.write(text)
+                self.f.flush()
+                self.batches += 1
+                self.lines += len(entries)
+                self.bytes += len(text)
+                self._fsync()
+            except (OSError, ValueError):
+                # disk full, file closed ... : the records are lost, the program goes on
+                self.errors += 1
+        for marker in markers:
+            marker.set()
+
+    def _format(self, entry):
+        first, second, text = entry
+        if isinstance(first, logging.LogRecord):
+            try:
+                return second.format(first) + '\n'
+            except Exception:
+                return 'unformattable log record : ' + repr(first.msg) + '\n'
+        if first is None:
+            return text + '\n'
+        return second + str(datetime.datetime.fromtimestamp(first)) + text + '\n'
+
+    def _fsync(self):
+        if self.fsync_interval is None:
+            return
+        now = time.monotonic()
+        if now - self.last_fsync >= self.fsync_interval:
+            os.fsync(self.f.fileno())
+            self.fsyncs += 1
+            self.last_fsync = now
+
+    # file renamed / removed by rotation -> open filename again
+    def _reopen_if_moved(self):
+        if self.f is None:
+            return
+        try:
+            moved = os.stat(self.filename).st_ino != os.fstat(self.f.fileno()).st_ino
+        except FileNotFoundError:
+            moved = True
+        if moved:
+            self.f.close()
+            self.f = open(self.filename, 'a', buffering=BUFFERING)
+            self.reopens += 1
+
+
+class LogWriterHandler(logging.Handler):
+    def __init__(self, writer, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.writer = writer
+
+    def emit(self, record):
+        # the message is fixed now, args may change before the writer formats it
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.writer.record(record, self.formatter or logging.Formatter(), record.levelno >= logging.ERROR)
+
+
+class WriterSink(object):
+    def __init__(self, writer, line):
+        self.writer = writer
+        self.line = line
+
+    def write(self, frame):
+        self.writer.line(self.line(frame))
+
+    def close(self):
+        pass
@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import uuid
+import base64
+import random
+import smtplib
+import argparse
+import collections
+from email.header import Header
+from email.utils import formatdate, make_msgid
+
+#
+# Streaming MIME message & SMTP DATA
+#
+# sendlog.py built the message with email.mime : the whole archive was read with f.read(),
+# base64 encoded in memory and the message flattened again before it was sent.  Here the
+# message is written line by line directly into the SMTP DATA command : attachments are
+# read (or produced, e.g. by tarfile) in blocks and base64 encoded block by block, so the
+# memory used does not depend on the size of the attachments.
+#
+# An error while the message is written (file not readable ...) closes the connection
+# without the final '.', so the server drops the partial message.
+#
+# BatchSender sends many messages (e.g. the logs of several Edge AI Boxes collected by a
+# relay box) through one connection, STARTTLS and login done once :
+#   - with the PIPELINING extension (RFC 2920) MAIL, RCPT and DATA of a message are sent
+#     in one group, together with the end of the previous message, and the replies are
+#     read after : one round trip per message instead of four.  Without PIPELINING every
+#     command waits for the reply of the previous one (RFC 5321)
+#   - transient failures (4xx replies, connection lost / refused) are retried with
+#     exponential back-off (connection opened again), permanent ones (5xx) are not
+#   - a message whose end of data reply was lost is sent again (delivered at least once)
+#
+#   python3 -m armm.mailer --from a@example.com --password xxxx --to b@example.com \
+#       bt-01=bt-01/bt_log.tar.gz bt-11=bt-11/bt_log.tar.gz
+#
+SMTP_HOST = 'smtp.gmail.com'
+SMTP_PORT = 587
+SMTP_TIMEOUT = 60.0         # [sec] socket timeout
+LINE_BYTES = 57             # bytes of one base64 line (76 characters)
+BLOCK = LINE_BYTES * 1024   # attachment read size
+SEND_BUFFER = 65536         # bytes sent to the socket at once
+RETRIES = 5                 # attempts of a message after a transient failure
+BACKOFF = 1.0               # [sec] first retry delay, doubled every retry
+MAX_BACKOFF = 60.0          # [sec]
+
+
+#
+# lines of the DATA command : CRLF, '.' doubled at the start of a line, sent in blocks
+#
+class DataWriter(object):
+    def __init__(self, send):
+        self.send = send
+        self.buffer = []
+        self.buffered = 0
+        self.bytes = 0
+
+    def line(self, data):
+        if isinstance(data, str):
+            data = data.encode('ascii')
+        if data.startswith(b'.'):
+            data = b'.' + data
+        self.buffer.append(data + b'\r\n')
+        self.buffered += len(data) + 2
+        if self.buffered >= SEND_BUFFER:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            data = b''.join(self.buffer)
+            self.buffer = []
+            self.buffered = 0
+            self.send(data)
+            self.bytes += len(data)
+
+    # end of the message
+    def end(self):
+        self.buffer.append(b'.\r\n')
+        self.flush()
+
+
+#
+# file like object : bytes written -> base64 lines
+# (tarfile or shutil can write an attachment into it)
+#
+class Base64Lines(object):
+    def __init__(self, line):
+        self.line = line
+        self.rest = b''
+        self.bytes = 0          # bytes before encoding
+
+    def write(self, data):
+        length = len(data)
+        self.bytes += length
+        data = self.rest + bytes(data)
+        whole = len(data) - len(data) % LINE_BYTES
+        encoded = base64.b64encode(data[:whole])
+        for start in range(0, len(encoded), 76):
+            self.line(encoded[start:start + 76])
+        self.rest = data[whole:]
+        return length
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.rest:
+            self.line(base64.b64encode(self.rest))
+            self.rest = b''
+
+
+#
+# attachment of a message
+#   source : bytes, file name (opened when written, so a message can be sent again),
+#            file object (read in blocks), or function(fileobj) writing the content
+#
+class Attachment(object):
+    def __init__(self, filename, source, content_type='application/octet-stream'):
+        self.filename = filename
+        self.source = source
+        self.content_type = content_type
+        self.bytes = 0
+
+    def write(self, line):
+        encoder = Base64Lines(line)
+        if isinstance(self.source, (bytes, bytearray)):
+            encoder.write(self.source)
+        elif isinstance(self.source, str):
+            with open(self.source, 'rb') as f:
+                copy_blocks(f, encoder)
+        elif callable(self.source):
+            self.source(encoder)
+        else:
+            copy_blocks(self.source, encoder)
+        encoder.close()
+        self.bytes = encoder.bytes
+
+
+def copy_blocks(src, dst):
+    while True:
+        data = src.read(BLOCK)
+        if not data:
+            return
+        dst.write(data)
+
+
+def header(value):
+    try:
+        value.encode('ascii')
+        return value
+    except UnicodeEncodeError:
+        return Header(value, 'utf-8').encode()
+
+
+#
+# write a multipart/mixed message : line(bytes / str) for every line (without CRLF)
+#
+def write_message(line, from_addr, to_addrs, subject, text, attachments=()):
+    boundary = '=====' + uuid.uuid4().hex
+    line('From: ' + header(from_addr))
+    line('To: ' + ', '.join(header(to) for to in to_addrs))
+    line('Subject: ' + header(subject))
+    line('Date: ' + formatdate(localtime=True))
+    line('Message-ID: ' + make_msgid())
+    line('MIME-Version: 1.0')
+    line('Content-Type: multipart/mixed; boundary="' + boundary + '"')
+    line('')
+    line('--' + boundary)
+    line('Content-Type: text/plain; charset="utf-8"')
+    line('Content-Transfer-Encoding: base64')
+    line('')
+    Attachment('', text.encode('utf-8')).write(line)
+    for attachment in attachments:
+        line('--' + boundary)
+        line('Content-Type: ' + attachment.content_type)
+        line('Content-Transfer-Encoding: base64')
+        line('Content-Disposition: attachment; filename="' + os.path.basename(attachment.filename) + '"')
+        line('')
+        attachment.write(line)
+    line('--' + boundary + '--')
+
+
+#
+# SMTP connection : STARTTLS and login when the server offers them
+#   password None : no login (local test server)
+#
+def connect(host=SMTP_HOST, port=SMTP_PORT, username=None, password=None, timeout=SMTP_TIMEOUT):
+    server = smtplib.SMTP(host, port, timeout=timeout)
+    server.ehlo()
+    if server.has_extn('starttls'):
+        server.starttls()
+        server.ehlo()
+    if password is not None and server.has_extn('auth'):
+        server.login(username, password)
+    return server
+
+
+#
+# send one message through the DATA command, written by write(line)
+# return bytes sent
+#
+def send_streaming(server, from_addr, to_addrs, write):
+    code, response = server.mail(from_addr)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, response, from_addr)
+    refused = {}
+    for to in to_addrs:
+        code, response = server.rcpt(to)
+        if code not in (250, 251):
+            refused[to] = (code, response)
+    if len(refused) == len(to_addrs):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    server.putcmd('data')
+    code, response = server.getreply()
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, response)
+    writer = DataWriter(server.send)
+    try:
+        write(writer.line)
+    except BaseException:
+        # no final '.' : the server must not deliver a partial message
+        server.close()
+        raise
+    writer.end()
+    code, response = server.getreply()
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPDataError(code, response)
+    return writer.bytes
+
+
+#
+# connect, send one message with attachments, quit
+# return (bytes sent, seconds)
+#
+def send_mail(from_addr, to_addrs, subject, text, attachments=(), host=SMTP_HOST, port=SMTP_PORT,
+              username=None, password=None):
+    started = time.monotonic()
+    server = connect(host, port, username, password)
+    try:
+        sent = send_streaming(server, from_addr, to_addrs,
+                              lambda line: write_message(line, from_addr, to_addrs, subject, text, attachments))
+    finally:
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+    return sent, time.monotonic() - started
+
+
+#
+# message of a batch
+#   key : name in the report (e.g. bt_id)
+#   attachments : Attachment list, sources given as bytes or file names (written again on retry)
+#
+class Message(object):
+    def __init__(self, key, subject, text, attachments=()):
+        self.key = key
+        self.subject = subject
+        self.text = text
+        self.attachments = list(attachments)
+        self.attempts = 0
+        self.error = None           # last failure (code, text)
+
+
+class BatchStats(object):
+    def __init__(self):
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.connections = 0
+        self.bytes = 0
+
+    def finish(self):
+        self.elapsed = time.monotonic() - self.started
+
+    def messages_per_sec(self):
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return ('{0} messages sent, {1} failed, {2} retries, {3} connections, {4} bytes in {5:.2f} sec. : '
+                '{6:.2f} messages/s').format(self.sent, self.failed, self.retries, self.connections, self.bytes,
+                                             self.elapsed, self.messages_per_sec())
+
+
+class TransientError(Exception):
+    pass
+
+
+class BatchSender(object):
+    def __init__(self, from_addr, to_addrs, host=SMTP_HOST, port=SMTP_PORT, username=None, password=None,
+                 retries=RETRIES, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+        self.from_addr = from_addr
+        self.to_addrs = list(to_addrs)
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.server = None
+        self.stats = BatchStats()
+        self.delivered = []         # messages accepted by the server
+        self.failed = []            # messages given up
+
+    #
+    # send all messages, return stats
+    #
+    def send(self, messages):
+        queue = collections.deque(messages)
+        delay = self.backoff
+        failures = 0                # connections failed in a row
+        while queue:
+            if self.server is None:
+                try:
+                    self.server = connect(self.host, self.port, self.username, self.password)
+                    self.stats.connections += 1
+                    failures = 0
+                except smtplib.SMTPAuthenticationError as e:
+                    # no message can be sent
+                    self._give_up_all(queue, (e.smtp_code, e.smtp_error.decode('utf-8', 'replace')))
+                    break
+                except (smtplib.SMTPException, OSError) as e:
+                    self._close()
+                    failures += 1
+                    if failures > self.retries:
+                        self._give_up_all(queue, (None, str(e)))
+                        break
+                    delay = self._sleep(delay)
+                    continue
+            sent = self.stats.sent
+            try:
+                self._run(queue)
+            except TransientError:
+                self._close()
+                if self.stats.sent > sent:
+                    delay = self.backoff        # the connection worked for a while
+                delay = self._sleep(delay)
+        self._quit()
+        self.stats.finish()
+        return self.stats
+
+    # back-off with jitter, return the next delay
+    def _sleep(self, delay):
+        time.sleep(delay * (0.5 + random.random() / 2))
+        return min(delay * 2, self.max_backoff)
+
+    def _give_up_all(self, queue, error):
+        while queue:
+            message = queue.popleft()
+            message.error = error
+            self._give_up(message)
+
+    #
+    # messages of queue through the open connection
+    # the messages in flight go back to the front of the queue if the connection fails
+    #
+    def _run(self, queue):
+        pipelining = self.server.has_extn('pipelining')
+        previous = None             # message written, end of data reply not read yet
+        message = None
+        try:
+            while queue:
+                message = queue.popleft()
+                if message.attempts > self.retries:
+                    self._give_up(message)
+                    message = None
+                    continue
+                if previous is not None and not pipelining:
+                    self._data_reply(previous)
+                    previous = None
+                message.attempts += 1
+                if pipelining:
+                    # in the same group as the end of the previous message
+                    self._envelope(message)
+                    if previous is not None:
+                        self._data_reply(previous)
+                        previous = None
+                    replies = self._envelope_replies()
+                else:
+                    replies = self._envelope_commands()
+                if not self._accepted(message, replies):
+                    message = None
+                    continue
+                writer = DataWriter(self.server.send)
+                write_message(writer.line, self.from_addr, self.to_addrs, message.subject, message.text,
+                              message.attachments)
+                writer.end()
+                self.stats.bytes += writer.bytes
+                previous, message = message, None
+            if previous is not None:
+                self._data_reply(previous)
+                previous = None
+        except (TransientError, smtplib.SMTPException, OSError) as e:
+            for requeued in (message, previous):
+                if requeued is not None:
+                    queue.appendleft(requeued)
+                    self.stats.retries += 1
+            raise TransientError(str(e))
+
+    # MAIL, RCPT, DATA in one group (PIPELINING : replies read by _envelope_replies)
+    def _envelope(self, message):
+        commands = ['mail FROM:' + smtplib.quoteaddr(self.from_addr)]
+        commands += ['rcpt TO:' + smtplib.quoteaddr(to) for to in self.to_addrs]
+        commands.append('data')
+        self.server.send(''.join(command + '\r\n' for command in commands))
+
+    # replies of _envelope : (mail, [rcpt, ...], data)
+    def _envelope_replies(self):
+        replies = [self.server.getreply() for _ in range(len(self.to_addrs) + 2)]
+        return replies[0], replies[1:-1], replies[-1]
+
+    #
+    # MAIL, RCPT, DATA one by one, every reply read before the next command (no PIPELINING)
+    #   RCPT not sent if MAIL is refused, DATA not sent if no recipient is accepted (None)
+    #
+    def _envelope_commands(self):
+        mail = self._command('mail FROM:' + smtplib.quoteaddr(self.from_addr))
+        rcpts = []
+        if mail[0] == 250:
+            rcpts = [self._command('rcpt TO:' + smtplib.quoteaddr(to)) for to in self.to_addrs]
+        data = None
+        if any(code in (250, 251) for code, _ in rcpts):
+            data = self._command('data')
+        return mail, rcpts, data
+
+    def _command(self, command):
+        self.server.putcmd(command)
+        return self.server.getreply()
+
+    #
+    # envelope replies (mail, [rcpt, ...], data) of message
+    # True : ready for the message content, False : message given up (permanent failure)
+    # TransientError : 4xx reply
+    #
+    def _accepted(self, message, replies):
+        mail, rcpts, data = replies
+        if data is not None and data[0] == 354:
+            if mail[0] == 250 and any(code in (250, 251) for code, _ in rcpts):
+                return True
+            # DATA accepted without sender / recipients : empty message, dropped by rset
+            self.server.send('.\r\n')
+            self.server.getreply()
+        failure = mail if mail[0] != 250 else next((reply for reply in rcpts if reply[0] not in (250, 251)), data)
+        message.error = (failure[0], failure[1].decode('utf-8', 'replace'))
+        self.server.rset()
+        if 400 <= failure[0] < 500:
+            raise TransientError('{0} {1}'.format(*message.error))
+        self._give_up(message)
+        return False
+
+    # end of data reply of message
+    def _data_reply(self, message):
+        code, response = self.server.getreply()
+        if code == 250:
+            self.stats.sent += 1
+            self.delivered.append(message)
+            return
+        message.error = (code, response.decode('utf-8', 'replace'))
+        if 400 <= code < 500:
+            raise TransientError('{0} {1}'.format(*message.error))
+        self._give_up(message)
+
+    def _give_up(self, message):
+        self.stats.failed += 1
+        self.failed.append(message)
+
+    def _quit(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.server = None
+
+    def _close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+
+# message of one Edge AI Box : archive + bt_id.txt
+def log_message(bt_id, archive):
+    return Message(bt_id, 'log files from ' + bt_id, 'log files from {0}\n'.format(bt_id),
+                   [Attachment(os.path.basename(archive), archive, 'application/gzip'),
+                    Attachment('bt_id.txt', bt_id.encode('utf-8'), 'text/plain; charset="utf-8"')])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='send the log archives of several Edge AI Boxes '
+                                                 'through one SMTP connection')
+    parser.add_argument('--from', dest='from_addr', required=True, help='from email address (login user)')
+    parser.add_argument('--password', help='app password (none : no login, e.g. local debugging server)')
+    parser.add_argument('--to', action='append', required=True, help='to email address (repeatable)')
+    parser.add_argument('--host', default=os.environ.get('ARMM_SMTP_HOST', SMTP_HOST))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('ARMM_SMTP_PORT', SMTP_PORT)))
+    parser.add_argument('--retries', type=int, default=RETRIES)
+    parser.add_argument('--list', help="file of 'bt_id archive' lines")
+    parser.add_argument('pairs', nargs='*', metavar='bt_id=archive')
+    args = parser.parse_args()
+
+    pairs = []
+    for pair in args.pairs:
+        if '=' not in pair:
+            parser.error('bt_id=archive expected : ' + pair)
+        pairs.append(pair.split('=', 1))
+    if args.list:
+        with open(args.list) as f:
+            pairs += [line.split(None, 1) for line in f if line.strip() and not line.startswith('#')]
+    for bt_id, archive in pairs:
+        if not os.path.isfile(archive.strip()):
+            parser.error('no archive : ' + archive.strip())
+
+    sender = BatchSender(args.from_addr, args.to, args.host, args.port, args.from_addr, args.password,
+                         retries=args.retries)
+    stats = sender.send([log_message(bt_id.strip(), archive.strip()) for bt_id, archive in pairs])
+    for message in sender.failed:
+        print('[ERROR] {0} : {1}'.format(message.key, message.error), file=sys.stderr)
+    print(stats)
+    return 1 if sender.failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import threading
+import collections
+import http.server
+
+#
+# Prometheus text format metrics of the host program (opt-in)
+#
+# Counters & gauges of the events seen only by the program (heartbeats sent / answered,
+# probe results, state, log pull, ARMM temperature) are kept in a Metrics registry : an
+# update is one dict operation under a lock.  The numbers already kept elsewhere (round
+# trip latency, time outs & checksum errors of LinkStats, job lateness of TimerScheduler,
+# NetworkHealth of the probe targets) are sources, read only when the metrics are rendered.
+# Nothing is formatted while nobody reads them.
+#
+# Served as
+#   - a file for the node_exporter textfile collector (write_textfile : replaced at once,
+#     the collector never reads a partial file), written every METRICS_PERIOD
+#   - http://127.0.0.1:<port>/metrics (MetricsServer : one thread, loopback only,
+#     rendered for every scrape)
+#
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+METRICS_PERIOD = 60         # [sec] textfile collector file
+LOOPBACK = '127.0.0.1'
+
+# name -> (type, help) of every metric of the program
+METRICS = {
+    'armm_up': ('gauge', 'host program is running'),
+    'armm_start_time_seconds': ('gauge', 'start time of the host program (unix time)'),
+    'armm_state': ('gauge', 'state machine : 0 POWERON, 1 WAIT4BT, 2 HEARTBEAT, 3 BT_DEAD'),
+    'armm_state_changes_total': ('counter', 'state machine transitions'),
+    'armm_heartbeats_sent_total': ('counter', 'heartbeat alive_req sent'),
+    'armm_heartbeats_acked_total': ('counter', 'heartbeat alive_req answered by alive_res'),
+    'armm_heartbeat_last_ack_time_seconds': ('gauge', 'last alive_res to a heartbeat (unix time)'),
+    'armm_temperature_celsius': ('gauge', 'ARMM temperature'),
+    'armm_status_field': ('gauge', 'fields of the last ARMM status_res'),
+    'armm_status_age_seconds': ('gauge', 'age of the last ARMM status_res'),
+    'armm_status_requests_total': ('counter', 'status_req sent (status cache misses)'),
+    'armm_status_failures_total': ('counter', 'status_req without status_res'),
+    'armm_status_cache_hits_total': ('counter', 'status reads answered by the status cache'),
+    'armm_log_pulls_total': ('counter', 'ARMM log pulls by result'),
+    'armm_log_pull_duration_seconds': ('gauge', 'duration of the last ARMM log pull'),
+    'armm_log_pull_records': ('gauge', 'log records of the last ARMM log pull'),
+    'armm_log_pull_last_time_seconds': ('gauge', 'end of the last ARMM log pull (unix time)'),
+    'armm_probes_total': ('counter', 'connectivity probes by target & result'),
+    'armm_probe_rtt_seconds': ('gauge', 'RTT of the last answered probe'),
+    'armm_probe_down': ('gauge', 'probe target is down (no answer in a full window)'),
+    'armm_probe_loss_ratio': ('gauge', 'EWMA of the probe loss ratio'),
+    'armm_probe_rtt_ewma_seconds': ('gauge', 'EWMA of the probe RTT'),
+    'armm_wan_down': ('gauge', 'WAN is down (quorum of probe targets down)'),
+    'armm_rtt_seconds': ('summary', 'round trip latency of ARMM requests'),
+    'armm_rx_timeouts_total': ('counter', 'ARMM requests without response'),
+    'armm_send_errors_total': ('counter', 'ARMM requests not sent (serial port error)'),
+    'armm_checksum_errors_total': ('counter', 'received frames with a wrong checksum'),
+    'armm_framing_errors_total': ('counter', 'broken frames (framing errors)'),
+    'armm_unexpected_frames_total': ('counter', 'received frames nobody waited for'),
+    'armm_dropped_frames_total': ('counter', 'unexpected frames dropped, nobody read them'),
+    'armm_job_lateness_seconds': ('summary', 'timer job start - due time'),
+    'armm_job_last_lateness_seconds': ('gauge', 'lateness of the last run of the timer job'),
+}
+
+
+# label value -> text format ('\', '"' & new line escaped)
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def number(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+# one sample line
+def sample(name, labels, value):
+    if labels:
+        name += '{' + ','.join('{0}="{1}"'.format(k, escape(v)) for k, v in labels) + '}'
+    return name + ' ' + number(value)
+
+
+#
+# counters, gauges & sources
+#   source : function -> iterable of (name, labels (dict), value)
+#
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = METRICS
+        self.values = {}            # (name, labels) -> value
+        self.sources = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = value
+
+    def add_source(self, source):
+        self.sources.append(source)
+
+    # all samples, grouped by metric name, in the Prometheus text format
+    def render(self):
+        with self.lock:
+            samples = [(name, labels, value) for (name, labels), value in self.values.items()]
+        for source in self.sources:
+            try:
+                for name, labels, value in source():
+                    samples.append((name, tuple(sorted(labels.items())), value))
+            except Exception as e:
+                # e.g. a dict changed by the state machine thread while read : next time
+                logging.debug('metrics source failed : ' + repr(e))
+        families = collections.OrderedDict()
+        for name, labels, value in sorted(samples, key=lambda s: (s[0], s[1])):
+            if value is None:
+                continue
+            family = self.family(name)
+            families.setdefault(family, []).append(sample(name, labels, value))
+        lines = []
+        for family, family_lines in families.items():
+            kind, text = self.types.get(family, ('untyped', None))
+            if text:
+                lines.append('# HELP {0} {1}'.format(family, text))
+            lines.append('# TYPE {0} {1}'.format(family, kind))
+            lines.extend(family_lines)
+        return '\n'.join(lines) + '\n'
+
+    # metric name of a sample (armm_rtt_seconds_count -> armm_rtt_seconds)
+    def family(self, name):
+        if name not in self.types:
+            for suffix in ('_count', '_sum'):
+                if name.endswith(suffix) and self.types.get(name[:-len(suffix)], ('',))[0] == 'summary':
+                    return name[:-len(suffix)]
+        return name
+
+    # file of the textfile collector, replaced at once
+    def write_textfile(self, filename):
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, filename)
+
+
+#
+# sources of the snapshots kept by the other modules
+#
+def summary(name, labels, entry):
+    # entry : Histogram.to_dict() [msec.]
+    result = []
+    for quantile, key in (('0.5', 'p50_ms'), ('0.95', 'p95_ms'), ('0.99', 'p99_ms')):
+        if entry.get(key) is not None:
+            result.append((name, dict(labels, quantile=quantile), round(entry[key] / 1000.0, 6)))
+    result.append((name + '_count', labels, entry['count']))
+    if entry['count']:
+        result.append((name + '_sum', labels, round(entry['mean_ms'] * entry['count'] / 1000.0, 6)))
+    return result
+
+
+# LinkStats.snapshot()
+def link_samples(snapshot):
+    result = []
+    for command, entry in snapshot['commands'].items():
+        labels = {'command': command}
+        result.extend(summary('armm_rtt_seconds', labels, entry))
+        result.append(('armm_rx_timeouts_total', labels, entry['timeouts']))
+        result.append(('armm_send_errors_total', labels, entry['send_errors']))
+    for command, count in snapshot['checksum_errors'].items():
+        result.append(('armm_checksum_errors_total', {'command': command}, count))
+    for command, count in snapshot['unexpected'].items():
+        result.append(('armm_unexpected_frames_total', {'command': command}, count))
+    result.append(('armm_framing_errors_total', {}, snapshot['framing_errors']))
+    result.append(('armm_dropped_frames_total', {}, snapshot['dropped']))
+    return result
+
+
+# TimerScheduler.snapshot()
+def timer_samples(snapshot):
+    result = []
+    for job, entry in snapshot.items():
+        labels = {'job': job}
+        result.extend(summary('armm_job_lateness_seconds', labels, entry))
+        if entry['last_ms'] is not None:
+            result.append(('armm_job_last_lateness_seconds', labels, round(entry['last_ms'] / 1000.0, 6)))
+    return result
+
+
+# NetworkHealth.snapshot()
+def health_samples(snapshot):
+    result = [('armm_wan_down', {}, snapshot['wan_down'])]
+    for target, entry in snapshot['targets'].items():
+        labels = {'target': target}
+        result.append(('armm_probe_down', labels, entry['down']))
+        result.append(('armm_probe_loss_ratio', labels, entry['loss_ewma']))
+        if entry['rtt_ewma_ms'] is not None:
+            result.append(('armm_probe_rtt_ewma_seconds', labels, round(entry['rtt_ewma_ms'] / 1000.0, 6)))
+    return result
+
+
+# StatusCache.snapshot()
+def status_samples(snapshot):
+    result = [
+        ('armm_status_requests_total', {}, snapshot['requests']),
+        ('armm_status_failures_total', {}, snapshot['failures']),
+        ('armm_status_cache_hits_total', {}, snapshot['hits']),
+        ('armm_status_age_seconds', {}, snapshot['age']),
+    ]
+    if snapshot['status'] is not None:
+        for field, value in snapshot['status']['fields'].items():
+            if isinstance(value, (int, float)):
+                result.append(('armm_status_field', {'field': field}, value))
+    return result
+
+
+#
+# events of the program -> counters & gauges
+#
+def count_state(metrics, state):
+    metrics.set('armm_state', state)
+    metrics.inc('armm_state_changes_total')
+
+
+# ProbeResult of a round
+def count_probes(metrics, results):
+    for result in results:
+        metrics.inc('armm_probes_total', target=result.name, result='ok' if result.ok else 'failed')
+        if result.rtt is not None:
+            metrics.set('armm_probe_rtt_seconds', result.rtt, target=result.name)
+
+
+# LogPullStats
+def count_log_pull(metrics, stats):
+    metrics.inc('armm_log_pulls_total', result='complete' if stats.complete else 'not_complete')
+    metrics.set('armm_log_pull_duration_seconds', stats.elapsed)
+    metrics.set('armm_log_pull_records', stats.records)
+    metrics.set('armm_log_pull_last_time_seconds', time.time())
+
+
+#
+# textfile collector file written every `period` by one thread
+#
+class TextfileWriter(object):
+    def __init__(self, metrics, filename, period=METRICS_PERIOD):
+        self.metrics = metrics
+        self.filename = filename
+        self.period = period
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='metrics-textfile', daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                self.metrics.write_textfile(self.filename)
+            except OSError as e:
+                logging.error("can't write metrics : " + str(e))
+            if self.stopped.wait(self.period):
+                return
+
+    def stop(self):
+        self.stopped.set()
+
+
+#
+# GET /metrics on the loopback interface, one thread (scrapes are answered one by one)
+#
+class MetricsServer(object):
+    def __init__(self, metrics, port, host=LOOPBACK):
+        self.metrics = metrics
+        self.address = (host, port)
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.HTTPServer(self.address, Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+import time
+import errno
+import socket
+import struct
+import select
+import asyncio
+import logging
+import threading
+import collections
+import concurrent.futures
+
+from armm.resolver import Resolver
+
+#
+# Connectivity probes off the heartbeat thread
+#
+# `ping host -c 2 -W 300` run one host after the other on the thread sending the
+# heartbeat can block it for 10 minutes when the WAN is dead, longer than the ARMM
+# heartbeat watchdog.  ProbeRunner runs all probes of a round at once on worker threads,
+# each with a deadline, and hands the results to a callback (e.g. TimerScheduler.post,
+# which runs it on the state machine thread).  A probe still running at the deadline
+# counts as failed.
+#
+# probe : function(timeout [sec]) -> True (reachable) / False, or Echo (RTT & loss)
+#
+# In-process probes (no fork / exec of /bin/ping) :
+#   icmp_probe : ICMP echo on an unprivileged datagram socket (Linux "ping socket", allowed
+#                for the groups of net.ipv4.ping_group_range)
+#   tcp_probe  : TCP connect (an answer, also connection refused, means reachable)
+#   dns_probe  : A query to the name servers (RTT of the query)
+# Host names are resolved by a Resolver, which keeps the addresses for the TTL of the answer.
+#
+PROBE_DEADLINE = 20.0       # [sec] per probe
+PING_COUNT = 2              # ICMP echo requests per ping probe
+PING_INTERVAL = 0.2         # [sec] between echo requests
+TCP_PORT = 443              # tcp_probe port when ICMP is not allowed
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+ProbeResult = collections.namedtuple('ProbeResult', ('name', 'ok', 'seconds', 'error', 'rtt', 'loss'))
+#   sent, received : requests & answers, rtts : list of RTT [sec] of the answers
+Echo = collections.namedtuple('Echo', ('sent', 'received', 'rtts'))
+
+
+# unprivileged ICMP echo allowed (net.ipv4.ping_group_range)
+def icmp_available():
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+    except OSError:
+        return False
+    sock.close()
+    return True
+
+
+def icmp_checksum(data):
+    if len(data) & 1:
+        data += b'\x00'
+    total = sum(struct.unpack('!{0}H'.format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+#
+# ICMP echo probe : count requests PING_INTERVAL apart, answers until the timeout
+# the kernel sets the identifier (socket port) and only gives us our own replies
+#
+def icmp_probe(host, count=PING_COUNT, resolver=None):
+    resolver = resolver if resolver is not None else Resolver()
+
+    def probe(timeout):
+        deadline = time.monotonic() + timeout
+        address = resolver.resolve(host, timeout)[0]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        try:
+            sock.connect((address, 0))
+            sent = {}                   # sequence -> time.monotonic() sent
+            rtts = []
+            errors = 0                  # ICMP errors (unreachable ...) instead of a reply
+            next_send = time.monotonic()
+            while len(rtts) + errors < count:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if len(sent) < count and now >= next_send:
+                    sequence = len(sent) + 1
+                    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, 0, sequence)
+                    payload = struct.pack('!d', now)
+                    checksum = icmp_checksum(header + payload)
+                    sock.send(struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, 0, sequence) + payload)
+                    sent[sequence] = now
+                    next_send = now + PING_INTERVAL
+                wait = deadline - now
+                if len(sent) < count:
+                    wait = min(wait, max(0.0, next_send - now))
+                readable, _, _ = select.select([sock], [], [], wait)
+                if not readable:
+                    continue
+                try:
+                    reply = sock.recv(1024)
+                except OSError as e:
+                    # ICMP errors (host / net / port unreachable) of the connected socket
+                    if e.errno in (errno.EHOSTUNREACH, errno.ENETUNREACH, errno.ECONNREFUSED):
+                        errors += 1
+                        continue
+                    raise
+                if len(reply) < 8:
+                    continue
+                rtype, _, _, _, sequence = struct.unpack('!BBHHH', reply[:8])
+                if rtype == ICMP_ECHO_REPLY and sequence in sent:
+                    rtts.append(time.monotonic() - sent.pop(sequence))
+            return Echo(count, len(rtts), rtts)
+        finally:
+            sock.close()
+    return probe
+
+
+#
+# TCP connect probe : SYN answered (connected or refused) -> reachable
+#
+def tcp_probe(host, port=TCP_PORT, resolver=None):
+    resolver = resolver if resolver is not None else Resolver()
+
+    def probe(timeout):
+        deadline = time.monotonic() + timeout
+        address = resolver.resolve(host, timeout)[0]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(max(0.001, deadline - time.monotonic()))
+            started = time.monotonic()
+            try:
+                sock.connect((address, port))
+            except ConnectionRefusedError:
+                pass
+            except socket.timeout:
+                return Echo(1, 0, [])
+            return Echo(1, 1, [time.monotonic() - started])
+        finally:
+            sock.close()
+    return probe
+
+
+#
+# DNS probe : A query of name (the answer also refreshes the resolver cache)
+#
+def dns_probe(name, resolver=None):
+    resolver = resolver if resolver is not None else Resolver()
+
+    def probe(timeout):
+        try:
+            _, _, rtt = resolver.query(name, timeout)
+        except socket.timeout:
+            return Echo(1, 0, [])
+        return Echo(1, 1, [rtt])
+    return probe
+
+
+#
+# probes of BT-SerialCommunication.py : ICMP echo of hosts if allowed, else TCP connect to
+# TCP_PORT, and a DNS query of dns_names, one resolver for all of them
+#
+def default_probes(hosts, dns_names=(), resolver=None):
+    resolver = resolver if resolver is not None else Resolver()
+    if icmp_available():
+        probes = [('icmp ' + host, icmp_probe(host, resolver=resolver)) for host in hosts]
+    else:
+        probes = [('tcp ' + host, tcp_probe(host, resolver=resolver)) for host in hosts]
+    return probes + [('dns ' + name, dns_probe(name, resolver)) for name in dns_names]
+
+
+class ProbeRunner(object):
+    #   probes : list of (name, probe)
+    def __init__(self, probes, deadline=PROBE_DEADLINE):
+        self.probes = list(probes)
+        self.deadline = deadline
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, len(self.probes)), thread_name_prefix='probe')
+        self.lock = threading.Lock()
+        self.busy = False               # round in progress (threaded start())
+        self.rounds = 0
+        self.skipped = 0                # rounds not started, previous one still running
+
+    # run one probe (worker thread)
+    def _run(self, name, probe):
+        started = time.monotonic()
+        rtt = loss = None
+        try:
+            answer = probe(self.deadline)
+            error = None
+            if isinstance(answer, Echo):
+                ok = answer.received > 0
+                if answer.rtts:
+                    rtt = sum(answer.rtts) / len(answer.rtts)
+                if answer.sent:
+                    loss = 1.0 - answer.received / float(answer.sent)
+            else:
+                ok = bool(answer)
+        except Exception as e:      # OSError, DnsError ...
+            ok = False
+            error = str(e) or type(e).__name__
+        return ProbeResult(name, ok, time.monotonic() - started, error, rtt, loss)
+
+    # results of a round in the order of self.probes
+    def _collect(self, futures, started):
+        results = []
+        for (name, _), future in zip(self.probes, futures):
+            if future.done():
+                results.append(future.result())
+            else:
+                results.append(ProbeResult(name, False, time.monotonic() - started, 'deadline', None, 1.0))
+        return results
+
+    #
+    # start a round without waiting for it
+    #   done : function(list of ProbeResult), called on a worker thread when all probes
+    #          finished or the deadline passed
+    # return False if the previous round is still running (nothing started)
+    #
+    def start(self, done):
+        with self.lock:
+            if self.busy:
+                self.skipped += 1
+                return False
+            self.busy = True
+            self.rounds += 1
+        started = time.monotonic()
+        futures = [self.executor.submit(self._run, name, probe) for name, probe in self.probes]
+
+        def wait():
+            try:
+                concurrent.futures.wait(futures, timeout=self.deadline)
+                results = self._collect(futures, started)
+            finally:
+                with self.lock:
+                    self.busy = False
+            done(results)
+
+        thread = threading.Thread(target=wait, name='probe-round')
+        thread.daemon = True
+        thread.start()
+        return True
+
+    # run a round & wait for it (asyncio), return list of ProbeResult
+    async def run_async(self):
+        loop = asyncio.get_event_loop()
+        self.rounds += 1
+        started = time.monotonic()
+        futures = [loop.run_in_executor(self.executor, self._run, name, probe) for name, probe in self.probes]
+        await asyncio.wait(futures, timeout=self.deadline)
+        return self._collect(futures, started)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+# RTT & loss of a result for the log
+def describe(result):
+    text = '{0:.1f} sec.'.format(result.seconds)
+    if result.rtt is not None:
+        text += ', rtt {0:.1f} ms'.format(result.rtt * 1000.0)
+    if result.loss is not None:
+        text += ', loss {0:.0f}%'.format(result.loss * 100.0)
+    if result.error:
+        text += ', ' + result.error
+    return text
+
+
+# log one round
+def log_results(results):
+    for result in results:
+        if result.ok:
+            logging.debug('ping OK : {0} ({1})'.format(result.name, describe(result)))
+        else:
+            logging.debug('ping failed : {0} ({1})'.format(result.name, describe(result)))
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+import re
+import sys
+import time
+import argparse
+import datetime
+import collections
+
+from armm import commands
+from armm.codec import FrameDecoder, decode, encode
+from armm.link import Correlator
+from armm.latency import LinkStats
+from armm.logquery import open_log, query, line_time, parse_when
+
+#
+# Offline replay of the wire traffic recorded in BT-log
+#
+# Every frame sent and received is in BT-log as a writelog line
+#   BT11 DEBUG: 2023-11-16 02:00:00.123456self.senddata = 100203031003
+#   BT11 DEBUG: 2023-11-16 02:00:00.234567self.recvData = 1002830041...1003
+# The replay takes these lines from the log generations (or the given files) and runs them
+# through the code of the program :
+#   - received bytes are fed to FrameDecoder (a state machine kept across frames, as the
+#     reader thread does), at the original timing, `speed` times faster or at once
+#   - every frame is also decoded by codec.decode, every sent frame is decoded & encoded
+#     again : a frame decoded (or encoded) differently than it was recorded is flagged
+#   - responses are matched to requests by link.Correlator, the round trip latency (time
+#     stamps of the log) is counted by latency.LinkStats.  log_res of a log pull are written
+#     as 'BT11 LOG:' records, not as frames, so log_req / log_res are not matched
+# and reports the decode throughput, so production traffic is a regression & performance
+# corpus.
+#
+#   python3 -m armm.replay /home/nvidia/bt-11/BT-log --since 1d
+#   python3 -m armm.replay --files BT-log.3.gz --speed 100
+#
+WIRE_LINE = re.compile(r'^BT\d\d DEBUG: (\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d+)?)'
+                       r'self\.(recvData|senddata) = ([0-9a-f]*)\s*$')
+RX = 'RX'
+TX = 'TX'
+REQUEST_TIMEOUT = 60.0      # [sec] (log time) request without response is a time out
+MAX_GAP = 60.0              # [sec] longest wait between two frames when paced
+SHOW = 20                   # flagged frames printed
+UNMATCHED = (commands.LOG_REQ, commands.LOG_RES)    # responses not in the log as frames
+
+Record = collections.namedtuple('Record', 'path lineno at direction raw')
+
+
+# writelog line of a frame -> (time, RX / TX, frame bytes), None if not a frame line
+def parse_line(line):
+    match = WIRE_LINE.match(line)
+    if match is None:
+        return None
+    try:
+        raw = bytes.fromhex(match.group(3))
+    except ValueError:
+        return None
+    at = line_time(match.group(1).encode('ascii'))
+    return at, RX if match.group(2) == 'recvData' else TX, raw
+
+
+#
+# frame records of the log generations of logname (since, until : unix time)
+# or of the given files, oldest first
+#
+def read_records(logname=None, since=None, until=None, files=None):
+    if files:
+        for path in files:
+            with open_log(path) as f:
+                for number, raw in enumerate(f, 1):
+                    parsed = parse_line(raw.decode('utf-8', 'replace'))
+                    if parsed is None:
+                        continue
+                    if (since is not None and parsed[0] < since) or (until is not None and parsed[0] >= until):
+                        continue
+                    yield Record(path, number, *parsed)
+        return
+    pattern = re.compile(r'self\.(?:recvData|senddata) = ')
+    for path, number, line in query(logname, since, until, pattern=pattern):
+        parsed = parse_line(line)
+        if parsed is not None:
+            yield Record(path, number, *parsed)
+
+
+# request waiting for its response (Correlator entry)
+class Request(object):
+    __slots__ = ('command', 'at')
+
+    def __init__(self, command, at):
+        self.command = command
+        self.at = at
+
+
+class Replay(object):
+    #   speed : 0 at once, 1 original timing, N N times faster
+    def __init__(self, speed=0.0, max_gap=MAX_GAP, timeout=REQUEST_TIMEOUT):
+        self.speed = speed
+        self.max_gap = max_gap
+        self.timeout = timeout
+        self.decoder = FrameDecoder()
+        self.waiting = Correlator()
+        self.stats = LinkStats()
+        self.flagged = []               # (record, reason)
+        self.counts = collections.Counter()
+        self.decode_seconds = 0.0       # time in FrameDecoder.feed & codec.decode
+        self.elapsed = 0.0
+        self.first = None               # (log time, monotonic) of the first record
+
+    def run(self, records):
+        started = time.monotonic()
+        for record in records:
+            self.pace(record)
+            self.expire(record.at)
+            if record.direction == RX:
+                self.rx(record)
+            else:
+                self.tx(record)
+        self.finish()
+        self.elapsed = time.monotonic() - started
+        return self
+
+    # wait until the time of the record (speed 0 : no wait)
+    def pace(self, record):
+        if self.first is None:
+            self.first = (record.at, time.monotonic())
+            return
+        if not self.speed:
+            return
+        gap = (record.at - self.first[0]) / self.speed - (time.monotonic() - self.first[1])
+        if gap > self.max_gap:
+            # long silence : move the base instead of waiting
+            self.first = (self.first[0], self.first[1] - (gap - self.max_gap))
+            gap = self.max_gap
+        if gap > 0:
+            time.sleep(gap)
+
+    def rx(self, record):
+        self.counts['rx'] += 1
+        self.counts['rx_bytes'] += len(record.raw)
+        started = time.perf_counter()
+        frames = self.decoder.feed(record.raw)
+        single = None
+        try:
+            single = decode(record.raw)
+        except ValueError:
+            pass
+        self.decode_seconds += time.perf_counter() - started
+        if len(frames) != 1:
+            self.flag(record, '{0} frames decoded'.format(len(frames)))
+        elif frames[0].raw != record.raw:
+            self.flag(record, 'decoded as ' + frames[0].raw.hex())
+        elif single is None:
+            self.flag(record, 'codec.decode : not a frame')
+        elif (single[0], bytes(single[1]), single[3]) != \
+                (frames[0].command, bytes(frames[0].parameter), frames[0].valid):
+            self.flag(record, 'codec.decode and FrameDecoder differ')
+        for frame in frames:
+            if not frame.valid:
+                self.counts['checksum_errors'] += 1
+            if frame.command in UNMATCHED:
+                self.stats.frame(frame)
+                continue
+            request = self.waiting.match(frame)
+            self.stats.frame(frame, request is not None)
+            if request is not None:
+                self.stats.response(request.command, record.at - request.at)
+
+    def tx(self, record):
+        self.counts['tx'] += 1
+        try:
+            command, parameter, _, valid = decode(record.raw)
+        except ValueError:
+            self.flag(record, 'not a frame')
+            return
+        data = bytes((command,)) + bytes(parameter)
+        if not valid:
+            self.flag(record, 'sent with a wrong checksum')
+        elif encode(data) != record.raw:
+            self.flag(record, 'encoded now as ' + encode(data).hex())
+        if command not in UNMATCHED:
+            self.waiting.add(Request(command, record.at))
+
+    # requests older than timeout (log time) : time out
+    def expire(self, at):
+        while self.waiting.order and at - self.waiting.order[0].at > self.timeout:
+            request = self.waiting.order[0]
+            self.waiting.remove(request)
+            self.stats.timeout(request.command)
+
+    def finish(self):
+        for request in self.waiting.clear():
+            self.counts['unanswered'] += 1
+        self.stats.broken_frames(self.decoder.framing_errors)
+
+    def flag(self, record, reason):
+        self.counts['flagged'] += 1
+        self.flagged.append((record, reason))
+
+    def lines(self, show=SHOW):
+        counts = self.counts
+        result = ['{0} frames received ({1} bytes), {2} sent, {3} flagged, {4} checksum errors, '
+                  '{5} requests without response at the end'.format(
+                      counts['rx'], counts['rx_bytes'], counts['tx'], counts['flagged'],
+                      counts['checksum_errors'], counts['unanswered'])]
+        if self.decode_seconds > 0:
+            result.append('decode : {0:.3f} sec., {1:.0f} frames/s, {2:.0f} bytes/s'.format(
+                self.decode_seconds, counts['rx'] / self.decode_seconds, counts['rx_bytes'] / self.decode_seconds))
+        result.append('replay : {0:.3f} sec.'.format(self.elapsed))
+        result.extend(self.stats.lines())
+        for record, reason in self.flagged[:show]:
+            result.append('FLAGGED {0}:{1} {2} {3} {4} : {5}'.format(
+                record.path, record.lineno, datetime.datetime.fromtimestamp(record.at),
+                record.direction, record.raw.hex(), reason))
+        if len(self.flagged) > show:
+            result.append('... {0} more flagged frames'.format(len(self.flagged) - show))
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replay the frames recorded in the BT log through the decoder')
+    parser.add_argument('logname', nargs='?', help='live log file (e.g. /home/nvidia/bt-11/BT-log), all generations')
+    parser.add_argument('--files', nargs='+', help='replay these log files (any generation, .gz / .zst) instead')
+    parser.add_argument('--since', help="start time : 'YYYY-mm-dd HH:MM[:SS]', 'HH:MM' or '2h' ago")
+    parser.add_argument('--until', help='end time (not included), same formats')
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='0 : at once (default), 1 : original timing, N : N times faster')
+    parser.add_argument('--max-gap', type=float, default=MAX_GAP, help='[sec] longest wait between frames')
+    parser.add_argument('--show', type=int, default=SHOW, help='flagged frames printed')
+    args = parser.parse_args()
+    if not args.logname and not args.files:
+        parser.error('logname or --files is required')
+
+    try:
+        since = parse_when(args.since) if args.since else None
+        until = parse_when(args.until) if args.until else None
+        replay = Replay(args.speed, args.max_gap)
+        replay.run(read_records(args.logname, since, until, args.files))
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        replay.finish()
+    try:
+        for line in replay.lines(args.show):
+            print(line)
+    except BrokenPipeError:
+        # output closed (e.g. | head)
+        sys.stderr.close()
+    return 1 if replay.counts['flagged'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
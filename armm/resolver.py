@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import socket
+import struct
+import threading
+import ipaddress
+
+#
+# Small DNS stub resolver with a TTL cache
+#
+# Every `ping www.google.com` resolved the name again.  Resolver sends one A query over
+# UDP to the name servers of /etc/resolv.conf and keeps the addresses for the TTL of the
+# answer (limited to MIN_TTL .. MAX_TTL), so a probe every 5 min. queries DNS only when
+# the record has expired.  query() always asks the server (DNS probe), resolve() uses the
+# cache.  Without a name server, socket.getaddrinfo() is used and cached for DEFAULT_TTL.
+# Names of /etc/hosts (read once) are never asked.
+#
+# IPv4 (A records) only, like the ping hosts of BT-SerialCommunication.py.
+#
+RESOLV_CONF = '/etc/resolv.conf'
+HOSTS = '/etc/hosts'
+DNS_PORT = 53
+MIN_TTL = 5                 # [sec]
+MAX_TTL = 3600              # [sec]
+DEFAULT_TTL = 60            # [sec] getaddrinfo() results (no TTL)
+TYPE_A = 1
+TYPE_CNAME = 5
+CLASS_IN = 1
+RCODE_NXDOMAIN = 3
+
+
+class DnsError(Exception):
+    pass
+
+
+# name does not exist : the other servers are not asked
+class NxDomainError(DnsError):
+    pass
+
+
+# name servers of resolv.conf : list of (address, port)
+def nameservers(filename=RESOLV_CONF):
+    servers = []
+    try:
+        with open(filename) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    try:
+                        if ipaddress.ip_address(fields[1]).version == 4:
+                            servers.append((fields[1], DNS_PORT))
+                    except ValueError:
+                        pass
+    except OSError:
+        pass
+    return servers
+
+
+# IPv4 names of the hosts file : name (lower case) -> list of addresses
+def hosts_file(filename=HOSTS):
+    names = {}
+    try:
+        with open(filename) as f:
+            for line in f:
+                fields = line.split('#', 1)[0].split()
+                if len(fields) < 2 or not is_address(fields[0]):
+                    continue
+                for name in fields[1:]:
+                    names.setdefault(name.lower(), []).append(fields[0])
+    except OSError:
+        pass
+    return names
+
+
+# IPv4 address literal -> True
+def is_address(host):
+    try:
+        return ipaddress.ip_address(host).version == 4
+    except ValueError:
+        return False
+
+
+#
+# wire format
+#
+def build_query(name, ident, qtype=TYPE_A):
+    header = struct.pack('!HHHHHH', ident, 0x0100, 1, 0, 0, 0)     # RD, 1 question
+    qname = b''
+    for label in name.rstrip('.').split('.'):
+        label = label.encode('idna')
+        if not 0 < len(label) < 64:
+            raise DnsError('bad name : ' + name)
+        qname += bytes((len(label),)) + label
+    return header + qname + b'\x00' + struct.pack('!HH', qtype, CLASS_IN)
+
+
+# skip a (compressed) name at offset, return offset after it
+def skip_name(message, offset):
+    while True:
+        if offset >= len(message):
+            raise DnsError('truncated name')
+        length = message[offset]
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += 1 + length
+        if length == 0:
+            return offset
+
+
+#
+# response -> (list of IPv4 addresses, TTL [sec])
+#
+def parse_response(message, ident):
+    if len(message) < 12:
+        raise DnsError('short response')
+    rid, flags, qdcount, ancount, _, _ = struct.unpack('!HHHHHH', message[:12])
+    if rid != ident or not flags & 0x8000:
+        raise DnsError('not a response to the query')
+    rcode = flags & 0x000F
+    if rcode == RCODE_NXDOMAIN:
+        raise NxDomainError('NXDOMAIN')
+    if rcode:
+        raise DnsError('rcode {0}'.format(rcode))
+    if flags & 0x0200:
+        raise DnsError('truncated response')
+    offset = 12
+    for _ in range(qdcount):
+        offset = skip_name(message, offset) + 4
+    addresses = []
+    ttl = None
+    for _ in range(ancount):
+        offset = skip_name(message, offset)
+        if offset + 10 > len(message):
+            raise DnsError('truncated answer')
+        rtype, rclass, rttl, rdlength = struct.unpack('!HHIH', message[offset:offset + 10])
+        offset += 10
+        rdata = message[offset:offset + rdlength]
+        offset += rdlength
+        if rclass != CLASS_IN or rtype not in (TYPE_A, TYPE_CNAME):
+            continue
+        # the chain is as old as its shortest lived record
+        ttl = rttl if ttl is None else min(ttl, rttl)
+        if rtype == TYPE_A and rdlength == 4:
+            addresses.append(socket.inet_ntoa(rdata))
+    if not addresses:
+        raise DnsError('no A record')
+    return addresses, ttl
+
+
+class Resolver(object):
+    #   servers : list of (address, port), default : resolv.conf
+    #   hosts : name -> list of addresses, default : /etc/hosts
+    def __init__(self, servers=None, min_ttl=MIN_TTL, max_ttl=MAX_TTL, hosts=None):
+        self.servers = nameservers() if servers is None else list(servers)
+        self.hosts = hosts_file() if hosts is None else hosts
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.cache = {}                 # name -> (addresses, expires (time.monotonic()))
+        self.lock = threading.Lock()    # probes resolve on worker threads
+        self.rand = random.SystemRandom()
+        # statistics
+        self.hits = 0
+        self.queries = 0
+
+    #
+    # ask the name servers (no cache), return (addresses, TTL [sec], RTT [sec])
+    # the cache is updated with the answer
+    #
+    def query(self, name, timeout=5.0):
+        if not self.servers:
+            started = time.monotonic()
+            infos = socket.getaddrinfo(name, None, socket.AF_INET, socket.SOCK_DGRAM)
+            addresses = sorted(set(info[4][0] for info in infos))
+            return self._store(name, addresses, DEFAULT_TTL), DEFAULT_TTL, time.monotonic() - started
+        deadline = time.monotonic() + timeout
+        error = None
+        for server in self.servers:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                addresses, ttl, rtt = self._ask(server, name, remaining)
+            except NxDomainError:
+                raise
+            except (OSError, DnsError) as e:
+                error = e
+                continue
+            ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+            return self._store(name, addresses, ttl), ttl, rtt
+        raise error if error is not None else socket.timeout('DNS query time out : ' + name)
+
+    # addresses of host from the cache, or from the name servers if expired
+    def resolve(self, host, timeout=5.0):
+        if is_address(host):
+            return [host]
+        if host.lower() in self.hosts:
+            return self.hosts[host.lower()]
+        with self.lock:
+            entry = self.cache.get(host)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+        return self.query(host, timeout)[0]
+
+    def _store(self, name, addresses, ttl):
+        with self.lock:
+            self.queries += 1
+            self.cache[name] = (addresses, time.monotonic() + ttl)
+        return addresses
+
+    # one query to one server
+    def _ask(self, server, name, timeout):
+        ident = self.rand.getrandbits(16)
+        query = build_query(name, ident)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect(server)
+            started = time.monotonic()
+            sock.send(query)
+            deadline = started + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout('DNS query time out : {0} @{1}'.format(name, server[0]))
+                sock.settimeout(remaining)
+                message = sock.recv(4096)
+                rtt = time.monotonic() - started
+                if message[:2] != query[:2]:
+                    continue            # late answer of an earlier query, keep waiting
+                addresses, ttl = parse_response(message, ident)
+                return addresses, ttl, rtt
+        finally:
+            sock.close()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import errno
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+#
+# Bulk serial reads for BtComm.recv
+#
+# comm.read() (one byte) makes one system call and one Python loop per byte, and
+# blocks for the whole port timeout (10-30 sec.) if nothing arrives.
+# ChunkReader reads everything the driver already has (in_waiting) in one call,
+# and otherwise waits (select on the port) for the first byte only until the recv
+# deadline.  The port timeout is not changed : setting it reconfigures the port
+# (tcsetattr) every time.
+#
+READ_CHUNK_SIZE = 4096      # max bytes read at once
+
+#
+# Waiting for the serial port
+#
+# The tty does not exist yet at boot, or is unplugged (bt-01 /dev/ttyACM0).  Instead of
+# retrying the open in a busy loop, open_port sleeps until the directory of the tty
+# (/dev) reports a change of that name (inotify : created, renamed, attributes changed
+# by udev), or until the back-off interval (0.1 sec. doubled up to 10 sec.) has passed.
+# Without inotify (not Linux) the back-off alone is used.
+#
+OPEN_RETRY_FIRST = 0.1      # [sec] first back-off interval
+OPEN_RETRY_MAX = 10.0       # [sec] max back-off interval
+
+# inotify (linux/inotify.h)
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')       # wd, mask, cookie, len (name follows)
+
+
+class ChunkReader(object):
+    def __init__(self, comm, max_size=READ_CHUNK_SIZE):
+        self.comm = comm                # pyserial Serial
+        self.max_size = max_size
+
+    # read received bytes, wait not beyond deadline (time.monotonic() value)
+    # nor beyond the port timeout, return b'' if nothing received
+    def read(self, deadline):
+        comm = self.comm
+        waiting = comm.in_waiting
+        if waiting > 0:
+            return comm.read(min(waiting, self.max_size))
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return b''
+        if comm.timeout is not None:
+            remaining = min(remaining, comm.timeout)
+        readable, _, _ = select.select([comm.fileno()], [], [], remaining)
+        if not readable:
+            return b''
+        # bytes arrived (or the device is gone : read raises SerialException)
+        return comm.read(min(max(comm.in_waiting, 1), self.max_size))
+
+
+#
+# wake up when the tty node is created or changed
+#
+class DeviceWatcher(object):
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path).encode()
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            # no libc / no inotify : back-off only
+            return
+        if fd < 0:
+            return
+        directory = os.path.dirname(os.path.abspath(path)).encode()
+        if libc.inotify_add_watch(fd, directory, IN_CREATE | IN_ATTRIB | IN_MOVED_TO) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    # wait until the tty node changes or timeout [sec] passes
+    # return True if woken up by the tty node
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            return False
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if readable and self.changed():
+                return True
+
+    # read inotify events, True if one of them is the tty node
+    def changed(self):
+        found = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return found
+                raise
+            offset = 0
+            while offset + INOTIFY_EVENT.size <= len(data):
+                _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                if data[offset:offset + length].rstrip(b'\0') == self.name:
+                    found = True
+                offset += length
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+#
+# open the port, wait until success
+#   opener       : function opening the port (e.g. serial.Serial(...)), raises OSError if it fails
+#                  (serial.SerialException is an OSError)
+#   max_attempts : give up after this number of attempts (raise the last error), None : forever
+# return (port, attempts, seconds until opened)
+#
+def open_port(path, opener, max_attempts=None, first=OPEN_RETRY_FIRST, maximum=OPEN_RETRY_MAX):
+    started = time.monotonic()
+    attempts = 0
+    interval = first
+    watcher = None
+    try:
+        while True:
+            attempts += 1
+            try:
+                port = opener()
+                return port, attempts, time.monotonic() - started
+            except OSError as e:
+                if max_attempts is not None and attempts >= max_attempts:
+                    raise
+                if attempts == 1:
+                    logging.debug("can't open " + path + " : " + str(e) + ", wait for it")
+            if watcher is None:
+                watcher = DeviceWatcher(path)
+            if not watcher.wait(interval):
+                interval = min(interval * 2, maximum)
+    finally:
+        if watcher is not None:
+            watcher.close()
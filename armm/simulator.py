@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import tty
+import time
+import signal
+import random
+import asyncio
+import argparse
+import datetime
+import collections
+
+from armm import commands
+from armm.codec import FrameDecoder, encode
+
+#
+# ARMM firmware simulator on a pseudo-terminal
+#
+# Opens a pty and answers every command like the bt-01 / bt-11 firmware, so the host
+# programs can be run without ARMM hardware:
+#   python3 -m armm.simulator --model bt-11 --link /tmp/ttyARMM --pace
+#   ARMM_TTY=/tmp/ttyARMM ARMM_LOG=/tmp/BT-log python3 bt-11_host_sample/BT-SerialCommunication.py
+#
+# alive_req -> alive_res, status_req -> status_res (status bytes, contents TBD),
+# time_sync_req -> time_sync_res (echo of date & time), log_req -> one log record per
+# request and 'NO LOG' after the last one, reboot_req -> reboot_res, setting commands ->
+# echo of the value, buttons -> ack, temperature_req -> temperature [deg C] (1 byte),
+# nop -> nop_res, other commands -> unknown_res with the received command as parameter.
+# bt-01 answers unknown_res to the bt-11 only commands (0x05-0x09).
+# Frames with a wrong checksum are ignored.
+#
+# latency : delay [sec] of every response (+ random jitter), responses keep their order
+# pacing  : bytes take 10 bits time (8N1) at the given baud rate in both directions
+#
+LINK = '/tmp/ttyARMM'       # symbolic link to the pty (ARMM_TTY for the host programs)
+LOG_RECORDS = 100           # log records stored at start
+TEMPERATURE = 45            # [deg C]
+STATUS = b'\x00'            # status_res parameter (contents TBD)
+BT11_ONLY = (commands.POWEROFF_TIME_REQ, commands.HEARTBEAT_PERIOD_REQ, commands.POWER_BUTTON_REQ,
+             commands.RESET_BUTTON_REQ, commands.TEMPERATURE_REQ)
+LOG_END = b'NO LOG'
+LOG_EVENTS = (b'POWER ON', b'HEARTBEAT TIMEOUT', b'COLD BOOT', b'TIME SYNC', b'POWER OFF')
+
+
+class ArmmSimulator(object):
+    def __init__(self, model='bt-11', latency=0.0, jitter=0.0, baudrate=0, logs=LOG_RECORDS,
+                 temperature=TEMPERATURE, status=STATUS, reboot_off=0.0, seed=None):
+        self.model = model
+        self.latency = latency
+        self.jitter = jitter
+        self.byte_time = 10.0 / baudrate if baudrate else 0.0     # start + 8 data + stop bits
+        self.temperature = temperature
+        self.status = status
+        self.reboot_off = reboot_off        # [sec] no response after reboot_res (power cycle)
+        self.rand = random.Random(seed)
+        self.decoder = FrameDecoder()
+        self.logstore = collections.deque()
+        self.heartbeat_period = 11
+        self.poweroff_time = 0
+        self.off_until = 0.0
+        # pty
+        self.master = None
+        self.slave = None
+        self.path = None
+        self.link = None
+        # Tx / Rx
+        self.loop = None
+        self.txbuf = bytearray()
+        self.rx_free = 0.0                  # time the Rx line is free (pacing)
+        self.tx_free = 0.0                  # time the Tx line is free (pacing)
+        self.ready = 0.0                    # time the last response is sent
+        # statistics
+        self.requests = collections.Counter()   # command code -> received frames
+        self.responses = 0
+        self.checksum_errors = 0
+        self.ignored = 0                    # frames received while powered off
+        self.rxbytes = 0
+        self.txbytes = 0
+        self.started = time.monotonic()
+        for _ in range(logs):
+            self.record(self.rand.choice(LOG_EVENTS))
+
+    # open pty, slave path is self.path (and link if given)
+    def open(self, link=None):
+        self.master, self.slave = os.openpty()
+        # raw : no echo, no line editing, 0x03 is not an interrupt
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+        if link:
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(self.path, link)
+            self.link = link
+        return self.path
+
+    def close(self):
+        if self.loop is not None and self.master is not None:
+            self.loop.remove_reader(self.master)
+            self.loop.remove_writer(self.master)
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+        if self.link and os.path.islink(self.link):
+            os.remove(self.link)
+        self.link = None
+
+    def start(self, loop=None):
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.loop.add_reader(self.master, self._readable)
+
+    # add one record to the log store
+    def record(self, event):
+        self.logstore.append(datetime.datetime.now().strftime('%y/%m/%d %H:%M:%S ').encode() + event)
+
+    #
+    # received request (valid frame) -> response data (command + parameter), None : no response
+    #
+    def handle(self, frame):
+        code = frame.command
+        parameter = frame.parameter
+        self.requests[code] += 1
+        if self.model == 'bt-01' and code in BT11_ONLY:
+            return bytes((commands.UNKNOWN_RES, code))
+        if code == commands.ALIVE_REQ:
+            return bytes((commands.ALIVE_RES,))
+        if code == commands.STATUS_REQ:
+            return bytes((commands.STATUS_RES,)) + self.status
+        if code == commands.TIME_SYNC_REQ and len(parameter) == 6:
+            self.record(b'TIME SYNC')
+            return bytes((commands.TIME_SYNC_RES,)) + parameter
+        if code == commands.LOG_REQ:
+            record = self.logstore.popleft() if self.logstore else LOG_END
+            return bytes((commands.LOG_RES,)) + record
+        if code == commands.REBOOT_REQ:
+            self.record(b'COLD BOOT')
+            if self.reboot_off > 0:
+                self.off_until = time.monotonic() + self.reboot_off
+            return bytes((commands.REBOOT_RES,))
+        if code == commands.POWEROFF_TIME_REQ and len(parameter) == 1:
+            self.poweroff_time = parameter[0]
+            return bytes((commands.POWEROFF_TIME_RES,)) + parameter
+        if code == commands.HEARTBEAT_PERIOD_REQ and len(parameter) == 1:
+            self.heartbeat_period = parameter[0]
+            return bytes((commands.HEARTBEAT_PERIOD_RES,)) + parameter
+        if code == commands.POWER_BUTTON_REQ:
+            self.record(b'POWER BUTTON')
+            return bytes((commands.POWER_BUTTON_RES,))
+        if code == commands.RESET_BUTTON_REQ:
+            self.record(b'RESET BUTTON')
+            return bytes((commands.RESET_BUTTON_RES,))
+        if code == commands.TEMPERATURE_REQ:
+            return bytes((commands.TEMPERATURE_RES, self.temperature & 0xFF))
+        if code == commands.NOP:
+            return bytes((commands.NOP_RES,))
+        return bytes((commands.UNKNOWN_RES, code))
+
+    #
+    # Rx
+    #
+    def _readable(self):
+        try:
+            data = os.read(self.master, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        self.rxbytes += len(data)
+        if not self.byte_time:
+            self._received(data)
+            return
+        # pacing : data is received when its last byte has arrived at the baud rate
+        now = self.loop.time()
+        self.rx_free = max(now, self.rx_free) + len(data) * self.byte_time
+        self.loop.call_at(self.rx_free, self._received, data)
+
+    def _received(self, data):
+        for frame in self.decoder.feed(data):
+            if not frame.valid:
+                self.checksum_errors += 1
+                continue
+            if time.monotonic() < self.off_until:
+                self.ignored += 1
+                continue
+            response = self.handle(frame)
+            if response is None:
+                continue
+            delay = self.latency + (self.rand.uniform(0.0, self.jitter) if self.jitter else 0.0)
+            # firmware answers in order : a response is not sent before the previous one
+            self.ready = max(self.loop.time() + delay, self.ready)
+            self.loop.call_at(self.ready, self._send, encode(response))
+
+    #
+    # Tx
+    #
+    def _send(self, frame):
+        self.responses += 1
+        if not self.byte_time:
+            self._write(frame)
+            return
+        # pacing : one byte every byte time
+        start = max(self.loop.time(), self.tx_free)
+        for i in range(len(frame)):
+            self.loop.call_at(start + i * self.byte_time, self._write, frame[i:i + 1])
+        self.tx_free = start + len(frame) * self.byte_time
+
+    def _write(self, data):
+        if self.master is None:
+            return
+        self.txbuf += data
+        self._flush()
+
+    def _flush(self):
+        try:
+            written = os.write(self.master, self.txbuf)
+            del self.txbuf[:written]
+            self.txbytes += written
+        except (BlockingIOError, InterruptedError):
+            pass
+        if self.txbuf:
+            self.loop.add_writer(self.master, self._flush)
+        else:
+            self.loop.remove_writer(self.master)
+
+    def __str__(self):
+        elapsed = time.monotonic() - self.started
+        counts = ', '.join('{0} {1}'.format(commands.name(code), count)
+                           for code, count in sorted(self.requests.items()))
+        return ('{0:.0f} sec. : {1} responses ({2:.2f}/s), rx {3} bytes, tx {4} bytes, '
+                'checksum errors {5}, ignored {6}, logs left {7} [{8}]').format(
+            elapsed, self.responses, self.responses / elapsed if elapsed > 0 else 0.0,
+            self.rxbytes, self.txbytes, self.checksum_errors, self.ignored, len(self.logstore), counts)
+
+
+async def report(simulator, period):
+    while True:
+        await asyncio.sleep(period)
+        print(simulator, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ARMM firmware simulator on a pseudo-terminal')
+    parser.add_argument('--model', choices=('bt-01', 'bt-11'), default='bt-11')
+    parser.add_argument('--link', default=LINK, help='symbolic link to the pty (default ' + LINK + ')')
+    parser.add_argument('--latency', type=float, default=0.0, help='[sec] response delay')
+    parser.add_argument('--jitter', type=float, default=0.0, help='[sec] random delay added to latency')
+    parser.add_argument('--pace', action='store_true', help='pace bytes at 1200 baud')
+    parser.add_argument('--baudrate', type=int, default=0, help='pace bytes at this baud rate')
+    parser.add_argument('--logs', type=int, default=LOG_RECORDS, help='log records stored at start')
+    parser.add_argument('--temperature', type=int, default=TEMPERATURE, help='[deg C]')
+    parser.add_argument('--reboot-off', type=float, default=0.0,
+                        help='[sec] no response after reboot_res (power cycle)')
+    parser.add_argument('--seed', type=int, help='random seed (log records, jitter)')
+    parser.add_argument('--report', type=float, default=0.0, help='[sec] print statistics period')
+    args = parser.parse_args()
+
+    baudrate = args.baudrate or (1200 if args.pace else 0)
+    simulator = ArmmSimulator(args.model, args.latency, args.jitter, baudrate, args.logs,
+                              args.temperature, reboot_off=args.reboot_off, seed=args.seed)
+    path = simulator.open(args.link)
+    print('ARMM simulator ({0}) on {1} -> {2}'.format(args.model, args.link, path), flush=True)
+
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    simulator.start(loop)
+    if args.report > 0:
+        asyncio.ensure_future(report(simulator, args.report))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(simulator, flush=True)
+        simulator.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import time
+import struct
+import asyncio
+import threading
+
+#
+# ARMM status (status_req / status_res) : decoder & last known status cache
+#
+# The contents of status_res are not defined yet (TBD in the command table), so a Status
+# keeps the parameter bytes as received and the fields of FIELDS found in them : when the
+# format is defined, only FIELDS changes.  A field beyond the end of the parameter is None.
+#
+# StatusCache keeps the last status received.  read() returns it while it is younger than
+# max_age and sends status_req only when it is older, so the users of the status (metrics,
+# statistics, state machine) share one request on the 1200 baud link.  Concurrent readers
+# of a stale status wait for the one request in flight instead of sending their own.
+#
+# field : (name, offset in the parameter, struct format)
+FIELDS = (
+    ('flags', 0, 'B'),          # first byte (contents TBD)
+)
+STATUS_MAX_AGE = 300.0      # [sec]
+
+
+class Status(object):
+    __slots__ = ('raw', 'fields', 'at', 'monotonic')
+
+    def __init__(self, raw, fields, at=None, monotonic=None):
+        self.raw = raw                  # status_res parameter (bytes)
+        self.fields = fields            # name -> value (None : not in the parameter)
+        self.at = time.time() if at is None else at
+        self.monotonic = time.monotonic() if monotonic is None else monotonic
+
+    # [sec] since received
+    def age(self):
+        return time.monotonic() - self.monotonic
+
+    def __getitem__(self, name):
+        return self.fields[name]
+
+    def to_dict(self):
+        return {'raw': self.raw.hex(), 'fields': dict(self.fields), 'at': self.at}
+
+    def __str__(self):
+        return ', '.join('{0} {1}'.format(name, value) for name, value in self.fields.items()) + \
+            ' (raw ' + (self.raw.hex() or '-') + ')'
+
+
+# status_res parameter -> Status
+def decode_status(parameter, fields=FIELDS):
+    raw = bytes(parameter)
+    values = {}
+    for name, offset, form in fields:
+        size = struct.calcsize('<' + form)
+        if offset + size <= len(raw):
+            values[name] = struct.unpack_from('<' + form, raw, offset)[0]
+        else:
+            values[name] = None
+    return Status(raw, values)
+
+
+class StatusCache(object):
+    def __init__(self, max_age=STATUS_MAX_AGE):
+        self.max_age = max_age
+        self.status = None          # last status received
+        self.lock = threading.Lock()
+        self.fetching = threading.Lock()    # one status_req in flight (threads)
+        self.async_fetching = None          # one status_req in flight (asyncio, made in the loop)
+        # statistics
+        self.hits = 0               # read() answered from the cache
+        self.requests = 0           # status_req sent
+        self.failures = 0           # no status_res
+
+    # status younger than max_age (default self.max_age), None if there is none
+    def get(self, max_age=None):
+        max_age = self.max_age if max_age is None else max_age
+        with self.lock:
+            status = self.status
+        if status is not None and status.age() <= max_age:
+            return status
+        return None
+
+    def update(self, status):
+        if status is not None:
+            with self.lock:
+                self.status = status
+
+    def clear(self):
+        with self.lock:
+            self.status = None
+
+    #
+    # status younger than max_age, else fetch() (sends status_req : Status or None)
+    #   no response : the last known status (older) or None
+    #
+    def read(self, fetch, max_age=None):
+        status = self.get(max_age)
+        if status is not None:
+            self.hits += 1
+            return status
+        started = time.monotonic()
+        with self.fetching:
+            # received by the request of another thread while waiting ?
+            status = self._since(started)
+            if status is not None:
+                self.hits += 1
+                return status
+            return self._fetched(fetch())
+
+    # same as read, fetch : coroutine function
+    async def read_async(self, fetch, max_age=None):
+        status = self.get(max_age)
+        if status is not None:
+            self.hits += 1
+            return status
+        if self.async_fetching is None:
+            self.async_fetching = asyncio.Lock()
+        started = time.monotonic()
+        async with self.async_fetching:
+            status = self._since(started)
+            if status is not None:
+                self.hits += 1
+                return status
+            return self._fetched(await fetch())
+
+    # status received after `started` (time.monotonic()), None if there is none
+    def _since(self, started):
+        with self.lock:
+            status = self.status
+        if status is not None and status.monotonic >= started:
+            return status
+        return None
+
+    def _fetched(self, status):
+        self.requests += 1
+        if status is None:
+            self.failures += 1
+            with self.lock:
+                return self.status
+        self.update(status)
+        return status
+
+    # JSON serializable
+    def snapshot(self):
+        with self.lock:
+            status = self.status
+        snapshot = {'hits': self.hits, 'requests': self.requests, 'failures': self.failures,
+                    'max_age': self.max_age, 'status': None, 'age': None}
+        if status is not None:
+            snapshot['status'] = status.to_dict()
+            snapshot['age'] = round(status.age(), 3)
+        return snapshot
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import mmap
+import time
+import struct
+import argparse
+import datetime
+import threading
+
+from armm.logquery import parse_when
+
+#
+# ARMM temperature telemetry (bt-11 temperature_req / temperature_res)
+#
+# Readings are kept in a fixed size file, mapped with mmap, of rings of slots, one ring per
+# tier.  A slot is the min / max / sum / count of the readings of one bucket of `period`
+# seconds :
+#   raw  : 1 min. buckets (one reading each) for 12 hours
+#   5min : 5 min. buckets for 7 days
+#   1h   : 1 hour buckets for 12 weeks
+# Every reading is added to the current bucket of every tier (the slot at the head of the
+# ring, updated in place), the head moves to the next slot when a new bucket starts and the
+# oldest bucket is overwritten.  The file never grows (74 KiB), a query reads at most one
+# ring, and the current buckets survive a restart of the program.  The map is written back
+# by the kernel, msync is done at most every SYNC_INTERVAL (as armm.journal) and at close.
+#
+#   file   : header (HEADER_SIZE bytes) + rings
+#   header : magic, version, number of tiers, per tier : period [sec], slots, head
+#   slot   : start of the bucket (unix time, 0 : empty), min, max [deg C], sum [deg C], count
+#
+#   python3 -m armm.temperature /home/nvidia/bt-11/BT-temperature.bin --since 2d
+#
+MAGIC = b'ARMMTEMP'
+VERSION = 1
+HEADER = struct.Struct('<8sII')
+TIER = struct.Struct('<III')
+HEADER_SIZE = 64
+SLOT = struct.Struct('<IhhiI')
+TIERS = (
+    ('raw', 60, 720),       # 12 hours
+    ('5min', 300, 2016),    # 7 days
+    ('1h', 3600, 2016),     # 12 weeks
+)
+TEMPERATURE_PERIOD = 60     # [sec] one reading per raw bucket
+SYNC_INTERVAL = 600.0       # [sec] msync at most this often (None : never, left to the kernel)
+
+
+# temperature_res parameter -> [deg C] (signed byte), None if no value
+def decode(parameter):
+    if len(parameter) < 1:
+        return None
+    return struct.unpack('<b', bytes(parameter[:1]))[0]
+
+
+class TemperatureLog(object):
+    def __init__(self, filename, tiers=TIERS, sync_interval=SYNC_INTERVAL):
+        self.filename = filename
+        self.tiers = tiers
+        self.sync_interval = sync_interval
+        self.last_sync = time.monotonic()
+        self.lock = threading.Lock()    # sampler (state machine thread) & readers (metrics)
+        self.f = None
+        self.map = None
+        self.heads = [0] * len(tiers)
+        self.offsets = []               # file offset of every ring
+        offset = HEADER_SIZE
+        for _, _, slots in tiers:
+            self.offsets.append(offset)
+            offset += slots * SLOT.size
+        self.size = offset
+        self.last = None                # (time, deg C) of the last reading
+
+    #
+    # open (create) the file, a file of another format or layout is started again
+    #   readonly : the file is not changed (ValueError if it is not a temperature file)
+    #
+    def open(self, readonly=False):
+        if readonly:
+            self.f = open(self.filename, 'rb')
+            if os.fstat(self.f.fileno()).st_size != self.size:
+                raise ValueError('not a temperature file : ' + self.filename)
+            self.map = mmap.mmap(self.f.fileno(), self.size, access=mmap.ACCESS_READ)
+        else:
+            fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+            self.f = os.fdopen(fd, 'r+b')
+            if os.fstat(fd).st_size != self.size:
+                self.f.truncate(0)
+                self.f.truncate(self.size)
+            self.map = mmap.mmap(fd, self.size)
+        if self._layout() == [(period, slots) for _, period, slots in self.tiers]:
+            self.heads = [TIER.unpack_from(self.map, HEADER.size + i * TIER.size)[2] for i in range(len(self.tiers))]
+        elif readonly:
+            raise ValueError('not a temperature file : ' + self.filename)
+        else:
+            self.map[:self.size] = bytes(self.size)
+            self.heads = [0] * len(self.tiers)
+            self._write_header()
+        return self
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.flush()
+                self.map.close()
+                self.map = None
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+    # (period, slots) of every tier in the file, None if not a temperature file
+    def _layout(self):
+        magic, version, count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or HEADER.size + count * TIER.size > HEADER_SIZE:
+            return None
+        layout = []
+        for i in range(count):
+            period, slots, head = TIER.unpack_from(self.map, HEADER.size + i * TIER.size)
+            if head >= max(slots, 1):
+                return None
+            layout.append((period, slots))
+        return layout
+
+    def _write_header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, len(self.tiers))
+        for i, (_, period, slots) in enumerate(self.tiers):
+            TIER.pack_into(self.map, HEADER.size + i * TIER.size, period, slots, self.heads[i])
+
+    def _slot(self, tier, index):
+        return SLOT.unpack_from(self.map, self.offsets[tier] + index * SLOT.size)
+
+    # one reading [deg C], at (unix time) : now
+    def add(self, value, at=None):
+        at = int(time.time() if at is None else at)
+        with self.lock:
+            self.last = (at, value)
+            if self.map is None:
+                return
+            for tier, (_, period, slots) in enumerate(self.tiers):
+                start = at - at % period
+                head = self.heads[tier]
+                bucket, low, high, total, count = self._slot(tier, head)
+                if bucket != start:
+                    if bucket:
+                        head = self.heads[tier] = (head + 1) % slots
+                    low, high, total, count = value, value, 0, 0
+                SLOT.pack_into(self.map, self.offsets[tier] + head * SLOT.size,
+                               start, min(low, value), max(high, value), total + value, count + 1)
+            self._write_header()
+            if self.sync_interval is not None and time.monotonic() - self.last_sync >= self.sync_interval:
+                self.map.flush()
+                self.last_sync = time.monotonic()
+
+    #
+    # buckets of tier (name), oldest first : list of (start, min, mean, max, count)
+    #   since, until : unix time, the buckets starting in [since, until)
+    #
+    def series(self, name, since=None, until=None):
+        tier = [t[0] for t in self.tiers].index(name)
+        slots = self.tiers[tier][2]
+        with self.lock:
+            if self.map is None:
+                return []
+            head = self.heads[tier]
+            raw = [self._slot(tier, (head + 1 + i) % slots) for i in range(slots)]
+        result = []
+        for start, low, high, total, count in raw:
+            if not start or not count:
+                continue
+            if (since is not None and start < since) or (until is not None and start >= until):
+                continue
+            result.append((start, low, total / count, high, count))
+        result.sort()
+        return result
+
+    # finest tier holding buckets since `since` (unix time)
+    def tier_for(self, since):
+        now = time.time()
+        for name, period, slots in self.tiers:
+            if since is None or now - since <= period * (slots - 1):
+                return name
+        return self.tiers[-1][0]
+
+    def __str__(self):
+        if self.last is None:
+            return 'no reading'
+        return 'last {0} deg C at {1}'.format(self.last[1], datetime.datetime.fromtimestamp(self.last[0]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='print the ARMM temperature trend')
+    parser.add_argument('filename', help='temperature file (e.g. /home/nvidia/bt-11/BT-temperature.bin)')
+    parser.add_argument('--since', help="start time : 'YYYY-mm-dd HH:MM[:SS]', 'HH:MM' or '2h' ago (default 12h)")
+    parser.add_argument('--until', help='end time (not included), same formats')
+    parser.add_argument('--tier', choices=[t[0] for t in TIERS], help='default : finest tier holding --since')
+    args = parser.parse_args()
+
+    try:
+        since = parse_when(args.since or '12h')
+        until = parse_when(args.until) if args.until else None
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    log = TemperatureLog(args.filename)
+    try:
+        log.open(readonly=True)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+    try:
+        name = args.tier or log.tier_for(since)
+        for start, low, mean, high, count in log.series(name, since, until):
+            print('{0} {1:>4} min {2:4d} mean {3:6.1f} max {4:4d} ({5} readings)'.format(
+                datetime.datetime.fromtimestamp(start), name, low, mean, high, count))
+    except BrokenPipeError:
+        # output closed (e.g. | head)
+        sys.stderr.close()
+    finally:
+        log.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
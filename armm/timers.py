@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+import time
+import heapq
+import datetime
+import threading
+import collections
+
+from armm.latency import Histogram
+
+#
+# Deadline driven timer scheduler
+#
+# Jobs are kept in a heap ordered by their due time (time.monotonic()), and run_next()
+# sleeps exactly until the first one is due, instead of waking up every 10 sec. to compare
+# time.time() deltas and call schedule.run_pending().
+#   every(seconds, ...)  : periodic job.  If the job returns a number, the next run is that
+#                          many seconds after it finished (e.g. heartbeat retry), otherwise
+#                          one period after the previous due time (no drift).
+#   daily('HH:MM', ...)  : every day at local time.  The due time is taken again from the
+#                          wall clock at every wake up, so RTC / NTP clock changes are followed.
+# Lateness (start of the run - due time) of every job is recorded in a histogram.
+# post(func, ...) is for other threads (e.g. probe results) : func runs on the thread
+# calling run_next(), which wakes up at once.
+#
+MAX_SLEEP = 3600.0          # [sec] wake up at least every hour (daily jobs follow clock changes)
+
+
+class Job(object):
+    def __init__(self, name, func, args, period=None, at=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.period = period            # [sec] periodic job
+        self.at = at                    # 'HH:MM' daily job
+        self.next_at = None             # daily job : next run (datetime, local time)
+        self.due = 0.0                  # time.monotonic() of the next run
+        self.entry = 0                  # sequence number of the heap entry in use
+        self.cancelled = False
+        # statistics
+        self.runs = 0
+        self.lateness = Histogram()     # [sec] start of run - due time
+        self.last_lateness = None
+
+    # daily job : next HH:MM after `now` (datetime)
+    def next_daily(self, now):
+        hour, minute = [int(x) for x in self.at.split(':')]
+        at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if at <= now:
+            at += datetime.timedelta(days=1)
+        return at
+
+    # daily job : monotonic due time from the wall clock
+    def refresh(self, monotonic, now):
+        self.due = monotonic + max(0.0, (self.next_at - now).total_seconds())
+
+    def to_dict(self):
+        summary = self.lateness.to_dict()
+        summary['runs'] = self.runs
+        summary['last_ms'] = None if self.last_lateness is None else round(self.last_lateness * 1000.0, 3)
+        return summary
+
+
+class TimerScheduler(object):
+    def __init__(self):
+        self.heap = []                  # (due, sequence, job), stale entries are skipped
+        self.sequence = 0
+        self.jobs = {}                  # name -> Job
+        self.posted = collections.deque()   # (func, args) posted by other threads
+        self.wakeup = threading.Event()
+
+    # periodic job, first run after `first` [sec] (default : one period)
+    # a job with the same name is replaced
+    def every(self, seconds, name, func, *args, first=None):
+        job = Job(name, func, args, period=seconds)
+        self._add(job)
+        self._push(job, time.monotonic() + (seconds if first is None else first))
+        return job
+
+    # daily job at 'HH:MM' (local time)
+    def daily(self, hhmm, name, func, *args):
+        job = Job(name, func, args, at=hhmm)
+        now = datetime.datetime.now()
+        job.next_at = job.next_daily(now)
+        job.refresh(time.monotonic(), now)
+        self._add(job)
+        self._push(job, job.due)
+        return job
+
+    def cancel(self, name):
+        job = self.jobs.pop(name, None)
+        if job is not None:
+            job.cancelled = True
+
+    def clear(self):
+        for job in self.jobs.values():
+            job.cancelled = True
+        self.jobs.clear()
+        self.heap = []
+        self.posted.clear()
+
+    # run a job after `seconds` instead of its normal time
+    def reschedule(self, name, seconds):
+        job = self.jobs[name]
+        if job.at is not None:
+            # daily job : due time is taken from next_at at every wake up
+            job.next_at = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+        self._push(job, time.monotonic() + seconds)
+        self.wakeup.set()
+
+    # run func(*args) on the scheduler thread as soon as possible (thread safe)
+    def post(self, func, *args):
+        self.posted.append((func, args))
+        self.wakeup.set()
+
+    # [sec] until the next job is due (None : no job)
+    def next_delay(self):
+        self._drop_stale()
+        if not self.heap:
+            return None
+        return max(0.0, self.heap[0][0] - time.monotonic())
+
+    # sleep until the next job is due (or wakeup is set) & run posted functions and all due jobs
+    # return number of jobs & posted functions run
+    def run_next(self, max_sleep=MAX_SLEEP):
+        self._refresh_daily()
+        delay = self.next_delay()
+        if delay is None or delay > max_sleep:
+            delay = max_sleep
+        if delay > 0 and not self.posted:
+            self.wakeup.wait(delay)
+            self._refresh_daily()
+        self.wakeup.clear()
+        return self.run_posted() + self.run_pending()
+
+    # run functions posted by other threads
+    def run_posted(self):
+        count = 0
+        while self.posted:
+            func, args = self.posted.popleft()
+            func(*args)
+            count += 1
+        return count
+
+    # run all due jobs in due time order
+    def run_pending(self):
+        count = 0
+        while True:
+            self._drop_stale()
+            if not self.heap or self.heap[0][0] > time.monotonic():
+                return count
+            due, _, job = heapq.heappop(self.heap)
+            self._run(job, due)
+            count += 1
+
+    # lateness of every job (JSON serializable)
+    def snapshot(self):
+        return dict((name, job.to_dict()) for name, job in sorted(self.jobs.items()))
+
+    # one line per job for the log
+    def lines(self):
+        result = []
+        for name, entry in self.snapshot().items():
+            if entry['count']:
+                result.append('{0} : {1} runs, lateness p50 {2:.1f} ms, p99 {3:.1f} ms, max {4:.1f} ms'.format(
+                    name, entry['runs'], entry['p50_ms'], entry['p99_ms'], entry['max_ms']))
+            else:
+                result.append('{0} : not run yet'.format(name))
+        return result
+
+    def _add(self, job):
+        old = self.jobs.get(job.name)
+        if old is not None:
+            old.cancelled = True
+        self.jobs[job.name] = job
+
+    # new heap entry for job, its older entries become stale
+    def _push(self, job, due):
+        self.sequence += 1
+        job.entry = self.sequence
+        job.due = due
+        heapq.heappush(self.heap, (due, self.sequence, job))
+
+    def _drop_stale(self):
+        while self.heap and (self.heap[0][2].cancelled or self.heap[0][1] != self.heap[0][2].entry):
+            heapq.heappop(self.heap)
+
+    # daily jobs : due time again from the wall clock
+    def _refresh_daily(self):
+        monotonic = time.monotonic()
+        now = datetime.datetime.now()
+        changed = False
+        for index, (due, sequence, job) in enumerate(self.heap):
+            if job.at is not None and sequence == job.entry:
+                job.refresh(monotonic, now)
+                if job.due != due:
+                    self.heap[index] = (job.due, sequence, job)
+                    changed = True
+        if changed:
+            heapq.heapify(self.heap)
+
+    def _run(self, job, due):
+        entry = job.entry
+        if job.at is not None:
+            lateness = (datetime.datetime.now() - job.next_at).total_seconds()
+        else:
+            lateness = time.monotonic() - due
+        job.runs += 1
+        job.last_lateness = lateness
+        job.lateness.record(max(0.0, lateness))
+        result = None
+        try:
+            result = job.func(*job.args)
+        finally:
+            # next run, unless cancelled or rescheduled by the job itself
+            if not job.cancelled and job.entry == entry:
+                if job.at is not None:
+                    now = datetime.datetime.now()
+                    job.next_at = job.next_daily(max(now, job.next_at))
+                    job.refresh(time.monotonic(), now)
+                    due = job.due
+                elif isinstance(result, (int, float)) and not isinstance(result, bool):
+                    due = time.monotonic() + result
+                else:
+                    due += job.period
+                    if due < time.monotonic():
+                        # late more than one period : do not run again at once
+                        due = time.monotonic() + job.period
+                self._push(job, due)
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import platform
+import datetime
+
+# armm shared modules at the top of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from armm import commands
+from armm.codec import MAX_PARAMETER_LENGTH, FrameDecoder, decode, encode
+
+#
+# Frame encode / decode micro-benchmark
+#
+# Runs the encode & decode paths of BtComm.send / recv over the ARMM command set
+# without serial hardware and prints ns/frame and MB/s (frame bytes on the wire) for
+# each implementation:
+#   legacy  : per-byte loops of the original BtComm.send / recv (kept here for comparison)
+#   codec   : armm.codec.encode / decode
+#   stream  : armm.codec.FrameDecoder.feed (frames as received by the reader)
+#
+# Results are written as JSON (--output) and can be compared with a previous run
+# (--compare) to find regressions between versions.
+#
+#   python3 benchmarks/bench_codec.py --output bench_codec.json
+#   python3 benchmarks/bench_codec.py --compare bench_codec.json
+#
+DLE = bytearray([0x10])
+STX = bytearray([0x02])
+ETX = bytearray([0x03])
+
+SEED = 20231116             # payloads are the same for every run
+MIN_TIME = 0.2              # [sec] minimum time of one measurement
+REPEAT = 5                  # measurements per case, best one is reported
+REGRESSION = 1.10           # --compare : slower than 110% of the previous run
+
+
+#
+# original BtComm.send : checksum & 0x10 escape byte by byte
+#
+def legacy_encode(data):
+    sendbytesnoescape = bytearray()
+    num_sum = 0
+    for i in data:
+        num_sum = num_sum + i
+        sendbytesnoescape.append(i)
+    csum = num_sum & 0xFF
+    sendbytesnoescape.append(csum)
+    sendbytesescape = bytearray()
+    for i in sendbytesnoescape:
+        sendbytesescape.append(i)
+        if i == 0x10:
+            sendbytesescape.append(i)
+    return DLE + STX + sendbytesescape + DLE + ETX
+
+
+#
+# original BtComm.recv after a frame is received : escape removal & checksum byte by byte
+# (the escape condition is kept as it was written)
+#
+def legacy_decode(frame):
+    recvData = bytearray()
+    recvData.extend(frame)
+    if recvData.find(b'\x10\x03') < 0:
+        return None
+    recvCommand = recvData[2]
+    recvdataforescapesequence = recvData[2:-3]
+    recvChecksumByte = recvData[-3]
+    afterEscapeSequence = bytearray()
+    pnum = 0
+    for num in recvdataforescapesequence:
+        if pnum == 0x10 & num == 0x10:
+            pnum = 0
+            continue
+        else:
+            pnum = num
+            afterEscapeSequence.append(num)
+    num_sum = 0
+    for num in afterEscapeSequence:
+        num_sum += num
+    checksumbyte = num_sum & 0xFF
+    return recvCommand, afterEscapeSequence, recvChecksumByte, checksumbyte == recvChecksumByte
+
+
+def codec_decode(frame):
+    return decode(frame)
+
+
+def stream_decode(frame, decoder=FrameDecoder()):
+    return decoder.feed(frame)
+
+
+ENCODERS = (('legacy', legacy_encode), ('codec', encode))
+DECODERS = (('legacy', legacy_decode), ('codec', codec_decode), ('stream', stream_decode))
+
+
+#
+# payloads : list of command + parameter (bytes)
+#
+def command_set():
+    # every command without parameter, and the commands with parameter as sent by BtComm
+    payloads = [bytes((code,)) for code in sorted(commands.NAMES)]
+    payloads.append(bytes((commands.TIME_SYNC_REQ, 0x23, 0x11, 0x16, 0x01, 0x55, 0x00)))
+    payloads.append(bytes((commands.POWEROFF_TIME_REQ, 0)))
+    payloads.append(bytes((commands.HEARTBEAT_PERIOD_REQ, 4)))
+    return payloads
+
+
+def random_payloads(size, count=64):
+    rand = random.Random(SEED + size)
+    return [bytes((commands.LOG_RES,)) + bytes(rand.getrandbits(8) for _ in range(size))
+            for _ in range(count)]
+
+
+# worst case : parameter is all 0x10, doubled by escape
+def dle_payloads(size):
+    return [bytes((commands.LOG_RES,)) + b'\x10' * size]
+
+
+# log_res records like an ARMM log dump : time stamp, event, counters (binary), 'NO LOG' at the end
+def log_dump(count=200):
+    rand = random.Random(SEED)
+    events = (b'POWER ON', b'HEARTBEAT TIMEOUT', b'COLD BOOT', b'ALIVE', b'TIME SYNC',
+              b'POWER OFF', b'RESET BUTTON', b'TEMPERATURE')
+    at = datetime.datetime(2023, 11, 16, 2, 0, 0)
+    payloads = []
+    for i in range(count):
+        at += datetime.timedelta(seconds=rand.randint(1, 600))
+        record = (at.strftime('%y/%m/%d %H:%M:%S ').encode() + rand.choice(events) +
+                  b' ' + bytes(rand.getrandbits(8) for _ in range(rand.randint(4, 16))))
+        payloads.append(bytes((commands.LOG_RES,)) + record)
+    payloads.append(bytes((commands.LOG_RES,)) + b'NO LOG')
+    return payloads
+
+
+def cases():
+    yield 'commands', command_set()
+    for size in (0, 1, 16, 64, MAX_PARAMETER_LENGTH):
+        yield 'random-{0}'.format(size), random_payloads(size)
+    for size in (16, MAX_PARAMETER_LENGTH):
+        yield 'dle-{0}'.format(size), dle_payloads(size)
+    yield 'log_res', log_dump()
+
+
+#
+# best ns/frame of REPEAT measurements, each at least MIN_TIME
+#
+def measure(function, items, min_time=MIN_TIME, repeat=REPEAT):
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            for item in items:
+                function(item)
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        loops *= 2 if elapsed <= 0 else max(2, int(min_time / elapsed * 1.2))
+    best = elapsed
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            for item in items:
+                function(item)
+        best = min(best, time.perf_counter() - started)
+    return best / (loops * len(items)) * 1e9
+
+
+# check that all implementations agree before measuring them
+def verify(name, payloads):
+    for data in payloads:
+        frame = encode(data)
+        if legacy_encode(data) != frame:
+            raise AssertionError(name + ' : encode differs from legacy : ' + data.hex())
+        command, parameter, _, valid = decode(frame)
+        if not valid or bytes((command,)) + bytes(parameter) != data:
+            raise AssertionError(name + ' : decode does not round trip : ' + data.hex())
+        decoded = FrameDecoder().feed(frame)
+        if len(decoded) != 1 or decoded[0].data() != data or not decoded[0].valid:
+            raise AssertionError(name + ' : FrameDecoder does not round trip : ' + data.hex())
+
+
+def run(min_time=MIN_TIME, repeat=REPEAT, only=None):
+    results = []
+    for name, payloads in cases():
+        if only and name not in only:
+            continue
+        verify(name, payloads)
+        frames = [encode(data) for data in payloads]
+        wire = sum(len(frame) for frame in frames) / len(frames)
+        for op, implementations, items in (('encode', ENCODERS, payloads), ('decode', DECODERS, frames)):
+            for impl, function in implementations:
+                ns = measure(function, items, min_time, repeat)
+                results.append({
+                    'case': name,
+                    'op': op,
+                    'impl': impl,
+                    'frames': len(items),
+                    'frame_bytes': round(wire, 1),
+                    'ns_per_frame': round(ns, 1),
+                    'mb_per_s': round(wire / ns * 1e3, 3),
+                })
+    return results
+
+
+def environment():
+    return {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'system': platform.platform(),
+    }
+
+
+def key(result):
+    return result['case'], result['op'], result['impl']
+
+
+def report(results, previous=None):
+    before = {}
+    if previous is not None:
+        before = dict((key(r), r) for r in previous['results'])
+    print('{0:<12} {1:<7} {2:<7} {3:>10} {4:>12} {5:>10}  {6}'.format(
+        'case', 'op', 'impl', 'bytes', 'ns/frame', 'MB/s', 'vs previous' if before else ''))
+    regressions = []
+    for r in results:
+        change = ''
+        old = before.get(key(r))
+        if old is not None:
+            ratio = r['ns_per_frame'] / old['ns_per_frame']
+            change = '{0:+.1f}%'.format((ratio - 1) * 100)
+            if ratio > REGRESSION:
+                change += ' SLOWER'
+                regressions.append(r)
+        print('{0:<12} {1:<7} {2:<7} {3:>10} {4:>12.1f} {5:>10.3f}  {6}'.format(
+            r['case'], r['op'], r['impl'], r['frame_bytes'], r['ns_per_frame'], r['mb_per_s'], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ARMM frame codec micro-benchmark')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of a previous run; exit 1 on regression')
+    parser.add_argument('--min-time', type=float, default=MIN_TIME, help='[sec] per measurement')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='measurements per case')
+    parser.add_argument('--case', action='append', help='run only this case (repeatable)')
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    results = run(args.min_time, args.repeat, args.case)
+    regressions = report(results, previous)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+            f.write('\n')
+    if regressions:
+        print('{0} regression(s) over {1:.0f}%'.format(len(regressions), (REGRESSION - 1) * 100))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
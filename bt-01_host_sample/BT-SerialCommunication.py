@@ -3,15 +3,33 @@
 import time
 import threading
 import os
-import shutil
+import sys
+import signal
+import collections
+import concurrent.futures
 
 import logging
-import subprocess
 import datetime
 
-import schedule
 import serial
 
+# armm shared modules : next to this file (installed) or at the top of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from armm.serialio import ChunkReader, open_port
+from armm.codec import FrameDecoder, encode
+from armm.link import BtLink
+from armm.logpull import pull_logs
+from armm.latency import LinkStats
+from armm.timers import TimerScheduler
+from armm.logwriter import LogWriter
+from armm.logrotate import LogRotator
+from armm.journal import FrameJournal
+from armm.probes import ProbeRunner, default_probes, log_results
+from armm.health import NetworkHealth
+from armm.status import StatusCache, decode_status
+from armm.metrics import Metrics, MetricsServer, TextfileWriter, link_samples, timer_samples, health_samples, \
+    status_samples, count_state, count_probes, count_log_pull
+
 # State
 STATE_POWERON = 0       # Power on
 STATE_WAIT4BT01 = 1     # Wait for BT-01 is alive
@@ -46,23 +64,91 @@ CMD_UNKNOWN_RES = bytearray([0xFF])     # B2A/A2B   : Received unknown command
 # Serial communication parameters
 #
 # FIXME: set /dev/tty
-DEVTTYNAME = '/dev/ttyACM0'   # Serial Port tty
+#   ARMM_TTY overrides the tty, e.g. the pty of the ARMM simulator (python3 -m armm.simulator)
+DEVTTYNAME = os.environ.get('ARMM_TTY', '/dev/ttyACM0')   # Serial Port tty
 BAUDRATE = '115200'           # Serial Port Baud Rate
 
 #
 # Logging
 #
 # FIXME: log should be append to /ver/log/syslog
-loggingFileName = '/home/nvidia/bt-01/BT-log'
+# ARMM_LOG overrides the file name
+loggingFileName = os.environ.get('ARMM_LOG', '/home/nvidia/bt-01/BT-log')
 formatter = '%(asctime)s : %(levelname)s : %(message)s'
+# writelog, logging and ARMM log records are queued and written by one thread & file handle
+LOG_FLUSH_INTERVAL = 1.0    # [sec] queued lines are written at least every second
+LOG_FSYNC_INTERVAL = 60     # [sec] fsync at most every minute (None : never)
+logwriter = LogWriter(loggingFileName, LOG_FLUSH_INTERVAL, LOG_FSYNC_INTERVAL)
+# daily rotation : BT-log -> BT-log.1 (renamed) & compressed in background, .1 - .7 kept
+LOG_KEEP = 7                # generations
+LOG_MAX_BYTES = 64 << 20    # total bytes of the generations
+LOG_COMPRESSION = 'auto'    # zstd if the zstandard module is installed, else gzip
+rotator = LogRotator(loggingFileName, LOG_KEEP, LOG_MAX_BYTES, LOG_COMPRESSION)
+
+#
+# Link statistics
+#
+# round trip latency of every command (p50/p95/p99/max), time outs, checksum errors and
+# unexpected frames, written as JSON every STATS_PERIOD and on SIGUSR1 (kill -USR1 <pid>)
+# ARMM_STATS overrides the file name
+statsFileName = os.environ.get('ARMM_STATS', '/home/nvidia/bt-01/BT-stats.json')
+STATS_PERIOD = 3600         # 1 hour
+linkstats = LinkStats()     # shared by every BtComm of this program (re-created in BT_DEAD)
+
+#
+# Frame journal (binary flight recorder)
+#
+# every frame sent & received, in a fixed size ring file (the last days of wire traffic
+# survive a crash or a cold boot), printed by : python3 -m armm.journal BT-frames.bin
+# ARMM_JOURNAL overrides the file name
+journalFileName = os.environ.get('ARMM_JOURNAL', '/home/nvidia/bt-01/BT-frames.bin')
+JOURNAL_SIZE = 4 << 20      # 4 MiB ring
+journal = FrameJournal(journalFileName, JOURNAL_SIZE)
+
+#
+# Last known BT-01 status
+#
+# status_res is kept STATUS_MAX_AGE, readers of the status (statistics, metrics) use the
+# kept one, status_req is sent only when it is older.  The status job reads it every
+# STATUS_MAX_AGE, so a stale status is refreshed in the HEARTBEAT state
+STATUS_MAX_AGE = 300        # [sec]
+statuscache = StatusCache(STATUS_MAX_AGE)
+
+#
+# Metrics (Prometheus text format, opt-in)
+#
+# heartbeats, RTT, time outs, checksum errors, ping, state, log pull & job lateness,
+# rendered only when read :
+#   ARMM_METRICS_FILE : file of the node_exporter textfile collector (every METRICS_PERIOD)
+#   ARMM_METRICS_PORT : http://127.0.0.1:<port>/metrics
+metricsFileName = os.environ.get('ARMM_METRICS_FILE')
+METRICS_PORT = int(os.environ.get('ARMM_METRICS_PORT', '0'))    # 0 : no HTTP endpoint
+METRICS_PERIOD = 60         # [sec]
+metrics = Metrics()
 
 # HEART BEAT timer (5 min. period)
 HB_TIME_PERIOD = 300        # should be 300
 
-# ping time out = 5 min. x 4 times, ping hosts : google
+# ping time out = 5 min. x 4 times, ping hosts : google & cloudflare
 PING_TIME_OUT = 300         # should be 300
-PING_TIME_OUT_COUNT = 4
-hosts = ["8.8.8.8", "www.google.com"]
+PING_TIME_OUT_COUNT = 4     # a target is down after 4 rounds without answer
+# targets fail independently : IP literals for ICMP (no name resolution), DNS only by its own probe
+hosts = ["8.8.8.8", "1.1.1.1"]
+dns_names = ["www.google.com"]  # DNS query probe
+WAN_QUORUM = None           # WAN is down when all ICMP hosts are down, DNS : evidence only
+health = NetworkHealth(WAN_QUORUM, PING_TIME_OUT_COUNT, evidence=['dns ' + name for name in dns_names])
+# all hosts are pinged at once on worker threads, never on the heartbeat thread
+PING_DEADLINE = 20          # [sec] max time of one ping
+# in-process ICMP echo (TCP connect if not allowed), DNS answers are cached for their TTL
+probes = ProbeRunner(default_probes(hosts, dns_names), PING_DEADLINE)
+
+#
+# Timer jobs of STATE_HEARTBEAT
+#
+# heartbeat, ping, 02:00 log read, 02:15 log shift & statistics are run by one scheduler,
+# which sleeps just until the next job is due (lateness of every job is in BT-stats.json)
+scheduler = TimerScheduler()
+heartbeat_lost = False      # no alive_res to the last heartbeat : STATE_BT_DEAD
 
 
 # デコレーター for DEBUG
@@ -89,14 +175,31 @@ def print_info(func):
 
 # write log(print) to BT log file
 def writelog(strlog):
-    f = open(loggingFileName, 'a')
-    strbytes = 'BT01 DEBUG: ' + str(datetime.datetime.now()) + strlog + '\n'
-    # print(strbytes)
-    f.write(strbytes)
-    f.close()
+    # time stamp is taken now, the line is written by the log writer thread
+    logwriter.write('BT01 DEBUG: ', strlog)
     return
 
 
+# write link statistics & timer job lateness to statsFileName & BT log
+def writestats():
+    try:
+        linkstats.write(statsFileName, {'timers': scheduler.snapshot(), 'network': health.snapshot(),
+                                        'status': statuscache.snapshot()})
+    except OSError as e:
+        logging.error("can't write statistics : " + str(e))
+    for line in linkstats.lines():
+        writelog('link stats : ' + line)
+    for line in scheduler.lines():
+        writelog('timer stats : ' + line)
+    writelog('log writer : ' + str(logwriter))
+    writelog('frame journal : ' + str(journal))
+
+
+# ARMM log record (log_res frame) -> BT log line
+def logline(frame):
+    return 'BT01 LOG: ' + str(bytearray(frame.parameter))
+
+
 #
 # Convert number to BCD
 #
@@ -106,25 +209,12 @@ def convert2bcd(num):
 
 
 #
-# shift every day log file for 1-7 management
+# shift every day log files for 1-7 management : BT-log is renamed to BT-log.1, not copied
 #
 def shiftlogfile():
     logging.info("start to shift log files")
-    for i in range(7, 0, -1):
-        filename = loggingFileName + '.' + str(i)
-        # print('BT log file name = ', filename)
-        if os.path.exists(filename):
-            if i == 7:
-                os.remove(filename)
-            else:
-                os.rename(loggingFileName + '.' + str(i), loggingFileName + '.' + str(i + 1))
-    if os.path.exists(loggingFileName):
-        shutil.copy2(loggingFileName, loggingFileName + '.1')
-
-        with open(loggingFileName, "r+") as f:
-            # print(f.read())
-            f.truncate(0)  # ファイル内容のクリア
-    return
+    # nothing is written to the log file while it is renamed, then a new BT-log is opened
+    logwriter.rotate(rotator.rotate)
 
 
 #
@@ -139,128 +229,165 @@ class BtComm(object):
         self.recvCommand = bytearray()
         self.recvChecksumByte = bytearray()
         self.afterEscapeSequence = bytearray()
+        # frame decoder & decoded frames not yet returned by recv
+        self.decoder = FrameDecoder()
+        self.recvFrames = collections.deque()
+        # background reader thread (start_reader)
+        self.link = None
         # Generate event
         self.event = threading.Event()
 
         # Open Serial Port. wait for success
-        while True:
-            try:
-                self.comm = serial.Serial(tty, baudrate, timeout=timeoutvalue)
-                self.isPortOpen = True
-                break
-            except serial.SerialException:
-                self.isPortOpen = False
+        #   sleeps until /dev/ttyACM0 appears (plugged) or the back-off interval passes
+        self.comm, attempts, seconds = open_port(
+            tty, lambda: serial.Serial(tty, baudrate, timeout=timeoutvalue))
+        self.isPortOpen = True
+        self.reader = ChunkReader(self.comm)      # bulk Rx reads
+        logging.info('opened {0} : {1} attempts, {2:.1f} sec.'.format(tty, attempts, seconds))
 
     # Receiving Data with time out setting[sec]
     def recv(self, timeout=300):
-        # for time out
-        time_start = time.time()
+        # for time out (monotonic : not affected by system clock changes)
+        deadline = time.monotonic() + timeout
         # Clear event to wait thread
         self.event.clear()
         # Clear Rx Buffer
         self.recvData.clear()
         # Rx result : True (success) False (fault: time out)
         result = False
+        frame = None
+
+        # reader thread running : take a frame nobody waits for
+        if self.link is not None:
+            try:
+                frame = self.link.get(timeout)
+            except IOError:
+                self.isPortOpen = False
+            if frame is None:
+                self.rxtimeout(timeout)
+                return result, self.recvData, self.recvCommand, self.afterEscapeSequence
+            return self.rxframe(frame)
 
         # Wait for Rx
         while not self.event.is_set():
+            # frame already decoded ? (several frames can arrive at once)
+            if self.recvFrames:
+                # Stop receiving data (success)
+                frame = self.recvFrames.popleft()
+                result = True
+                self.stop()
+                break
+
             # Check time out
-            time_end = time.time()
-            if time_end - time_start > timeout:
+            if time.monotonic() >= deadline:
                 # Time out process
                 result = False
                 self.stop()
-                # for DEBUG
-                print("Rx timeout:{0}sec".format(timeout))
+                self.rxtimeout(timeout)
                 break
 
-            # Received !  read Rx
-            buff = self.comm.read()
+            # Received !  read Rx (all bytes waiting, not beyond the deadline)
+            buff = self.reader.read(deadline)
 
             # Check Rx data 
             if len(buff) > 0:
-                # Read Rx
-                self.recvData.extend(buff)
-                # <DLE(0x10)><ETX(0x03) Received ? 
-                if (self.recvData.find(b'\x10\x03')) >= 0:
-                    # Stop receiving data (success)
-                    result = True
-                    self.stop()
-                    break
+                # decode Rx : checksum, 0x10 escape & <DLE><STX>..<DLE><ETX> framing in one pass
+                frames = self.decoder.feed(buff)
+                for frame in frames:
+                    journal.rx(frame)
+                self.recvFrames.extend(frames)
 
         # Return Result
         if result:
-            # DEBUG
-            print('self.recvData = ', self.recvData)
+            return self.rxframe(frame)
 
-            # write recvData as log
-            strlog = 'self.recvData = ' + str(self.recvData)
-            writelog(strlog)
+        return result, self.recvData, self.recvCommand, self.afterEscapeSequence
 
-            #
-            # here, process checksum, 0x10 escape process, & discriminating the command
-            #
-            # received command
-            self.recvCommand = self.recvData[2]
-            # extract data for checksum
-            recvdataforchecksum = self.recvData[2:-3]
-            # extract payload for 0x10 escape sequence
-            recvdataforescapesequence = self.recvData[3:-3]
-            # received data checksum
-            self.recvChecksumByte = self.recvData[-3]
-            # check checksum
-            num_sum = 0
-            for num in recvdataforchecksum:
-                num_sum += num
-            checksumbyte = num_sum & 0xFF
-            if checksumbyte == self.recvChecksumByte:
-                logging.debug("received data check sum is correct")
-            else:
-                logging.debug("received data check sum is not correct")
-            # send CMD_UNKNOWN_RES
-            # not need now
-
-            # retrieve 0x10 from escape sequence
-            self.afterEscapeSequence = bytearray()
-            pnum = 0  # non 0x10
-            for num in recvdataforescapesequence:
-                if pnum == 16 & num == 16:
-                    pnum = 0
-                    continue
-                else:
-                    pnum = num
-                    self.afterEscapeSequence.append(num)
-            # print("afterEscapeSequence = ", afterEscapeSequence)
+    # Rx time out log
+    def rxtimeout(self, timeout):
+        # for DEBUG
+        print("Rx timeout:{0}sec".format(timeout))
 
-        return result, self.recvData, self.recvCommand, self.afterEscapeSequence
+    # received frame -> recvData, recvCommand, afterEscapeSequence (& log)
+    def rxframe(self, frame):
+        self.recvData.clear()
+        self.recvData.extend(frame.raw)
+        # DEBUG
+        print('self.recvData = ', self.recvData)
+
+        # write recvData as log
+        strlog = 'self.recvData = ' + str(self.recvData)
+        writelog(strlog)
+
+        # received command
+        self.recvCommand = frame.command
+        # received data checksum
+        self.recvChecksumByte = frame.checksum
+        # check checksum
+        if frame.valid:
+            logging.debug("received data check sum is correct")
+        else:
+            logging.debug("received data check sum is not correct")
+        # send CMD_UNKNOWN_RES
+        # not need now
+
+        # parameter after 0x10 escape removal
+        self.afterEscapeSequence = bytearray(frame.parameter)
+
+        return True, self.recvData, self.recvCommand, self.afterEscapeSequence
+
+    # start background reader thread
+    #   after this, Rx frames are matched to transact() requests by command code
+    #   and recv() returns only frames nobody waits for
+    def start_reader(self):
+        if self.link is None:
+            self.link = BtLink(self.comm, self.decoder, linkstats, journal)
+            # frames decoded by recv but not returned yet
+            while self.recvFrames:
+                self.link.keep(self.recvFrames.popleft())
+            self.link.start()
+
+    # send request, return Future of the response frame (reader thread required)
+    def request(self, data):
+        return self.link.request(data, self.send)
+
+    # send request & wait for its response with time out setting[sec]
+    # return same as recv.  send error : isPortOpen = False
+    def transact(self, data, timeout=30):
+        if self.link is None:
+            if not self.send(data):
+                return False, bytearray(), bytearray(), bytearray()
+            return self.recv(timeout)
+
+        future = self.request(data)
+        try:
+            frame = future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self.link.cancel(future)
+            self.rxtimeout(timeout)
+            return False, bytearray(), bytearray(), bytearray()
+        except IOError:
+            # send error or reader thread stopped
+            self.isPortOpen = False
+            return False, bytearray(), bytearray(), bytearray()
+        if frame is None:
+            # no response defined for this command
+            return True, bytearray(), bytearray(), bytearray()
+        return self.rxframe(frame)
 
     # Send Data
     def send(self, data):
-        # check 0x10 escape
-        sendbytearray = bytearray()
-        sendbytearray.clear()
-        for i in data:
-            sendbytearray.append(i)
-            if i == 0x10:  # 0x10 escape required ?
-                sendbytearray.append(i)  # yes
-
-        # Add DLE+STX, checkSum, DLE+ETX
-        #  calculate check sum
-        num_sum = 0
-        for i in sendbytearray:
-            num_sum = num_sum + i
-        sumbyte = num_sum & 0xFF  # extract only lowest byte
-        csum = bytearray([sumbyte])
-        #  make a command
-        senddata = DLE + STX + sendbytearray + csum + DLE + ETX
+        # check sum, 0x10 escape & <DLE><STX>..<DLE><ETX> (constant commands are pre-encoded)
+        senddata = encode(data)
 
         try:
             self.comm.write(senddata)
             self.isPortOpen = True
+            journal.tx(senddata, data[0])
             # DEBUG
             print('senddata = ', senddata)
 
-            strlog = 'self.senddata = ' + str(senddata)
+            strlog = 'self.senddata = ' + str(bytearray(senddata))
             writelog(strlog)
 
         except serial.SerialException:
@@ -276,21 +403,26 @@ class BtComm(object):
     # Close Serial Port
     def close(self):
         self.stop()
+        if self.link is not None:
+            self.link.stop()
+            self.link = None
         if self.isPortOpen:
             self.comm.close()
         self.isPortOpen = False
 
-    # TODO: read BT-01 status -> need to define status(parameters)
-    def readstatus(self):
-        # send status_req
+    # read BT-01 status (armm.status.Status), the kept one if younger than max_age [sec]
+    #   (default STATUS_MAX_AGE, 0 : always send status_req)
+    #   no response : the last known status or None
+    def readstatus(self, max_age=None, timeout=30):
+        return statuscache.read(lambda: self.fetchstatus(timeout), max_age)
+
+    # send status_req : Status or None
+    def fetchstatus(self, timeout=30):
         logging.debug("send status request")
-        result = self.send(CMD_STATUS_REQ)
-        if not result:
-            return result
-        else:
-            result, rxdata, rxcommand, rxparameter = self.recv(30)
-            # TODO: here, analysis the status
-        return result
+        result, rxdata, rxcommand, rxparameter = self.transact(CMD_STATUS_REQ, timeout)
+        if result and rxcommand == CMD_STATUS_RES[0]:
+            return decode_status(rxparameter)
+        return None
 
     # sync RTC
     def syncrtc(self):
@@ -314,17 +446,13 @@ class BtComm(object):
             hex_n = '{:02x}'.format(i)
             print('0x' + hex_n)
 
-        result = self.send(rtc_data)
         print("rtc_data = ", rtc_data)
-        if not result:
-            return
-        else:
-            result, rxdata, rxcommand, rxparameter = self.recv(30)
-            if result:
-                logging.debug("received BT-01 RTC response")
-                print("RxParameter (RTC) = ", rxparameter)
-            else:
-                logging.debug("not received RTC sync response")
+        result, rxdata, rxcommand, rxparameter = self.transact(rtc_data, 30)
+        if result:
+            logging.debug("received BT-01 RTC response")
+            print("RxParameter (RTC) = ", rxparameter)
+        elif self.isPortOpen:
+            logging.debug("not received RTC sync response")
         return
 
     # @print_info
@@ -332,53 +460,162 @@ class BtComm(object):
     def readlogs(self):
         logging.debug("send bt01 log request")
         print(str(datetime.datetime.now()) + " Read Logs starts")
-        while True:
-            result = BtComm.send(self, CMD_LOG_REQ)
-            if not result:
-                logging.debug("log request failed")
-                break
-            else:
-                result, rxdata, rxcommand, rxparameter = self.recv(30)
-                if result:
-                    logging.debug("received BT-01 log")
-                    print("RxParameter (log) = ", rxparameter)
-
-                    f = open(loggingFileName, 'a')
-                    strbytes = 'BT01 LOG: ' + str(rxparameter) + '\n'
-                    print(strbytes)
-                    f.write(strbytes)
-                    f.close()
-
-                    # check log end
-                    if (rxparameter.find(b'NO LOG')) >= 0:
-                        break
-                    else:
-                        time.sleep(1)
-
-                else:
-                    logging.debug("not received BT-01 log")
-                    print("not received BT-01 log")
-        return result
+        # log_req pipelined : next log_req is sent as soon as a log_res is received
+        self.start_reader()
+        sink = logwriter.sink(logline)
+        try:
+            stats = pull_logs(self.request, sink, cancel=self.link.cancel)
+        finally:
+            sink.close()
+        logging.info("read logs : " + str(stats))
+        count_log_pull(metrics, stats)
+        print(str(datetime.datetime.now()) + " Read Logs ends : " + str(stats))
+        return stats.complete
 
     # cold boot request
     def coldboot(self):
         logging.debug("send cold reboot request")
-        result = BtComm.send(self, CMD_REBOOT_REQ)
-        if not result:
-            return
+        result, rxdata, rxcommand, rxparameter = self.transact(CMD_REBOOT_REQ, 30)
+        if result:
+            logging.debug("received coldBoot response")
+            print("received coldBoot response")
+        elif self.isPortOpen:
+            logging.debug("not received coldBoot response")
+            print("not received coldBoot response")
+        return
+
+
+#
+# start the jobs of STATE_HEARTBEAT
+#
+def startjobs(btcom):
+    global heartbeat_lost
+    scheduler.clear()
+    heartbeat_lost = False
+    health.reset()
+    # heart beat every HB_TIME_PERIOD
+    scheduler.every(HB_TIME_PERIOD, 'heartbeat', heartbeat, btcom)
+    # ping every PING_TIME_OUT
+    scheduler.every(PING_TIME_OUT, 'ping', pingcheck, btcom)
+    # Set to read LOG every day at 2:00 am
+    scheduler.daily("02:00", 'readlogs', btcom.readlogs)
+    # Set to shift log files every day at 2:15am
+    scheduler.daily("02:15", 'shiftlogfile', shiftlogfile)
+    # write link statistics every hour
+    scheduler.every(STATS_PERIOD, 'stats', writestats)
+    # refresh the kept status when it is stale
+    scheduler.every(STATUS_MAX_AGE, 'status', statuscheck, btcom)
+
+
+#
+# heart beat job : send 'alive_req' and wait for 'alive_res'
+#   no response : heartbeat_lost = True (main moves to STATE_BT_DEAD)
+#   send error : btcom.isPortOpen = False (main moves to STATE_POWERON)
+#
+def heartbeat(btcom):
+    global heartbeat_lost
+    # DEBUG
+    print('Send HEARTBEAT')
+    metrics.inc('armm_heartbeats_sent_total')
+
+    # send 'alive_req' and wait for 'alive_res'
+    #  send alive_req command & wait for alive_res w/ 10 sec. time out
+    result, rxdata, rxcommand, rxparameter = btcom.transact(CMD_ALIVE_REQ, 10)
+    if not btcom.isPortOpen:
+        return
+
+    # data received ?
+    if result:
+        # alive_res ?
+        if rxdata == b'\x10\x02\xaa\xaa\x10\x03':
+            # yes
+            # DEBUG
+            logging.info('Received HEARTBEAT Response')
+            metrics.inc('armm_heartbeats_acked_total')
+            metrics.set('armm_heartbeat_last_ack_time_seconds', time.time())
+            print("Received HEARTBEAT Response")
         else:
-            result, rxdata, rxcommand, rxparameter = self.recv(30)
-            if result:
-                logging.debug("received coldBoot response")
-                print("received coldBoot response")
-            else:
-                logging.debug("not received coldBoot response")
-                print("not received coldBoot response")
+            # if not alive_res, just ignore it
+            # just in case of communication error
+            # DEBUG
+            logging.info('Not received HEARTBEAT response but something else')
+            print("Not received HEARTBEAT response but something else")
+    else:
+        # Not received 'alive_res' in 10 sec.
+        heartbeat_lost = True
+        # DEBUG
+        print('NOT received BT01 HEARTBEAT Response')
+
+
+# status job : status_req only if the kept status is older than STATUS_MAX_AGE
+def statuscheck(btcom):
+    status = btcom.readstatus()
+    logging.debug('status : ' + str(status))
+
+
+#
+# ping job : start pinging all hosts, results are given to pingresult on this thread
+#
+def pingcheck(btcom):
+    # execute ping
+    # DEBUG
+    print("Start ping")
+    if not probes.start(lambda results: scheduler.post(pingresult, btcom, results)):
+        logging.debug("previous ping not finished, skip")
+
+
+#
+# ping results : if LTE is not working, send reboot_req & wait for reboot_res
+#   After receiving reboot_res, start shutdown
+#
+def pingresult(btcom, results):
+    log_results(results)
+    count_probes(metrics, results)
+    if health.update(results):
+        # WAN network is not working
+        # no connection to internet, cold reboot AI BOX
+        # cold reboot request
+        # DEBUG
+        logging.info('ping does not reach !!  Send Cold Boot Req and Shutdown')
+        print("ping does not reach !!  Send Cold Boot Req and Shutdown")
+        btcom.coldboot()
+        # check received res
+        # if received, execute shutdown
+        # if not, maybe can do something
+        # but ANYWAY shutdown
+        logwriter.flush()
+        os.system('shutdown -h now')
+
+
+# open the frame journal, the program runs without it if it can't be opened
+def openjournal():
+    try:
+        journal.open()
+    except (OSError, ValueError) as e:
+        logging.error("can't open frame journal " + journalFileName + " : " + str(e))
+
+
+# start serving metrics (opt-in), the program runs without them if they can't be served
+def startmetrics():
+    if not metricsFileName and not METRICS_PORT:
         return
+    metrics.set('armm_up', 1)
+    metrics.set('armm_start_time_seconds', time.time())
+    metrics.add_source(lambda: link_samples(linkstats.snapshot()))
+    metrics.add_source(lambda: timer_samples(scheduler.snapshot()))
+    metrics.add_source(lambda: health_samples(health.snapshot()))
+    metrics.add_source(lambda: status_samples(statuscache.snapshot()))
+    if metricsFileName:
+        TextfileWriter(metrics, metricsFileName, METRICS_PERIOD).start()
+    if METRICS_PORT:
+        try:
+            MetricsServer(metrics, METRICS_PORT).start()
+        except OSError as e:
+            logging.error("can't serve metrics on port " + str(METRICS_PORT) + " : " + str(e))
 
 
 def main():
-    logging.basicConfig(filename=loggingFileName, format=formatter, level=logging.DEBUG)
+    logging.basicConfig(handlers=[logwriter.start().handler()], format=formatter, level=logging.DEBUG)
     # logging.basicConfig(filename=loggingFileName, encoding='utf-8', format=formatter, level=logging.DEBUG)
     # logging.basicConfig(encoding='utf-8', format=formatter, level=logging.DEBUG)
     # logging.basicConfig(level=logging.DEBUG)
@@ -388,6 +625,10 @@ def main():
     #
     logging.info('=============================================')
     logging.info('AIBOX Program (re-)started : start log output')
+    openjournal()
+    startmetrics()
+    # kill -USR1 : write link statistics now
+    signal.signal(signal.SIGUSR1, lambda signum, frame: writestats())
 
     ''' 
     logging message examples
@@ -406,12 +647,13 @@ def main():
     logging.debug('start to open serial port & wait for "opened" successfully')
     print("Start to open serial port")
     btcom = BtComm(DEVTTYNAME, BAUDRATE)
+    # Rx by background reader thread, responses matched to requests
+    btcom.start_reader()
 
     logging.debug('opened serial port !')
     print("Opened serial port")
-    hb_time_start = time.time()
-    ping_time_start = time.time()
     logging.info('state = STATE_POWERON')
+    metrics.set('armm_state', state)
 
     #
     # just wait for system up and running
@@ -430,6 +672,7 @@ def main():
 
             # Shift to STATE:01 "BT-01確認待機"
             state = STATE_WAIT4BT01  # Current STATE: 01
+            count_state(metrics, state)
             logging.info('state = STATE_WAIT4BT01')
             pstate = STATE_POWERON  # Previous STATE: 00
 
@@ -443,9 +686,8 @@ def main():
             while True:
                 # send 'alive_req' and wait for 'alive_res' w/ interval 1 min.
                 #  send alive_req command
-                btcom.send(CMD_ALIVE_REQ)
-                #  wait for alive_res w/ 1 min. time out
-                result, rxdata, rxccmmand, rxparameter = btcom.recv(60)
+                #  and wait for alive_res w/ 1 min. time out
+                result, rxdata, rxccmmand, rxparameter = btcom.transact(CMD_ALIVE_REQ, 60)
                 # data received ?
                 if result:
                     # alive_res ?
@@ -459,6 +701,7 @@ def main():
 
             # shift to next state
             state = STATE_HEARTBEAT
+            count_state(metrics, state)
             logging.info('state = STATE_HEARTBEAT')
             pstate = STATE_WAIT4BT01
 
@@ -469,161 +712,53 @@ def main():
                 # DEBUG
                 print('Start Shift Process from WAIT4BT01 to HEARTBEAT')
 
-                # read BT-01 status
-                logging.debug("send status request")
-                result = btcom.send(CMD_STATUS_REQ)
-                if result:
-                    result, rxdata, rxcommand, rxparameter = btcom.recv(10)
-                    # status is not implemented, yet in current bt-01
+                # read BT-01 status (not the kept one : BT-01 may have been rebooted)
+                status = btcom.readstatus(0, 10)
+                logging.info('status : ' + str(status))
 
                 # sync RTC
                 btcom.syncrtc()
                 # read all logs & write them to logging
                 result = btcom.readlogs()
 
-                # Set to read LOG every day at 2:00 am
-                schedule.every().days.at("02:00").do(btcom.readlogs)
-                # Set to shift log files every day at 2:15am
-                schedule.every().days.at("02:15").do(shiftlogfile)
-
-                # initiate ping
-                ping_time_start = time.time()
-                ping_time_end = ping_time_start
-                ping_counter = 0
-
-                # heart beat timer
-                hb_time_start = time.time()
-                hb_time_end = hb_time_start
+                # jobs of STATE_HEARTBEAT, each one runs just at its own time
+                startjobs(btcom)
 
             elif pstate == STATE_BT_DEAD:
                 pstate = STATE_HEARTBEAT
                 # DEBUG
                 print('Start Shift Process from BT_DEAD to HEARTBEAT')
 
-                # read BT-01 status
-                logging.debug("send status request")
-                result = btcom.send(CMD_STATUS_REQ)
-                if result:
-                    result, rxdata, rxcommand, rxparameter = btcom.recv(10)
-                    # status is not implemented, yet in current bt-01
+                # read BT-01 status (not the kept one : BT-01 may have been rebooted)
+                status = btcom.readstatus(0, 10)
+                logging.info('status : ' + str(status))
 
                 # sync RTC
                 btcom.syncrtc()
                 # read all logs
                 btcom.readlogs()
 
-                # Set to read LOG every day at 2:00 am
-                schedule.every().days.at("02:00").do(btcom.readlogs)
-                # Set to shift log files every day at 2:15am
-                schedule.every().days.at("02:15").do(shiftlogfile)
-
-                # initiate ping
-                ping_time_start = time.time()
-                ping_time_end = ping_time_start
-                ping_counter = 0
-
-                # heart beat timer
-                hb_time_start = time.time()
-                hb_time_end = hb_time_start
+                # jobs of STATE_HEARTBEAT, each one runs just at its own time
+                startjobs(btcom)
 
             else:
                 # STATE:02 処理
-                # just put sleep, could be 10 sec.
-                time.sleep(10)
-
-                # HEART BEAT timing ?
-                # DEBUG
-                # print("start heart beat timing check")
-                hb_time_end = time.time()
-                if hb_time_end - hb_time_start > HB_TIME_PERIOD:
-                    # HEART BEAT process
-                    # DEBUG
-                    print('Send HEARTBEAT')
-
-                    # send 'alive_req' and wait for 'alive_res'
-                    #  send alive_req command
-                    result = btcom.send(CMD_ALIVE_REQ)
-                    if not result:
-                        # 送信不能：何かが異常になった
-                        # move to POWERON state
-                        state = STATE_POWERON
-                        logging.info('Due to serial communication error, shift to state = SATE_POWERON')
-                        continue
-
-                    #  wait for alive_res w/ 10 sec. time out
-                    result, rxdata, rxcommand, rxparameter = btcom.recv(10)
-                    # data received ?
-                    if result:
-                        # alive_res ?
-                        if rxdata == b'\x10\x02\xaa\xaa\x10\x03':
-                            # yes
-                            hb_time_start = time.time()
-                            hb_time_end = hb_time_start
-                            # DEBUG
-                            logging.info('Received HEARTBEAT Response')
-                            print("Received HEARTBEAT Response")
-
-                        else:
-                            # if not alive_res, just ignore it
-                            # just in case of communication error
-                            hb_time_start = time.time()
-                            hb_time_end = hb_time_start
-                            # DEBUG
-                            logging.info('Not received HEARTBEAT response but something else')
-                            print("Not received HEARTBEAT response but something else")
-                            continue
-
-                    else:
-                        # Not received 'alive_res' in 10 sec.
-                        state = STATE_BT_DEAD
-                        logging.info('state = STATE_BT_DEAD')
-                        pstate = STATE_HEARTBEAT
-                        # DEBUG
-                        print('NOT received BT01 HEARTBEAT Response')
-                        break
-
-                #
-                # if LTE is not working, send reboot_req & wait for reboot_res
-                #   After receiving reboot_res, start shutdown
-                #
-                ping_time_end = time.time()
-                if ping_time_end - ping_time_start > PING_TIME_OUT:
-                    # execute ping
-                    # DEBUG
-                    print("Start ping")
-                    for host in hosts:
-                        res = subprocess.run(["ping", host, "-c", "2", "-W", "300"], stdout=subprocess.PIPE)
-                        if res.returncode == 0:
-                            # DEBUG
-                            logging.debug('ping OK')
-                            ping_time_start = time.time()
-                            ping_time_end = ping_time_start
-                            ping_counter = 0
-                        else:
-                            # not received ping
-                            logging.debug("ping failed")
-                            ping_counter += 1
-                            if ping_counter >= PING_TIME_OUT_COUNT:
-                                # WAN network is not working
-                                # no connection to internet, cold reboot AI BOX
-                                # cold reboot request
-                                # DEBUG
-                                logging.info('ping does not reach !!  Send Cold Boot Req and Shutdown')
-                                print("ping does not reach !!  Send Cold Boot Req and Shutdown")
-                                btcom.coldboot()
-                                # check received res
-                                # if received, execute shutdown
-                                # if not, maybe can do something
-                                # but ANYWAY shutdown
-                                os.system('shutdown -h now')
-
-                            else:
-                                ping_time_start = time.time()
-                                ping_time_end = ping_time_start
-
-                # execute to read LOG
-                # every day 2 am
-                schedule.run_pending()
+                # sleep until the next job (heartbeat, ping, log read, log shift) is due & run it
+                scheduler.run_next()
+                if not btcom.isPortOpen:
+                    # 送信不能：何かが異常になった
+                    # move to POWERON state
+                    state = STATE_POWERON
+                    count_state(metrics, state)
+                    logging.info('Due to serial communication error, shift to state = SATE_POWERON')
+                    continue
+                if heartbeat_lost:
+                    # Not received 'alive_res' in 10 sec.
+                    scheduler.clear()
+                    state = STATE_BT_DEAD
+                    count_state(metrics, state)
+                    logging.info('state = STATE_BT_DEAD')
+                    pstate = STATE_HEARTBEAT
 
         else:
             # STATE:03 STATE_BT_DEAD
@@ -634,20 +769,20 @@ def main():
                 # DEBUG put 5 sec for debug
                 time.sleep(5)
                 btcom = BtComm(DEVTTYNAME, BAUDRATE)
+                btcom.start_reader()
                 # send 'alive_req' and wait for 'alive_res' w/ interval 5 min.
-                #  send alive_req command
-                btcom.send(CMD_ALIVE_REQ)
-                #  wait for alive_res w/ 5 min. time out
-                result, rxdata, rxcommand, rxparameter = btcom.recv(300)
+                #  send alive_req command & wait for alive_res w/ 5 min. time out
+                result, rxdata, rxcommand, rxparameter = btcom.transact(CMD_ALIVE_REQ, 300)
                 # data received ?
                 if result:
                     # alive_res ?
-                    if rxdata == b'\x10\x02UU\x10\x03':
+                    if rxdata == b'\x10\x02\xaa\xaa\x10\x03':
                         # yes
                         break
 
             # shift to next state
             state = STATE_HEARTBEAT
+            count_state(metrics, state)
             logging.info('state = STATE_HEARTBEAT')
             pstate = STATE_BT_DEAD
 
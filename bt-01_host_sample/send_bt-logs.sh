@@ -1,11 +1,26 @@
 #!/bin/bash
 
 # command format
-# send_bt-logs.sh from_email_address from_email_app-password, to_email_address
+# send_bt-logs.sh from_email_address from_email_app-password, to_email_address [incremental]
+#   incremental : send only the log lines added since the last mail (no archive of all files)
 
 timestamp=$(date +%Y%m%d-%H%M%S)
 fileName="bt_log-${timestamp}"
 
+# set to_email
+fr_email=$1
+appPassword=$2
+to_email=$3
+mode=$4
+# echo $to_email
+
+if [ "$mode" = "incremental" ]; then
+    echo "send log lines added since the last mail by email"
+    # shellcheck disable=SC2086
+    python3 sendlog.py --incremental BT-log $fr_email $appPassword $to_email || exit 1
+    echo "sent log file !"
+    exit 0
+fi
 
 echo "archiving device logs into a file..."
 # cwd=$PWD
@@ -21,12 +36,6 @@ echo "device logs collection completed!"
 
 echo "send log file by email"
 
-# set to_email
-fr_email=$1
-appPassword=$2
-to_email=$3
-# echo $to_email
-
 python3 sendlog.py $fileName.tar.gz $fr_email $appPassword $to_email
 
 
@@ -3,7 +3,9 @@
 import time
 import threading
 import os
+import sys
 import shutil
+import collections
 
 import logging
 import subprocess
@@ -12,6 +14,11 @@ import datetime
 import schedule
 import serial
 
+# armm shared modules : next to this file (installed) or at the top of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from armm.serialio import ChunkReader, open_port
+from armm.codec import FrameDecoder, checksum, encode
+
 # version description
 # described at logging.info at the beginning
 VERSIONDESCRIPTION = 'version 2024/2/16 : Test serial communication just after writing binary to an ARMM board'
@@ -59,14 +66,15 @@ CMD_UNKNOWN_RES = bytearray([0xFF])         # B2A/A2B   : Received unknown comma
 # Serial communication parameters
 #
 # set /dev/tty & baud rate
-DEVTTYNAME = "/dev/ttyTHS0"     # Serial Port tty : Orin NX/nano UART1
+#   ARMM_TTY overrides the tty, e.g. the pty of the ARMM simulator (python3 -m armm.simulator)
+DEVTTYNAME = os.environ.get('ARMM_TTY', "/dev/ttyTHS0")     # Serial Port tty : Orin NX/nano UART1
 BAUDRATE = 1200                 # Serial Port Baud Rate : 1200 because of keeping signal quality
 
 #
 # Logging
 #
-# logs append to /home/nvidia/bt-11
-loggingFileName = '/home/nvidia/bt-11/BT-log'
+# logs append to /home/nvidia/bt-11 (ARMM_LOG overrides the file name)
+loggingFileName = os.environ.get('ARMM_LOG', '/home/nvidia/bt-11/BT-log')
 formatter = '%(asctime)s : %(levelname)s : %(message)s'
 
 #
@@ -164,49 +172,52 @@ class BtComm(object):
         self.recvCommand = bytearray()
         self.recvChecksumByte = bytearray()
         self.afterEscapeSequence = bytearray()
-        self.recvdataforescapesequence = bytearray()
-        # Tx
-        self.sendbytesnoescape = bytearray()
-        self.sendbytesescape = bytearray()
+        # frame decoder & decoded frames not yet returned by recv
+        self.decoder = FrameDecoder()
+        self.recvFrames = collections.deque()
         # Generate event
         self.event = threading.Event()
 
         # Open Serial Port. wait for success until success
-        while True:
-            try:
-                self.comm = serial.Serial(
-                    port=tty, 
-                    baudrate=baudratevalue, 
+        #   sleeps until the tty appears or the back-off interval passes (no busy loop)
+        self.comm, attempts, seconds = open_port(tty, lambda: serial.Serial(
+                    port=tty,
+                    baudrate=baudratevalue,
                     bytesize=serial.EIGHTBITS,
                     parity=serial.PARITY_NONE,
                     stopbits=serial.STOPBITS_ONE,
                     timeout=timeoutvalue
-                    )
-                self.isPortOpen = True              # opened successfully
-                break
-            except serial.SerialException:
-                self.isPortOpen = False             # failed
-                # not break until success
-                # break
+                    ))
+        self.isPortOpen = True              # opened successfully
+        self.reader = ChunkReader(self.comm)      # bulk Rx reads
+        logging.info('opened {0} : {1} attempts, {2:.1f} sec.'.format(tty, attempts, seconds))
 
         return
 
     # Receiving Data with time out setting[sec]
     def recv(self, timeout=300.0):
-        # for time out
-        time_start = time.time()
+        # for time out (monotonic : not affected by system clock changes)
+        deadline = time.monotonic() + timeout
         # Clear event to wait thread
         self.event.clear()
         # Clear Rx Buffer
         self.recvData.clear()
         # Rx result : True (success) False (fault: time out)
         result = False
+        frame = None
 
         # Wait for Rx
         while not self.event.is_set():
+            # frame already decoded ? (several frames can arrive at once)
+            if self.recvFrames:
+                # Stop receiving data (success)
+                frame = self.recvFrames.popleft()
+                result = True
+                self.stop()
+                break
+
             # Check time out
-            time_end = time.time()
-            if time_end - time_start > timeout:
+            if time.monotonic() >= deadline:
                 # time out process
                 result = False
                 self.stop()
@@ -217,22 +228,17 @@ class BtComm(object):
                 writelog(strlog)
                 break
 
-            # Received !  read Rx
-            buff = self.comm.read()
+            # Received !  read Rx (all bytes waiting, not beyond the deadline)
+            buff = self.reader.read(deadline)
 
-            # Check Rx data 
+            # Check Rx data
             if len(buff) > 0:
-                # Read Rx
-                self.recvData.extend(buff)
-                # <DLE(0x10)><ETX(0x03) Received ? 
-                if (self.recvData.find(b'\x10\x03')) >= 0:
-                    # Stop receiving data (success)
-                    result = True
-                    self.stop()
-                    break
+                # decode Rx : checksum, 0x10 escape & <DLE><STX>..<DLE><ETX> framing in one pass
+                self.recvFrames.extend(self.decoder.feed(buff))
 
         # Return Result
         if result:
+            self.recvData.extend(frame.raw)
             # DEBUG
             print('self.recvData = ', self.recvData)
             print('self.recvData = ', self.recvData.hex())
@@ -243,42 +249,19 @@ class BtComm(object):
             strlog = 'self.recvData = ' + str(self.recvData.hex())
             writelog(strlog)
 
-            #
-            # here, process checksum, 0x10 escape process, & discriminating the command
-            #
-            
             # received command
-            self.recvCommand = self.recvData[2]
-            # extract data for checksum
-            # recvdataforchecksum = self.recvData[2:-3]
-            # extract payload for 0x10 escape sequence
-            self.recvdataforescapesequence = self.recvData[2:-3]
+            self.recvCommand = frame.command
             # received data checksum
-            self.recvChecksumByte = self.recvData[-3]
-            # extract escape sequence 0x10
-            self.afterEscapeSequence = bytearray()
-            self.afterEscapeSequence.clear()
-            pnum = 0  # non 0x10
-            for num in self.recvdataforescapesequence:
-                if pnum == 0x10 & num == 0x10:
-                    pnum = 0
-                    continue
-                else:
-                    pnum = num
-                    self.afterEscapeSequence.append(num)
-            
+            self.recvChecksumByte = frame.checksum
+            # command & parameter after 0x10 escape removal
+            self.afterEscapeSequence = bytearray(frame.data())
+
             print("self.afterEscapeSequence = ", self.afterEscapeSequence)
-            
-            # check checksum
-            num_sum = 0
-            for num in self.afterEscapeSequence:
-                num_sum += num
-            checksumbyte = num_sum & 0xFF
-            
-            print("checksumbyte = ", hex(checksumbyte))
+
+            print("checksumbyte = ", hex(checksum(self.afterEscapeSequence)))
             print("self.recvChecksumByte = ", hex(self.recvChecksumByte))
 
-            if checksumbyte == self.recvChecksumByte:
+            if frame.valid:
                 logging.debug("received data check sum is correct")
                 print("received data check sum is correct")
             else:
@@ -292,22 +275,8 @@ class BtComm(object):
     # Send Data
     def send(self, data):
         # here, argument data = command +  parameter bytearray
-        # check sum
-        self.sendbytesnoescape.clear()
-        num_sum = 0
-        for i in data:
-            num_sum = num_sum + i
-            self.sendbytesnoescape.append(i)
-        csum = num_sum & 0xFF       # extract only lowest byte
-        self.sendbytesnoescape.append(csum)
-        
-        # 0x10 escape
-        self.sendbytesescape.clear()
-        for i in self.sendbytesnoescape:
-            self.sendbytesescape.append(i)
-            if i == 0x10:
-                self.sendbytesescape.append(i)
-        senddata = DLE + STX + self.sendbytesescape + DLE + ETX
+        # check sum, 0x10 escape & <DLE><STX>..<DLE><ETX> (constant commands are pre-encoded)
+        senddata = encode(data)
 
         try:
             self.comm.write(senddata)
@@ -316,7 +285,7 @@ class BtComm(object):
             print('senddata = ', senddata)
             print('senddata = ', senddata.hex())
 
-            strlog = 'self.senddata = ' + str(senddata)
+            strlog = 'self.senddata = ' + str(bytearray(senddata))
             writelog(strlog)
             strlog = 'self.senddata = ' + str(senddata.hex())
             writelog(strlog)
@@ -2,16 +2,39 @@
 
 import time
 import threading
+import asyncio
 import os
-import shutil
+import sys
+import signal
+import atexit
+import collections
+import concurrent.futures
 
 import logging
-import subprocess
 import datetime
 
-import schedule
 import serial
 
+# armm shared modules : next to this file (installed) or at the top of this repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from armm.serialio import ChunkReader, open_port
+from armm.codec import FrameDecoder, checksum, encode
+from armm.link import BtLink
+from armm.logpull import pull_logs, pull_logs_async
+from armm.aio import AsyncBtComm, seconds_until
+from armm.latency import LinkStats
+from armm.timers import TimerScheduler
+from armm.logwriter import LogWriter
+from armm.logrotate import LogRotator
+from armm.journal import FrameJournal
+from armm.probes import ProbeRunner, default_probes, log_results
+from armm.health import NetworkHealth
+from armm.status import StatusCache, decode_status
+from armm.temperature import TemperatureLog, decode
+from armm.metrics import Metrics, MetricsServer, TextfileWriter, link_samples, timer_samples, health_samples, \
+    status_samples, count_state, count_probes, count_log_pull
+from armm import commands
+
 # version description
 # described at logging.info at the beginning
 VERSIONDESCRIPTION = 'version 2023/11/16 : no STATE_BT_DEAD, heartbeat = every 5min.'
@@ -59,15 +82,78 @@ CMD_UNKNOWN_RES = bytearray([0xFF])         # B2A/A2B   : Received unknown comma
 # Serial communication parameters
 #
 # set /dev/tty & baud rate
-DEVTTYNAME = "/dev/ttyTHS0"     # Serial Port tty : Orin NX/nano UART1
+#   ARMM_TTY overrides the tty, e.g. the pty of the ARMM simulator (python3 -m armm.simulator)
+DEVTTYNAME = os.environ.get('ARMM_TTY', "/dev/ttyTHS0")     # Serial Port tty : Orin NX/nano UART1
 BAUDRATE = 1200                 # Serial Port Baud Rate : 1200 because of keeping signal quality
 
 #
 # Logging
 #
-# logs append to /home/nvidia/bt-11
-loggingFileName = '/home/nvidia/bt-11/BT-log'
+# logs append to /home/nvidia/bt-11 (ARMM_LOG overrides the file name)
+loggingFileName = os.environ.get('ARMM_LOG', '/home/nvidia/bt-11/BT-log')
 formatter = '%(asctime)s : %(levelname)s : %(message)s'
+# writelog, logging and ARMM log records are queued and written by one thread & file handle
+LOG_FLUSH_INTERVAL = 1.0    # [sec] queued lines are written at least every second
+LOG_FSYNC_INTERVAL = 60     # [sec] fsync at most every minute (None : never)
+logwriter = LogWriter(loggingFileName, LOG_FLUSH_INTERVAL, LOG_FSYNC_INTERVAL)
+# daily rotation : BT-log -> BT-log.1 (renamed) & compressed in background, .1 - .7 kept
+LOG_KEEP = 7                # generations
+LOG_MAX_BYTES = 64 << 20    # total bytes of the generations
+LOG_COMPRESSION = 'auto'    # zstd if the zstandard module is installed, else gzip
+rotator = LogRotator(loggingFileName, LOG_KEEP, LOG_MAX_BYTES, LOG_COMPRESSION)
+
+#
+# Link statistics
+#
+# round trip latency of every command (p50/p95/p99/max), time outs, checksum errors and
+# unexpected frames, written as JSON every STATS_PERIOD and on SIGUSR1 (kill -USR1 <pid>)
+# ARMM_STATS overrides the file name
+statsFileName = os.environ.get('ARMM_STATS', '/home/nvidia/bt-11/BT-stats.json')
+STATS_PERIOD = 3600             # 1 hour
+linkstats = LinkStats()         # shared by every BtComm / AsyncBtComm of this program
+
+#
+# Frame journal (binary flight recorder)
+#
+# every frame sent & received, in a fixed size ring file (the last days of wire traffic
+# survive a crash or a cold boot), printed by : python3 -m armm.journal BT-frames.bin
+# ARMM_JOURNAL overrides the file name
+journalFileName = os.environ.get('ARMM_JOURNAL', '/home/nvidia/bt-11/BT-frames.bin')
+JOURNAL_SIZE = 4 << 20          # 4 MiB ring
+journal = FrameJournal(journalFileName, JOURNAL_SIZE)
+
+#
+# Temperature telemetry
+#
+# ARMM temperature read every TEMPERATURE_PERIOD, kept as 1 min. readings (12 hours) and
+# 5 min. / 1 hour min, mean & max (7 days / 12 weeks) in a fixed size file, printed by :
+# python3 -m armm.temperature BT-temperature.bin --since 2d
+# ARMM_TEMPERATURE overrides the file name
+temperatureFileName = os.environ.get('ARMM_TEMPERATURE', '/home/nvidia/bt-11/BT-temperature.bin')
+TEMPERATURE_PERIOD = 60         # [sec]
+TEMPERATURE_TIMEOUT = 10.0      # [sec] wait for temperature_res
+temperatures = TemperatureLog(temperatureFileName)
+
+#
+# Last known BT-11 status
+#
+# status_res is kept STATUS_MAX_AGE, readers of the status (statistics, metrics) use the
+# kept one, status_req is sent only when it is older.  The status job reads it every
+# STATUS_MAX_AGE, so a stale status is refreshed in the HEARTBEAT state
+STATUS_MAX_AGE = 300        # [sec]
+statuscache = StatusCache(STATUS_MAX_AGE)
+
+#
+# Metrics (Prometheus text format, opt-in)
+#
+# heartbeats, RTT, time outs, checksum errors, ping, state, temperature, log pull & job
+# lateness, rendered only when read :
+#   ARMM_METRICS_FILE : file of the node_exporter textfile collector (every METRICS_PERIOD)
+#   ARMM_METRICS_PORT : http://127.0.0.1:<port>/metrics
+metricsFileName = os.environ.get('ARMM_METRICS_FILE')
+METRICS_PORT = int(os.environ.get('ARMM_METRICS_PORT', '0'))    # 0 : no HTTP endpoint
+METRICS_PERIOD = 60             # [sec]
+metrics = Metrics()
 
 #
 # HEART BEAT parameters (set to 5 min. period)
@@ -86,8 +172,31 @@ POWEROFF_TIME = 0               # for poweroff time command : 0 = 30 sec.
 
 # ping time out = 5 min. x 4 times
 PING_TIME_OUT = 300             # should be 300
-PING_TIME_OUT_COUNT = 4         # if continuous ping failed 4 times, reset LTE
-hosts = ["8.8.8.8", "www.google.com"]   # set 2 hosts for ping
+PING_TIME_OUT_COUNT = 4         # a target is down after 4 rounds without answer
+# targets fail independently : IP literals for ICMP (no name resolution), DNS only by its own probe
+hosts = ["8.8.8.8", "1.1.1.1"]  # set 2 hosts for ping (2 providers)
+dns_names = ["www.google.com"]  # DNS query probe
+WAN_QUORUM = None               # WAN is down (reset LTE) when all ICMP hosts are down, DNS : evidence only
+health = NetworkHealth(WAN_QUORUM, PING_TIME_OUT_COUNT, evidence=['dns ' + name for name in dns_names])
+# all hosts are pinged at once on worker threads, never on the heartbeat thread
+PING_DEADLINE = 20              # [sec] max time of one ping
+# in-process ICMP echo (TCP connect if not allowed), DNS answers are cached for their TTL
+probes = ProbeRunner(default_probes(hosts, dns_names), PING_DEADLINE)
+
+#
+# Timer jobs of STATE_HEARTBEAT (main)
+#
+# heartbeat, ping, temperature, 02:00 log read, 02:15 log shift & statistics are run by one
+# scheduler, which sleeps just until the next job is due (lateness of every job is in BT-stats.json)
+HEARTBEAT_RETRY = 10            # [sec] re-try heartbeat after no response
+scheduler = TimerScheduler()
+
+#
+# Main loop
+#
+# False : state machine, timer jobs run by the heap scheduler (scheduler.run_next() sleeps until the next job is due) (main)
+# True  : asyncio event loop, heartbeat, ping, log pull & RTC sync as concurrent tasks (main_async)
+USE_ASYNCIO = False
 
 
 # デコレーター for DEBUG
@@ -114,14 +223,32 @@ def print_info(func):
 
 # write log(print) to BT log file
 def writelog(strlog):
-    f = open(loggingFileName, 'a')
-    strbytes = 'BT11 DEBUG: ' + str(datetime.datetime.now()) + strlog + '\n'
-    # print(strbytes)
-    f.write(strbytes)
-    f.close()
+    # time stamp is taken now, the line is written by the log writer thread
+    logwriter.write('BT11 DEBUG: ', strlog)
     return
 
 
+# write link statistics & timer job lateness to statsFileName & BT log
+def writestats():
+    try:
+        linkstats.write(statsFileName, {'timers': scheduler.snapshot(), 'network': health.snapshot(),
+                                        'status': statuscache.snapshot()})
+    except OSError as e:
+        logging.error("can't write statistics : " + str(e))
+    for line in linkstats.lines():
+        writelog('link stats : ' + line)
+    for line in scheduler.lines():
+        writelog('timer stats : ' + line)
+    writelog('log writer : ' + str(logwriter))
+    writelog('frame journal : ' + str(journal))
+    writelog('temperature : ' + str(temperatures))
+
+
+# ARMM log record (log_res frame) -> BT log line
+def logline(frame):
+    return 'BT11 LOG: ' + str(bytearray(frame.data()))
+
+
 #
 # Convert hex int (one byte) to BCD format (one byte)
 #
@@ -131,25 +258,12 @@ def convert2bcd(num):
 
 
 #
-# shift every day log files for 1-7 management
+# shift every day log files for 1-7 management : BT-log is renamed to BT-log.1, not copied
 #
 def shiftlogfile():
     logging.info("start to shift log files")
-    for i in range(7, 0, -1):
-        filename = loggingFileName + '.' + str(i)
-        # print('BT log file name = ', filename)
-        if os.path.exists(filename):
-            if i == 7:
-                os.remove(filename)     # remove loggingFileName.7
-            else:
-                os.rename(loggingFileName + '.' + str(i), loggingFileName + '.' + str(i + 1))
-    if os.path.exists(loggingFileName):
-        shutil.copy2(loggingFileName, loggingFileName + '.1')
-
-        with open(loggingFileName, "r+") as f:
-            # print(f.read())
-            f.truncate(0)   # clear file contents
-    return
+    # nothing is written to the log file while it is renamed, then a new BT-log is opened
+    logwriter.rotate(rotator.rotate)
 
 
 #
@@ -164,160 +278,184 @@ class BtComm(object):
         self.recvCommand = bytearray()
         self.recvChecksumByte = bytearray()
         self.afterEscapeSequence = bytearray()
-        self.recvdataforescapesequence = bytearray()
-        # Tx
-        self.sendbytesnoescape = bytearray()
-        self.sendbytesescape = bytearray()
+        # frame decoder & decoded frames not yet returned by recv
+        self.decoder = FrameDecoder()
+        self.recvFrames = collections.deque()
+        # background reader thread (start_reader)
+        self.link = None
         # Generate event
         self.event = threading.Event()
 
         # Open Serial Port. wait for success until success
-        while True:
-            try:
-                self.comm = serial.Serial(
-                    port=tty, 
-                    baudrate=baudratevalue, 
+        #   sleeps until the tty appears or the back-off interval passes (no busy loop)
+        self.comm, attempts, seconds = open_port(tty, lambda: serial.Serial(
+                    port=tty,
+                    baudrate=baudratevalue,
                     bytesize=serial.EIGHTBITS,
                     parity=serial.PARITY_NONE,
                     stopbits=serial.STOPBITS_ONE,
                     timeout=timeoutvalue
-                    )
-                self.isPortOpen = True              # opened successfully
-                break
-            except serial.SerialException:
-                self.isPortOpen = False             # failed
-                # not break until success
-                # break
+                    ))
+        self.isPortOpen = True              # opened successfully
+        self.reader = ChunkReader(self.comm)      # bulk Rx reads
+        logging.info('opened {0} : {1} attempts, {2:.1f} sec.'.format(tty, attempts, seconds))
 
         return
 
     # Receiving Data with time out setting[sec]
     def recv(self, timeout=300.0):
-        # for time out
-        time_start = time.time()
+        # for time out (monotonic : not affected by system clock changes)
+        deadline = time.monotonic() + timeout
         # Clear event to wait thread
         self.event.clear()
         # Clear Rx Buffer
         self.recvData.clear()
         # Rx result : True (success) False (fault: time out)
         result = False
+        frame = None
+
+        # reader thread running : take a frame nobody waits for
+        if self.link is not None:
+            try:
+                frame = self.link.get(timeout)
+            except IOError:
+                self.isPortOpen = False
+            if frame is None:
+                self.rxtimeout(timeout)
+                return result, self.recvData, self.recvCommand, self.afterEscapeSequence
+            return self.rxframe(frame)
 
         # Wait for Rx
         while not self.event.is_set():
+            # frame already decoded ? (several frames can arrive at once)
+            if self.recvFrames:
+                # Stop receiving data (success)
+                frame = self.recvFrames.popleft()
+                result = True
+                self.stop()
+                break
+
             # Check time out
-            time_end = time.time()
-            if time_end - time_start > timeout:
+            if time.monotonic() >= deadline:
                 # time out process
                 result = False
                 self.stop()
-                # for DEBUG
-                print("Rx timeout:{0}sec".format(timeout))
-                # write recvData as log
-                strlog = "Rx timeout:{0}sec".format(timeout)
-                writelog(strlog)
+                self.rxtimeout(timeout)
                 break
 
-            # Received !  read Rx
-            buff = self.comm.read()
+            # Received !  read Rx (all bytes waiting, not beyond the deadline)
+            buff = self.reader.read(deadline)
 
-            # Check Rx data 
+            # Check Rx data
             if len(buff) > 0:
-                # Read Rx
-                self.recvData.extend(buff)
-                # <DLE(0x10)><ETX(0x03) Received ? 
-                if (self.recvData.find(b'\x10\x03')) >= 0:
-                    # Stop receiving data (success)
-                    result = True
-                    self.stop()
-                    break
+                # decode Rx : checksum, 0x10 escape & <DLE><STX>..<DLE><ETX> framing in one pass
+                frames = self.decoder.feed(buff)
+                for frame in frames:
+                    journal.rx(frame)
+                self.recvFrames.extend(frames)
 
         # Return Result
         if result:
-            # DEBUG
-            print('self.recvData = ', self.recvData)
-            print('self.recvData = ', self.recvData.hex())
+            return self.rxframe(frame)
 
-            # write recvData as log
-            strlog = 'self.recvData = ' + str(self.recvData)
-            writelog(strlog)
-            strlog = 'self.recvData = ' + str(self.recvData.hex())
-            writelog(strlog)
+        return result, self.recvData, self.recvCommand, self.afterEscapeSequence
 
-            #
-            # here, process checksum, 0x10 escape process, & discriminating the command
-            #
-            
-            # received command
-            self.recvCommand = self.recvData[2]
-            # extract data for checksum
-            # recvdataforchecksum = self.recvData[2:-3]
-            # extract payload for 0x10 escape sequence
-            self.recvdataforescapesequence = self.recvData[2:-3]
-            # received data checksum
-            self.recvChecksumByte = self.recvData[-3]
-            # extract escape sequence 0x10
-            self.afterEscapeSequence = bytearray()
-            self.afterEscapeSequence.clear()
-            pnum = 0  # non 0x10
-            for num in self.recvdataforescapesequence:
-                if pnum == 0x10 & num == 0x10:
-                    pnum = 0
-                    continue
-                else:
-                    pnum = num
-                    self.afterEscapeSequence.append(num)
-            
-            print("self.afterEscapeSequence = ", self.afterEscapeSequence)
-            
-            # check checksum
-            num_sum = 0
-            for num in self.afterEscapeSequence:
-                num_sum += num
-            checksumbyte = num_sum & 0xFF
-            
-            print("checksumbyte = ", hex(checksumbyte))
-            print("self.recvChecksumByte = ", hex(self.recvChecksumByte))
+    # Rx time out log
+    def rxtimeout(self, timeout):
+        # for DEBUG
+        print("Rx timeout:{0}sec".format(timeout))
+        # write recvData as log
+        strlog = "Rx timeout:{0}sec".format(timeout)
+        writelog(strlog)
 
-            if checksumbyte == self.recvChecksumByte:
-                logging.debug("received data check sum is correct")
-                print("received data check sum is correct")
-            else:
-                logging.debug("received data check sum is not correct")
-                print("received data check sum is not correct")
-            # send CMD_UNKNOWN_RES
-            # but not need now
+    # received frame -> recvData, recvCommand, afterEscapeSequence (& log)
+    def rxframe(self, frame):
+        self.recvData.clear()
+        self.recvData.extend(frame.raw)
+        # DEBUG
+        print('self.recvData = ', self.recvData)
+        print('self.recvData = ', self.recvData.hex())
 
-        return result, self.recvData, self.recvCommand, self.afterEscapeSequence
+        # write recvData as log (raw frames are in the frame journal)
+        strlog = 'self.recvData = ' + str(self.recvData.hex())
+        writelog(strlog)
+
+        # received command
+        self.recvCommand = frame.command
+        # received data checksum
+        self.recvChecksumByte = frame.checksum
+        # command & parameter after 0x10 escape removal
+        self.afterEscapeSequence = bytearray(frame.data())
+
+        print("self.afterEscapeSequence = ", self.afterEscapeSequence)
+
+        print("checksumbyte = ", hex(checksum(self.afterEscapeSequence)))
+        print("self.recvChecksumByte = ", hex(self.recvChecksumByte))
+
+        if frame.valid:
+            logging.debug("received data check sum is correct")
+            print("received data check sum is correct")
+        else:
+            logging.debug("received data check sum is not correct")
+            print("received data check sum is not correct")
+        # send CMD_UNKNOWN_RES
+        # but not need now
+
+        return True, self.recvData, self.recvCommand, self.afterEscapeSequence
+
+    # start background reader thread
+    #   after this, Rx frames are matched to transact() requests by command code
+    #   and recv() returns only frames nobody waits for
+    def start_reader(self):
+        if self.link is None:
+            self.link = BtLink(self.comm, self.decoder, linkstats, journal)
+            # frames decoded by recv but not returned yet
+            while self.recvFrames:
+                self.link.keep(self.recvFrames.popleft())
+            self.link.start()
+
+    # send request, return Future of the response frame (reader thread required)
+    def request(self, data):
+        return self.link.request(data, self.send)
+
+    # send request & wait for its response with time out setting[sec]
+    # return same as recv.  send error : isPortOpen = False
+    def transact(self, data, timeout=30.0):
+        if self.link is None:
+            if not self.send(data):
+                return False, bytearray(), bytearray(), bytearray()
+            return self.recv(timeout)
+
+        future = self.request(data)
+        try:
+            frame = future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self.link.cancel(future)
+            self.rxtimeout(timeout)
+            return False, bytearray(), bytearray(), bytearray()
+        except IOError:
+            # send error or reader thread stopped
+            self.isPortOpen = False
+            return False, bytearray(), bytearray(), bytearray()
+        if frame is None:
+            # no response defined for this command
+            return True, bytearray(), bytearray(), bytearray()
+        return self.rxframe(frame)
 
     # Send Data
     def send(self, data):
         # here, argument data = command +  parameter bytearray
-        # check sum
-        self.sendbytesnoescape.clear()
-        num_sum = 0
-        for i in data:
-            num_sum = num_sum + i
-            self.sendbytesnoescape.append(i)
-        csum = num_sum & 0xFF       # extract only lowest byte
-        self.sendbytesnoescape.append(csum)
-        
-        # 0x10 escape
-        self.sendbytesescape.clear()
-        for i in self.sendbytesnoescape:
-            self.sendbytesescape.append(i)
-            if i == 0x10:
-                self.sendbytesescape.append(i)
-        senddata = DLE + STX + self.sendbytesescape + DLE + ETX
+        # check sum, 0x10 escape & <DLE><STX>..<DLE><ETX> (constant commands are pre-encoded)
+        senddata = encode(data)
 
         try:
             self.comm.write(senddata)
             self.isPortOpen = True
+            journal.tx(senddata, data[0])
             # DEBUG
             print('senddata = ', senddata)
             print('senddata = ', senddata.hex())
 
-            strlog = 'self.senddata = ' + str(senddata)
-            writelog(strlog)
             strlog = 'self.senddata = ' + str(senddata.hex())
             writelog(strlog)
             
@@ -334,21 +472,33 @@ class BtComm(object):
     # Close Serial Port
     def close(self):
         self.stop()
+        if self.link is not None:
+            self.link.stop()
+            self.link = None
         if self.isPortOpen:
             self.comm.close()
         self.isPortOpen = False
 
-    # read BT-11 status -> need to define status(parameters)
-    def readstatus(self):
-        # send status_req
+    # read BT-11 status (armm.status.Status), the kept one if younger than max_age [sec]
+    #   (default STATUS_MAX_AGE, 0 : always send status_req)
+    #   no response : the last known status or None
+    def readstatus(self, max_age=None, timeout=30.0):
+        return statuscache.read(lambda: self.fetchstatus(timeout), max_age)
+
+    # send status_req : Status or None
+    def fetchstatus(self, timeout=30.0):
         logging.debug("send status request")
-        result = self.send(CMD_STATUS_REQ)
-        if not result:
-            return result
-        else:
-            result, rxdata, rxcommand, rxparameter = self.recv(30.0)
-            # here, analysis the status if required
-        return result
+        result, rxdata, rxcommand, rxparameter = self.transact(CMD_STATUS_REQ, timeout)
+        if result and rxcommand == CMD_STATUS_RES[0]:
+            return decode_status(rxparameter[1:])
+        return None
+
+    # read ARMM temperature [deg C], None : no response
+    def readtemperature(self):
+        result, rxdata, rxcommand, rxparameter = self.transact(CMD_TEMPERATURE_REQ, TEMPERATURE_TIMEOUT)
+        if result and rxcommand == CMD_TEMPERATURE_RES[0]:
+            return decode(rxparameter[1:])
+        return None
 
     # sync RTC
     def syncrtc(self):
@@ -372,17 +522,13 @@ class BtComm(object):
             hex_n = '{:02x}'.format(i)
             print('0x' + hex_n)
 
-        result = self.send(rtc_data)
         print("rtc_data = ", rtc_data)
-        if not result:
-            return
-        else:
-            result, rxdata, rxcommand, rxparameter = self.recv(30)
-            if result:
-                logging.debug("received BT-11 RTC response")
-                print("RxParameter (RTC) = ", rxparameter)
-            else:
-                logging.debug("not received RTC sync response")
+        result, rxdata, rxcommand, rxparameter = self.transact(rtc_data, 30)
+        if result:
+            logging.debug("received BT-11 RTC response")
+            print("RxParameter (RTC) = ", rxparameter)
+        elif self.isPortOpen:
+            logging.debug("not received RTC sync response")
         return
 
     # @print_info
@@ -390,48 +536,28 @@ class BtComm(object):
     def readlogs(self):
         logging.debug("send BT11 log request")
         print(str(datetime.datetime.now()) + " Read Logs starts")
-        while True:
-            result = self.send(CMD_LOG_REQ)
-            if not result:
-                logging.debug("log request failed")
-                break
-            else:
-                result, rxdata, rxcommand, rxparameter = self.recv(30.0)
-                if result:
-                    logging.debug("received BT-11 log")
-                    print("RxParameter (log) = ", rxparameter)
-
-                    f = open(loggingFileName, 'a')
-                    strbytes = 'BT11 LOG: ' + str(rxparameter) + '\n'
-                    print(strbytes)
-                    f.write(strbytes)
-                    f.close()
-
-                    # check log end
-                    if (rxparameter.find(b'NO LOG')) >= 0:
-                        break
-                    else:
-                        time.sleep(1)
-
-                else:
-                    logging.debug("not received BT-11 log")
-                    print("not received BT-11 log")
-        return result
+        # log_req pipelined : next log_req is sent as soon as a log_res is received
+        self.start_reader()
+        sink = logwriter.sink(logline)
+        try:
+            stats = pull_logs(self.request, sink, cancel=self.link.cancel)
+        finally:
+            sink.close()
+        logging.info("read logs : " + str(stats))
+        count_log_pull(metrics, stats)
+        print(str(datetime.datetime.now()) + " Read Logs ends : " + str(stats))
+        return stats.complete
 
     # cold boot request
     def coldboot(self):
         logging.debug("send cold reboot request")
-        result = self.send(CMD_REBOOT_REQ)
-        if not result:
-            return
-        else:
-            result, rxdata, rxcommand, rxparameter = self.recv(30.0)
-            if result:
-                logging.debug("received coldBoot response")
-                print("received coldBoot response")
-            else:
-                logging.debug("not received coldBoot response")
-                print("not received coldBoot response")
+        result, rxdata, rxcommand, rxparameter = self.transact(CMD_REBOOT_REQ, 30.0)
+        if result:
+            logging.debug("received coldBoot response")
+            print("received coldBoot response")
+        elif self.isPortOpen:
+            logging.debug("not received coldBoot response")
+            print("not received coldBoot response")
         return
 
     def heartbeat_period(self):
@@ -440,17 +566,13 @@ class BtComm(object):
         hb_period = bytearray()
         hb_period.append(0x06)
         hb_period.append(HEARTBEAT_PERIOD)
-        result = self.send(hb_period)
-        if not result:
-                 return
-        else:
-            result, rxdata, rxcommand, rxparameter = self.recv(30.0)
-            if result:
-                logging.debug("received heartbeat period response")
-                print("received heartbeat period response")
-            else:
-                logging.debug("not received heartbeat period response")
-                print("not received heartbeat period response")
+        result, rxdata, rxcommand, rxparameter = self.transact(hb_period, 30.0)
+        if result:
+            logging.debug("received heartbeat period response")
+            print("received heartbeat period response")
+        elif self.isPortOpen:
+            logging.debug("not received heartbeat period response")
+            print("not received heartbeat period response")
         return
 
     def poweroff_time(self):
@@ -459,22 +581,56 @@ class BtComm(object):
         powerofftime = bytearray()
         powerofftime.append(0x05)
         powerofftime.append(POWEROFF_TIME)
-        result = self.send(powerofftime)
-        if not result:
-            return
-        else:
-            result, rxdata, rxcommand, rxparameter = self.recv(30.0)
-            if result:
-                logging.debug("received power off time response")
-                print("received power off time response")
-            else:
-                logging.debug("not received power off time response")
-                print("not received power off time response")
+        result, rxdata, rxcommand, rxparameter = self.transact(powerofftime, 30.0)
+        if result:
+            logging.debug("received power off time response")
+            print("received power off time response")
+        elif self.isPortOpen:
+            logging.debug("not received power off time response")
+            print("not received power off time response")
         return
 
 
+# open the frame journal, the program runs without it if it can't be opened
+def openjournal():
+    try:
+        journal.open()
+    except (OSError, ValueError) as e:
+        logging.error("can't open frame journal " + journalFileName + " : " + str(e))
+
+
+# open the temperature file, readings are not kept if it can't be opened
+# (msync at most every SYNC_INTERVAL : the file is closed, and synced, at exit)
+def opentemperature():
+    try:
+        temperatures.open()
+    except (OSError, ValueError) as e:
+        logging.error("can't open temperature file " + temperatureFileName + " : " + str(e))
+        return
+    atexit.register(temperatures.close)
+
+
+# start serving metrics (opt-in), the program runs without them if they can't be served
+def startmetrics():
+    if not metricsFileName and not METRICS_PORT:
+        return
+    metrics.set('armm_up', 1)
+    metrics.set('armm_start_time_seconds', time.time())
+    metrics.add_source(lambda: link_samples(linkstats.snapshot()))
+    metrics.add_source(lambda: timer_samples(scheduler.snapshot()))
+    metrics.add_source(lambda: health_samples(health.snapshot()))
+    metrics.add_source(lambda: status_samples(statuscache.snapshot()))
+    if metricsFileName:
+        TextfileWriter(metrics, metricsFileName, METRICS_PERIOD).start()
+    if METRICS_PORT:
+        try:
+            MetricsServer(metrics, METRICS_PORT).start()
+        except OSError as e:
+            logging.error("can't serve metrics on port " + str(METRICS_PORT) + " : " + str(e))
+
+
 def main():
-    logging.basicConfig(filename=loggingFileName, format=formatter, level=logging.DEBUG)
+    logging.basicConfig(handlers=[logwriter.start().handler()], format=formatter, level=logging.DEBUG)
     # logging.basicConfig(filename=loggingFileName, encoding='utf-8', format=formatter, level=logging.DEBUG)
     # logging.basicConfig(encoding='utf-8', format=formatter, level=logging.DEBUG)
     # logging.basicConfig(level=logging.DEBUG)
@@ -484,7 +640,12 @@ def main():
     #
     logging.info('=============================================')
     logging.info('AIBOX Program (re-)started : start log output')
+    openjournal()
+    opentemperature()
+    startmetrics()
     logging.info(VERSIONDESCRIPTION)
+    # kill -USR1 : write link statistics now
+    signal.signal(signal.SIGUSR1, lambda signum, frame: writestats())
     ''' 
     logging message examples
     logging.critical('CRITICAL MESSAGE')
@@ -503,12 +664,13 @@ def main():
     print("Start to open serial port")
 
     btcom = BtComm(DEVTTYNAME, BAUDRATE)
+    # Rx by background reader thread, responses matched to requests
+    btcom.start_reader()
 
     logging.debug('opened serial port !')
     print("Opened serial port")
-    hb_time_start = time.time()
-    ping_time_start = time.time()
     logging.info('state = STATE_POWERON')
+    metrics.set('armm_state', state)
 
     #
     # just wait for system up and running
@@ -528,6 +690,7 @@ def main():
 
             # Shift to STATE:01 "wait for alive_res" from bt-11
             state = STATE_WAIT4BT11     # next STATE: 01
+            count_state(metrics, state)
             logging.info('shift state = STATE_WAIT4BT11, pstate = STATE_POWERON')
             pstate = STATE_POWERON      # Previous STATE: 00
 
@@ -543,9 +706,8 @@ def main():
             while True:
                 # send 'alive_req' and wait for 'alive_res' w/ interval 1 min.
                 #  send alive_req command
-                btcom.send(CMD_ALIVE_REQ)
-                #  wait for alive_res w/ 1 min. time out
-                result, rxdata, rxccmmand, rxparameter = btcom.recv(60)
+                #  and wait for alive_res w/ 1 min. time out
+                result, rxdata, rxccmmand, rxparameter = btcom.transact(CMD_ALIVE_REQ, 60)
                 # data received ?
                 if result:
                     # alive_res ?
@@ -560,6 +722,7 @@ def main():
 
             # shift to next state
             state = STATE_HEARTBEAT
+            count_state(metrics, state)
             logging.info('shift state = STATE_HEARTBEAT, pstate = STATE_WAIT4BT11')
             pstate = STATE_WAIT4BT11
 
@@ -578,13 +741,9 @@ def main():
                 # set power off time to 30 sec.
                 btcom.poweroff_time()
 
-                # read BT-11 status
-                logging.debug("send status request")
-                result = btcom.send(CMD_STATUS_REQ)
-                if result:
-                    result, rxdata, rxcommand, rxparameter = btcom.recv(10.0)
-                    # here, analysis the status if required
-                    # not implemented, now
+                # read BT-11 status (not the kept one : BT-11 may have been rebooted)
+                status = btcom.readstatus(0, 10.0)
+                logging.info('status : ' + str(status))
 
                 # sync RTC
                 strlog = "Sync RTC"
@@ -596,119 +755,349 @@ def main():
                 writelog(strlog)
                 result = btcom.readlogs()
 
+                # jobs of STATE_HEARTBEAT, each one runs just at its own time
+                scheduler.clear()
+                # heart beat every HEARTBEAT_TIME_PERIOD
+                scheduler.every(HEARTBEAT_TIME_PERIOD, 'heartbeat', heartbeat, btcom)
+                # ping every PING_TIME_OUT
+                health.reset()
+                scheduler.every(PING_TIME_OUT, 'ping', pingcheck, btcom)
                 # Set to read LOG every day at 2:00 am
-                schedule.every().days.at("02:00").do(btcom.readlogs)
+                scheduler.daily("02:00", 'readlogs', btcom.readlogs)
                 # Set to shift log files every day at 2:15am
-                schedule.every().days.at("02:15").do(shiftlogfile)
-
-                # initiate ping
-                ping_time_start = time.time()
-                # ping_time_end = ping_time_start
-                ping_counter = 0
-
-                # heart beat timer
-                hb_time_start = time.time()
-                # hb_time_end = hb_time_start
+                scheduler.daily("02:15", 'shiftlogfile', shiftlogfile)
+                # read temperature every TEMPERATURE_PERIOD
+                scheduler.every(TEMPERATURE_PERIOD, 'temperature', temperaturecheck, btcom)
+                # refresh the kept status when it is stale
+                scheduler.every(STATUS_MAX_AGE, 'status', statuscheck, btcom)
+                # write link statistics every hour
+                scheduler.every(STATS_PERIOD, 'stats', writestats)
 
             else:
                 # STATE:02 処理
-                # just put sleep, could be 10 sec.
-                time.sleep(10)
+                # sleep until the next job (heartbeat, ping, log read, log shift) is due & run it
+                scheduler.run_next()
+                if not btcom.isPortOpen:
+                    # move to POWERON state
+                    state = STATE_POWERON
+                    count_state(metrics, state)
+                    logging.info('Due to serial communication error to send, shift to state = SATE_POWERON')
+                    continue
 
-                # HEART BEAT timing ?
-                # DEBUG
-                # print("start heart beat timing check")
-                hb_time_end = time.time()
-                if hb_time_end - hb_time_start > HEARTBEAT_TIME_PERIOD:
-                    # HEART BEAT process
-                    # DEBUG
-                    print('Send HEARTBEAT')
-                    strlog = "Send HEARTBEAT"
-                    writelog(strlog)
-
-                    # send 'alive_req' and wait for 'alive_res'
-                    #  send alive_req command
-                    result = btcom.send(CMD_ALIVE_REQ)
-                    if not result:
-                        # move to POWERON state
-                        state = STATE_POWERON
-                        logging.info('Due to serial communication error to send, shift to state = SATE_POWERON')
-                        continue
-
-                    #  wait for alive_res w/ 15 sec. time out
-                    result, rxdata, rxcommand, rxparameter = btcom.recv(15)
-                    # data received ?
-                    if result:
-                        # alive_res ?
-                        if rxdata == b'\x10\x02\xaa\xaa\x10\x03':
-                            # yes
-                            hb_time_start = time.time()
-                            # hb_time_end = hb_time_start
-                            # DEBUG
-                            logging.info('Received HEARTBEAT Response')
-
-                        else:
-                            # if not alive_res, just ignore it
-                            # just in case of communication error
-                            hb_time_start = time.time()
-                            # hb_time_end = hb_time_start
-                            # DEBUG
-                            logging.info('Not received HEARTBEAT response but something else')
-                            continue
-
-                    else:
-                        # Nothing received in 15 sec.
-                        logging.info('Nothing received from BT-11 after HEARTBEAT Req')
-                        # pstate = STATE_HEARTBEAT
-                        # DEBUG
-                        print('Nothing received from BT-11 after HEARTBEAT Req')
-                        # just do nothing, and re-try heartbeat
-
-                #
-                # if LTE is not working, send reboot_req & wait for reboot_res
-                #   After receiving reboot_res, start shutdown
-                #
-                ping_time_end = time.time()
-                if ping_time_end - ping_time_start > PING_TIME_OUT:
-                    # execute ping
-                    # DEBUG
-                    print("Start ping")
-                    strlog = "Start ping"
-                    writelog(strlog)
-
-                    for host in hosts:
-                        res = subprocess.run(["ping", host, "-c", "2", "-W", "300"], stdout=subprocess.PIPE)
-                        if res.returncode == 0:
-                            # DEBUG
-                            logging.debug('ping OK')
-                            ping_time_start = time.time()
-                            # ping_time_end = ping_time_start
-                            ping_counter = 0
-                        else:
-                            # not received ping
-                            logging.debug("ping failed")
-                            ping_counter += 1
-                            if ping_counter >= PING_TIME_OUT_COUNT:
-                                # WAN network is not working
-                                # no connection to internet, cold reboot AI BOX
-                                # cold reboot request
-                                # DEBUG
-                                logging.info('ping does not reach !!  Send Cold Boot Req and Shutdown')
-                                btcom.coldboot()
-                                # check received res
-                                # if received, execute shutdown
-                                # if not resend cold boot request
-                                # but ANYWAY shutdown
-                                os.system('shutdown -h now')
-
-                            else:
-                                ping_time_start = time.time()
-                                # ping_time_end = ping_time_start
-
-                # execute to read LOG
-                # every day 2 am
-                schedule.run_pending()
+
+#
+# heart beat job : send 'alive_req' and wait for 'alive_res'
+#   return [sec] until the next heart beat
+#   send error : btcom.isPortOpen = False (main moves to POWERON state)
+#
+def heartbeat(btcom):
+    # DEBUG
+    print('Send HEARTBEAT')
+    strlog = "Send HEARTBEAT"
+    writelog(strlog)
+    metrics.inc('armm_heartbeats_sent_total')
+
+    #  send alive_req command & wait for alive_res w/ 15 sec. time out
+    result, rxdata, rxcommand, rxparameter = btcom.transact(CMD_ALIVE_REQ, 15)
+    if not btcom.isPortOpen:
+        return HEARTBEAT_TIME_PERIOD
+
+    # data received ?
+    if result:
+        # alive_res ?
+        if rxdata == b'\x10\x02\xaa\xaa\x10\x03':
+            # yes
+            logging.info('Received HEARTBEAT Response')
+            metrics.inc('armm_heartbeats_acked_total')
+            metrics.set('armm_heartbeat_last_ack_time_seconds', time.time())
+        else:
+            # if not alive_res, just ignore it
+            # just in case of communication error
+            logging.info('Not received HEARTBEAT response but something else')
+        return HEARTBEAT_TIME_PERIOD
+
+    # Nothing received in 15 sec.
+    logging.info('Nothing received from BT-11 after HEARTBEAT Req')
+    # DEBUG
+    print('Nothing received from BT-11 after HEARTBEAT Req')
+    # just do nothing, and re-try heartbeat
+    return HEARTBEAT_RETRY
+
+
+#
+# temperature job : read ARMM temperature
+#
+def temperaturecheck(btcom):
+    addtemperature(btcom.readtemperature())
+
+
+# temperature reading -> temperature file & metrics
+def addtemperature(value):
+    if value is not None:
+        temperatures.add(value)
+        metrics.set('armm_temperature_celsius', value)
+
+
+# status job : status_req only if the kept status is older than STATUS_MAX_AGE
+def statuscheck(btcom):
+    status = btcom.readstatus()
+    logging.debug('status : ' + str(status))
+
+
+#
+# ping job : start pinging all hosts, results are given to pingresult on this thread
+#
+def pingcheck(btcom):
+    # DEBUG
+    print("Start ping")
+    strlog = "Start ping"
+    writelog(strlog)
+    if not probes.start(lambda results: scheduler.post(pingresult, btcom, results)):
+        logging.debug("previous ping not finished, skip")
+
+
+#
+# ping results : if LTE is not working, send reboot_req & wait for reboot_res
+#   After receiving reboot_res, start shutdown
+#
+def pingresult(btcom, results):
+    log_results(results)
+    count_probes(metrics, results)
+    if health.update(results):
+        # WAN network is not working
+        # no connection to internet, cold reboot AI BOX
+        # cold reboot request
+        # DEBUG
+        logging.info('ping does not reach !!  Send Cold Boot Req and Shutdown')
+        btcom.coldboot()
+        # check received res
+        # if received, execute shutdown
+        # if not resend cold boot request
+        # but ANYWAY shutdown
+        logwriter.flush()
+        os.system('shutdown -h now')
+
+
+#
+# asyncio version of main()
+#   STATE_POWERON & STATE_WAIT4BT11 are the same as main().
+#   In STATE_HEARTBEAT, heartbeat, ping, 01:55 RTC sync, 02:00 log pull & 02:15 log shift
+#   run as concurrent tasks, each one sleeps just until its own next time.
+#
+def main_async():
+    logging.basicConfig(handlers=[logwriter.start().handler()], format=formatter, level=logging.DEBUG)
+    logging.info('=============================================')
+    logging.info('AIBOX Program (re-)started : start log output (asyncio)')
+    openjournal()
+    opentemperature()
+    startmetrics()
+    logging.info(VERSIONDESCRIPTION)
+
+    loop = asyncio.get_event_loop()
+    # kill -USR1 : write link statistics now
+    loop.add_signal_handler(signal.SIGUSR1, writestats)
+    loop.run_until_complete(run_async())
+
+
+# Rx / Tx frame log
+def writerxlog(frame):
+    recvdata = bytearray(frame.raw)
+    journal.rx(frame)
+    writelog('self.recvData = ' + str(recvdata.hex()))
+    if not frame.valid:
+        logging.debug("received data check sum is not correct")
+
+
+def writetxlog(senddata):
+    journal.tx(senddata)
+    writelog('self.senddata = ' + str(bytearray(senddata).hex()))
+
+
+async def run_async():
+    # -- STATE = 00 "Power On" -- #
+    logging.info('state = STATE_POWERON')
+    metrics.set('armm_state', STATE_POWERON)
+    logging.info('program started.  wait for 15 seconds for system up')
+    await asyncio.sleep(15)
+
+    while True:
+        # Continue til port opened
+        logging.debug('start to open serial port & wait for "opened" successfully forever')
+        btcom = AsyncBtComm(DEVTTYNAME, BAUDRATE, on_frame=writerxlog, on_send=writetxlog, stats=linkstats)
+        await btcom.open()
+        logging.debug('opened serial port !')
+
+        try:
+            # STATE:01 wait for alive_res
+            logging.info('shift state = STATE_WAIT4BT11, pstate = STATE_POWERON')
+            count_state(metrics, STATE_WAIT4BT11)
+            writelog("state = STATE_WAIT4BT11")
+            while True:
+                frame = await btcom.alive(60)
+                if frame is not None and frame.command == commands.ALIVE_RES:
+                    print('Received alive_res, BT11 is alive.')
+                    logging.info("Received alive_res, BT11 is alive.")
+                    break
+                await asyncio.sleep(60)
+
+            # STATE:02 heartbeat
+            logging.info('shift state = STATE_HEARTBEAT, pstate = STATE_WAIT4BT11')
+            count_state(metrics, STATE_HEARTBEAT)
+            await heartbeat_state_async(btcom)
+
+        except IOError:
+            # move to POWERON state
+            logging.info('Due to serial communication error to send, shift to state = SATE_POWERON')
+            count_state(metrics, STATE_POWERON)
+
+        btcom.close()
+
+
+async def heartbeat_state_async(btcom):
+    writelog("Start Shift Process from WAIT4BT11 to HEARTBEAT")
+    # set heartbeat period & power off time
+    await btcom.heartbeat_period(HEARTBEAT_PERIOD)
+    await btcom.poweroff_time(POWEROFF_TIME)
+    # read BT-11 status (not the kept one : BT-11 may have been rebooted)
+    status = await statuscache.read_async(lambda: fetchstatus_async(btcom, 10.0), 0)
+    logging.info('status : ' + str(status))
+    # sync RTC & read all logs
+    writelog("Sync RTC")
+    await syncrtc_async(btcom)
+    writelog("Read all logs from BT11")
+    await readlogs_async(btcom)
+
+    tasks = [
+        asyncio.ensure_future(heartbeat_task(btcom)),
+        asyncio.ensure_future(ping_task(btcom)),
+        asyncio.ensure_future(daily_task("01:55", syncrtc_async, btcom)),
+        asyncio.ensure_future(daily_task("02:00", readlogs_async, btcom)),
+        asyncio.ensure_future(daily_task("02:15", shiftlogfile_async)),
+        asyncio.ensure_future(stats_task()),
+        asyncio.ensure_future(temperature_task(btcom)),
+        asyncio.ensure_future(status_task(btcom)),
+    ]
+    # tasks run forever, until one of them fails (serial port error)
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        # also when this coroutine is cancelled
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+    errors = [task.exception() for task in done if task.exception() is not None]
+    if errors:
+        raise errors[0]
+
+
+async def heartbeat_task(btcom):
+    delay = HEARTBEAT_TIME_PERIOD
+    while True:
+        await asyncio.sleep(delay)
+        delay = HEARTBEAT_TIME_PERIOD
+        print('Send HEARTBEAT')
+        writelog("Send HEARTBEAT")
+        metrics.inc('armm_heartbeats_sent_total')
+        frame = await btcom.alive(15)
+        if frame is None:
+            # just do nothing, and re-try heartbeat
+            logging.info('Nothing received from BT-11 after HEARTBEAT Req')
+            delay = HEARTBEAT_RETRY
+        elif frame.command == commands.ALIVE_RES:
+            logging.info('Received HEARTBEAT Response')
+            metrics.inc('armm_heartbeats_acked_total')
+            metrics.set('armm_heartbeat_last_ack_time_seconds', time.time())
+        else:
+            logging.info('Not received HEARTBEAT response but something else')
+
+
+async def ping_task(btcom):
+    health.reset()
+    while True:
+        await asyncio.sleep(PING_TIME_OUT)
+        writelog("Start ping")
+        # all hosts at once, each one at most PING_DEADLINE
+        results = await probes.run_async()
+        log_results(results)
+        count_probes(metrics, results)
+        if health.update(results):
+            # WAN network is not working, cold reboot AI BOX
+            logging.info('ping does not reach !!  Send Cold Boot Req and Shutdown')
+            await btcom.reboot()
+            # ANYWAY shutdown
+            logwriter.flush()
+            os.system('shutdown -h now')
+            break
+
+
+async def temperature_task(btcom):
+    while True:
+        await asyncio.sleep(TEMPERATURE_PERIOD)
+        frame = await btcom.temperature(TEMPERATURE_TIMEOUT)
+        if frame is not None and frame.command == commands.TEMPERATURE_RES:
+            addtemperature(decode(frame.parameter))
+
+
+# refresh the kept status when it is stale (status_req only if older than STATUS_MAX_AGE)
+async def status_task(btcom):
+    while True:
+        await asyncio.sleep(STATUS_MAX_AGE)
+        status = await statuscache.read_async(lambda: fetchstatus_async(btcom, 10.0))
+        logging.debug('status : ' + str(status))
+
+
+# run job every day at HH:MM
+async def daily_task(hhmm, job, *args):
+    while True:
+        await asyncio.sleep(seconds_until(hhmm))
+        await job(*args)
+
+
+# write link statistics every STATS_PERIOD
+async def stats_task():
+    while True:
+        await asyncio.sleep(STATS_PERIOD)
+        writestats()
+
+
+# send status_req : Status or None
+async def fetchstatus_async(btcom, timeout=30.0):
+    logging.debug("send status request")
+    frame = await btcom.status(timeout)
+    if frame is not None and frame.command == commands.STATUS_RES:
+        return decode_status(frame.parameter)
+    return None
+
+
+async def syncrtc_async(btcom):
+    logging.debug("send RTC sync request")
+    frame = await btcom.time_sync()
+    if frame is not None:
+        logging.debug("received BT-11 RTC response")
+    else:
+        logging.debug("not received RTC sync response")
+
+
+async def readlogs_async(btcom):
+    logging.debug("send BT11 log request")
+    sink = logwriter.sink(logline)
+    try:
+        stats = await pull_logs_async(btcom.request, sink)
+    finally:
+        sink.close()
+    logging.info("read logs : " + str(stats))
+    count_log_pull(metrics, stats)
+    if not btcom.isPortOpen:
+        raise IOError("Can't send data through serial port.")
+
+
+# rotation & compression block : on a worker thread, not in the event loop
+async def shiftlogfile_async():
+    await asyncio.get_event_loop().run_in_executor(None, shiftlogfile)
 
 
 if __name__ == '__main__':
-    main()
+    if USE_ASYNCIO:
+        main_async()
+    else:
+        main()
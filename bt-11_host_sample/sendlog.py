@@ -1,73 +1,94 @@
 '''ファイルを添付したメールを送信する'''
+import os
 import sys
+import time
+import argparse
 import smtplib
-from email.mime import multipart
-from email.mime import text
-from email.mime.application import MIMEApplication
 
-smtp_host = 'smtp.gmail.com'
-smtp_port = 587
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from armm import mailer
+from armm import logship
+
+smtp_host = os.environ.get('ARMM_SMTP_HOST', mailer.SMTP_HOST)
+smtp_port = int(os.environ.get('ARMM_SMTP_PORT', mailer.SMTP_PORT))
+bt_name = 'bt-11'
 
 # from_email = 'xxxx@example.com'
 # username = 'xxxx@example.com'
 # app_password = 'xxxxxxxxx'
 
-msg = multipart.MIMEMultipart()
-msg['Subject'] = 'log files from bt-11'
-# msg['From'] = from_email
-# msg['To'] = to_email
-msg.attach(text.MIMEText('Test email', 'plain'))        # 本文
-
 # ファイル名はシェルスクリプトからもらう引数にする
 # 送出先も引数でもらう（一つだけ）
+#
+#   sendlog.py file_name from_email app-password to_email
+#       file_name (archive) を添付して送る
+#   sendlog.py --incremental BT-log from_email app-password to_email
+#       前回送った後に BT-log の各世代に追記された分だけを tar.gz にして送る
+#       (送った位置は .BT-log.sendlog.json に記録)
+#   ARMM_SMTP_HOST / ARMM_SMTP_PORT : SMTP server (試験用のローカルサーバー等)
+#
+parser = argparse.ArgumentParser(description='send log files by email')
+parser.add_argument('--incremental', action='store_true',
+                    help='file_name is the live log (BT-log) : send only the bytes added since the last mail')
+parser.add_argument('--checkpoint', help='checkpoint file of --incremental (default .BT-log.sendlog.json)')
+parser.add_argument('file_name')
+parser.add_argument('from_email')
+parser.add_argument('app_password')
+parser.add_argument('to_email')
 
 # check argument number
-args = sys.argv
-if 5 != len(args):
-    print('Require five arguments, sendlog.py, file name, from_email address, from_email app-password, and to_email address')
-    exit(1)
+args = parser.parse_args()
 
 # set file name and to_email
-attachedfilename = args[1]
-from_email = args[2]
-appPassword = args[3]
-to_email = args[4]
-msg['From'] = from_email
-msg['To'] = to_email
+attachedfilename = args.file_name
+from_email = args.from_email
+appPassword = args.app_password
+to_email = args.to_email
 username = from_email
-app_password = appPassword
+app_password = appPassword if appPassword != '-' else None     # '-' : no login (test server)
 
+text = 'Test email'         # 本文
+attachments = []
+files = []
 try:
-    with open(attachedfilename, 'rb') as f:
-        attachment = MIMEApplication(f.read())
-        attachment.add_header(
-            'Content-Disposition', 'attachment',
-            filename=attachedfilename
-        )
-        msg.attach(attachment)
+    if args.incremental:
+        checkpoint = logship.Checkpoint(args.checkpoint or logship.checkpoint_path(attachedfilename)).load()
+        parts = logship.collect(attachedfilename, checkpoint)
+        if logship.new_bytes(parts) == 0:
+            print('no new log since the last mail')
+            exit(0)
+        text = 'log files from {0} (incremental)\n'.format(bt_name) + '\n'.join(logship.describe(parts)) + '\n'
+        archivename = time.strftime('bt_log-%Y%m%d-%H%M%S') + '-incremental.tar.gz'
+        attachments.append(mailer.Attachment(archivename, lambda f: logship.write_archive(parts, f),
+                                             'application/gzip'))
+    else:
+        f = open(attachedfilename, 'rb')
+        files.append(f)
+        attachments.append(mailer.Attachment(attachedfilename, f))
 except Exception as e:
     print(f'[ERROR] {type(e)}:{str(e)}')
     exit(1)
 
-
 # attach bt id file (bt_id.txt)
 try:
-    with open('bt_id.txt', 'r') as f:
-        attachment = text.MIMEText(f.read())
-        attachment.add_header(
-            'Content-Disposition', 'attachment',
-            filename='bt_id.txt'
-        )
-        msg.attach(attachment)
+    with open('bt_id.txt', 'rb') as f:
+        attachments.append(mailer.Attachment('bt_id.txt', f.read(), 'text/plain; charset="utf-8"'))
 except Exception as e:
     print(f'[ERROR] {type(e)}:{str(e)}')
     exit(1)
 
+try:
+    sent, seconds = mailer.send_mail(from_email, [to_email], 'log files from ' + bt_name, text, attachments,
+                                     smtp_host, smtp_port, username, app_password)
+except (smtplib.SMTPException, OSError) as e:
+    print(f'[ERROR] {type(e)}:{str(e)}')
+    exit(1)
+finally:
+    for f in files:
+        f.close()
 
-server = smtplib.SMTP(smtp_host, smtp_port)
-server.ehlo()
-server.starttls()
-server.ehlo()
-server.login(username, app_password)
-server.send_message(msg)
-server.quit()
+print(f'sent {sent} bytes in {seconds:.1f} sec.')
+if args.incremental:
+    # only after the server accepted the mail
+    checkpoint.save(parts)
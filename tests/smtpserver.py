@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import threading
+import socketserver
+
+#
+# Local SMTP stand-in for the mailer tests
+#
+# Accepts every message (no STARTTLS, no AUTH), optionally offers PIPELINING, and can
+# answer 451 to the end of data of chosen messages (1 : first message received).  It
+# records the messages and how the commands arrived :
+#   violations : without PIPELINING, commands received before the reply to the previous
+#                one was sent (RFC 5321 lock step broken)
+#   groups     : MAIL commands received together with their RCPT & DATA in one read
+#
+
+
+class SmtpServer(object):
+    def __init__(self, pipelining=False, fail=()):
+        self.pipelining = pipelining
+        self.fail = set(fail)
+        self.lock = threading.Lock()
+        self.count = 0                  # end of data received
+        self.messages = []              # accepted message data (bytes)
+        self.violations = []
+        self.groups = 0
+        self.server = None
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        owner = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                owner._session(self.request)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _session(self, sock):
+        buffer = [b'']
+
+        def readline():
+            while b'\r\n' not in buffer[0]:
+                data = sock.recv(65536)
+                if not data:
+                    raise EOFError
+                buffer[0] += data
+            line, buffer[0] = buffer[0].split(b'\r\n', 1)
+            return line
+
+        def reply(text):
+            sock.sendall(text.encode('ascii') + b'\r\n')
+
+        reply('220 stand-in')
+        try:
+            while True:
+                line = readline()
+                command = line.decode('ascii', 'replace').upper()
+                if not self.pipelining and buffer[0] and not command.startswith('QUIT'):
+                    with self.lock:
+                        self.violations.append(command)
+                if command.startswith('EHLO'):
+                    reply('250-stand-in')
+                    if self.pipelining:
+                        reply('250-PIPELINING')
+                    reply('250 8BITMIME')
+                elif command.startswith('MAIL'):
+                    if b'\r\nDATA\r\n' in buffer[0].upper():
+                        with self.lock:
+                            self.groups += 1
+                    reply('250 ok')
+                elif command.startswith('DATA'):
+                    reply('354 go ahead')
+                    lines = []
+                    while True:
+                        line = readline()
+                        if line == b'.':
+                            break
+                        lines.append(line[1:] if line.startswith(b'..') else line)
+                    with self.lock:
+                        self.count += 1
+                        failed = self.count in self.fail
+                        if not failed:
+                            self.messages.append(b'\r\n'.join(lines))
+                    reply('451 try again later' if failed else '250 queued')
+                elif command.startswith('QUIT'):
+                    reply('221 bye')
+                    return
+                else:
+                    reply('250 ok')
+        except (EOFError, socket.error):
+            return
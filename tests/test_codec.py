@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+from armm import commands
+from armm.codec import (DLE, FRAME_END, FRAME_START, MAX_PARAMETER_LENGTH, FrameDecoder, checksum,
+                        decode, encode)
+
+#
+# armm.codec : encode / decode round trips & the streaming decoder
+#
+
+
+def test_encode_format():
+    frame = encode(bytes([commands.ALIVE_REQ]))
+    assert frame == FRAME_START + bytes([commands.ALIVE_REQ, commands.ALIVE_REQ]) + FRAME_END
+
+
+def test_escape_round_trip():
+    # 0x10 in command, parameter & checksum (0x10 + 0x00 = 0x10) are doubled
+    data = bytes([0x10, 0x00])
+    frame = encode(data)
+    assert frame == FRAME_START + b'\x10\x10\x00\x10\x10' + FRAME_END
+    command, parameter, checksumbyte, valid = decode(frame)
+    assert (command, bytes(parameter), checksumbyte, valid) == (0x10, b'\x00', 0x10, True)
+
+
+def test_round_trip_random():
+    generator = random.Random(1)
+    codes = sorted(commands.NAMES)
+    for _ in range(2000):
+        length = generator.randint(0, MAX_PARAMETER_LENGTH)
+        data = bytes([generator.choice(codes)]) + \
+            bytes(generator.choice((0x10, generator.randrange(256))) for _ in range(length))
+        command, parameter, checksumbyte, valid = decode(encode(data))
+        assert valid
+        assert bytes([command]) + bytes(parameter) == data
+        assert checksumbyte == checksum(data)
+
+
+def test_decode_rejects_non_frame():
+    for raw in (b'', b'\x10\x02\x55\x10\x03', b'\x00\x02\x55\x55\x10\x03'):
+        try:
+            decode(raw)
+        except ValueError:
+            continue
+        assert False, raw
+
+
+def test_decoder_any_chunk_size():
+    generator = random.Random(2)
+    datas = [bytes([0x81]) + bytes(generator.choice((0x10, 0x02, 0x03, generator.randrange(256)))
+                                   for _ in range(generator.randint(0, 40))) for _ in range(200)]
+    stream = b''.join(encode(data) for data in datas)
+    for size in (1, 2, 3, 7, 64, len(stream)):
+        decoder = FrameDecoder()
+        frames = []
+        for i in range(0, len(stream), size):
+            frames.extend(decoder.feed(stream[i:i + size]))
+        assert [frame.data() for frame in frames] == datas
+        assert all(frame.valid for frame in frames)
+        assert b''.join(frame.raw for frame in frames) == stream
+        assert decoder.framing_errors == 0
+
+
+def test_decoder_checksum_error_and_garbage():
+    good = encode(b'\x81hello')
+    bad = bytearray(encode(b'\x82world'))
+    bad[-3] ^= 0x01                             # checksum byte
+    decoder = FrameDecoder()
+    frames = decoder.feed(b'noise' + good + b'\x00\x03' + bytes(bad) + good)
+    assert [frame.valid for frame in frames] == [True, False, True]
+    assert frames[1].command == 0x82
+    assert decoder.checksum_errors == 1
+    assert decoder.discarded == len(b'noise') + 2
+
+
+def test_decoder_resyncs_after_lost_end():
+    # frame without <DLE><ETX> longer than the max body : dropped, the next frame is decoded
+    decoder = FrameDecoder()
+    lost = FRAME_START + b'\x81' + b'x' * (MAX_PARAMETER_LENGTH + 10)
+    frames = decoder.feed(lost + encode(b'\x81ok'))
+    assert [frame.data() for frame in frames] == [b'\x81ok']
+    assert decoder.framing_errors == 1
+
+
+def test_decoder_bad_escape():
+    decoder = FrameDecoder()
+    frames = decoder.feed(FRAME_START + b'\x81' + DLE + b'\x41' + FRAME_END + encode(b'\x81ok'))
+    assert [frame.data() for frame in frames] == [b'\x81ok']
+    assert decoder.framing_errors >= 1
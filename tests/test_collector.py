@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import json
+import time
+import socket
+import asyncio
+import tarfile
+import threading
+import http.client
+
+import pytest
+
+from armm.collector import Collector
+from armm.logship import Checkpoint, collect, post_archive
+
+#
+# armm.collector over HTTP : chunked ingest (armm.logship), oversized & malformed bodies
+#
+MAX_BODY = 64 * 1024
+
+
+# collector on its own event loop thread, port chosen by the system
+@pytest.fixture
+def collector(tmpdir):
+    loop = asyncio.new_event_loop()
+    collector = Collector(str(tmpdir.join('root')), workers=1, max_body=MAX_BODY)
+    started = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(collector.start('127.0.0.1', 0))
+        started.set()
+        loop.run_forever()
+        loop.run_until_complete(collector.close())
+        loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    assert started.wait(30)
+    collector.port = collector.server.sockets[0].getsockname()[1]
+    yield collector
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(30)
+
+
+def get(collector, path):
+    connection = http.client.HTTPConnection('127.0.0.1', collector.port, timeout=10)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read().decode('utf-8'))
+    finally:
+        connection.close()
+
+
+# raw request, return (status, body) of the response
+def raw_request(collector, data):
+    sock = socket.create_connection(('127.0.0.1', collector.port), timeout=10)
+    response = b''
+    try:
+        try:
+            sock.sendall(data)
+        except ConnectionError:
+            pass            # answered & closed before the whole body was sent
+        while True:
+            received = sock.recv(65536)
+            if not received:
+                break
+            response += received
+    except ConnectionError:
+        pass
+    finally:
+        sock.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split(b' ')[1]), json.loads(body.decode('utf-8'))
+
+
+def delta(size):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w:gz') as tar:
+        info = tarfile.TarInfo('BT-log')
+        payload = os.urandom(size)
+        info.size = len(payload)
+        tar.addfile(info, io.BytesIO(payload))
+    return data.getvalue()
+
+
+# directory of the only bt_id received
+def collector_dir(collector):
+    names = os.listdir(os.path.join(collector.root, 'devices'))
+    assert len(names) == 1
+    return names[0]
+
+
+def test_chunked_ingest(collector, tmpdir):
+    log = tmpdir.join('BT-log')
+    log.write_binary(b'2023-11-16 02:00:00,000 : INFO : Received HEARTBEAT Response\n'
+                     b'2023-11-16 02:05:00,000 : INFO : Cold boot requested\n')
+    parts = collect(str(log), Checkpoint(str(tmpdir.join('.BT-log.post.json'))))
+    reply = post_archive('http://127.0.0.1:{0}'.format(collector.port), 'bt 1', parts)
+    assert reply['bytes'] > 0
+    stored = os.listdir(os.path.join(collector.root, 'devices', collector_dir(collector)))
+    assert len(stored) == 1 and stored[0].endswith('.tar.gz')
+
+    deadline = time.monotonic() + 30
+    while get(collector, '/stats')[1]['parsed'] < 1:
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    status, events = get(collector, '/events?bt_id=bt%201&type=coldboot')
+    assert status == 200
+    assert [event['line'] for event in events] == ['2023-11-16 02:05:00,000 : INFO : Cold boot requested']
+
+
+def test_oversized_content_length(collector):
+    status, body = raw_request(collector, 'POST /logs/bt-1 HTTP/1.1\r\nContent-Length: {0}\r\n\r\n'.format(
+        MAX_BODY + 1).encode('ascii'))
+    assert status == 413
+
+
+def test_oversized_chunked(collector):
+    data = delta(MAX_BODY * 2)
+    chunks = b''.join(b'%x\r\n%s\r\n' % (len(data[i:i + 4096]), data[i:i + 4096]) for i in range(0, len(data), 4096))
+    status, body = raw_request(collector, b'POST /logs/bt-1 HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n' +
+                               chunks + b'0\r\n\r\n')
+    assert status == 413
+    # nothing stored, no partial file left
+    for directory, _, files in os.walk(os.path.join(collector.root, 'devices')):
+        assert files == []
+
+
+@pytest.mark.parametrize('request_data', [
+    b'POST /logs/bt-1 HTTP/1.1\r\nContent-Length: abc\r\n\r\n',
+    b'POST /logs/bt-1 HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n',
+    b'POST /logs/bt-1 HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n' + b'1' * 70000 + b'\r\n',
+], ids=['content-length', 'chunk-size', 'chunk-line-too-long'])
+def test_malformed_body_size(collector, request_data):
+    status, body = raw_request(collector, request_data)
+    assert status == 400
+    assert get(collector, '/stats')[0] == 200
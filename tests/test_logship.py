@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import io
+import tarfile
+
+from armm.logrotate import LogRotator
+from armm.logship import Checkpoint, checkpoint_path, collect, new_bytes, write_archive
+
+#
+# armm.logship : checkpoint & resume across appends, partial lines & rotations
+#
+
+
+def line(i):
+    return '2023-11-16 02:00:{0:02d},000 : INFO : Received HEARTBEAT Response {1}\n'.format(
+        i % 60, i).encode('ascii')
+
+
+def append(log, data):
+    with open(str(log), 'ab') as f:
+        f.write(data)
+
+
+# archive of parts -> {member name : (ARMM.offset, data)}
+def archive(parts):
+    data = io.BytesIO()
+    write_archive(parts, data)
+    data.seek(0)
+    members = {}
+    with tarfile.open(fileobj=data, mode='r:gz') as tar:
+        for info in tar:
+            members[info.name] = (int(info.pax_headers['ARMM.offset']), tar.extractfile(info).read())
+    return members
+
+
+# one shipping run : collect, archive, save the checkpoint (as after an accepted mail)
+def ship(logname):
+    checkpoint = Checkpoint(checkpoint_path(logname)).load()
+    parts = collect(logname, checkpoint)
+    members = archive(parts)
+    assert sum(len(data) for _, data in members.values()) == new_bytes(parts)
+    checkpoint.save(parts)
+    return members
+
+
+def test_checkpoint_path(tmpdir):
+    logname = str(tmpdir.join('BT-log'))
+    assert checkpoint_path(logname) == str(tmpdir.join('.BT-log.sendlog.json'))
+    assert checkpoint_path(logname, 'post') == str(tmpdir.join('.BT-log.post.json'))
+
+
+def test_resume_after_append(tmpdir):
+    log = tmpdir.join('BT-log')
+    first = b''.join(line(i) for i in range(100))
+    log.write_binary(first)
+    assert ship(str(log)) == {'BT-log': (0, first)}
+    # nothing new : no member, same checkpoint
+    assert ship(str(log)) == {}
+
+    more = b''.join(line(i) for i in range(100, 150))
+    append(log, more)
+    assert ship(str(log)) == {'BT-log': (len(first), more)}
+
+
+def test_partial_line_waits(tmpdir):
+    log = tmpdir.join('BT-log')
+    log.write_binary(line(0) + b'2023-11-16 02:00:01,000 : INFO : Rec')
+    assert ship(str(log)) == {'BT-log': (0, line(0))}
+    append(log, b'eived\n')
+    assert ship(str(log)) == \
+        {'BT-log': (len(line(0)), b'2023-11-16 02:00:01,000 : INFO : Received\n')}
+
+
+def test_unsaved_checkpoint_resends(tmpdir):
+    log = tmpdir.join('BT-log')
+    log.write_binary(line(0))
+    logname = str(log)
+    parts = collect(logname, Checkpoint(checkpoint_path(logname)).load())
+    archive(parts)
+    # mail not accepted : checkpoint not saved, the same bytes are sent again
+    assert ship(logname) == {'BT-log': (0, line(0))}
+
+
+def test_resume_across_rotation(tmpdir):
+    log = tmpdir.join('BT-log')
+    logname = str(log)
+    first = b''.join(line(i) for i in range(200))
+    log.write_binary(first)
+    ship(logname)
+
+    # appended, rotated (renamed & compressed : new inode) before the next run
+    tail = b''.join(line(i) for i in range(200, 220))
+    append(log, tail)
+    rotator = LogRotator(logname, compression='gzip')
+    rotator.rotate()
+    rotator.join()
+    assert tmpdir.join('BT-log.1.gz').check() and not log.check()
+    fresh = b''.join(line(i) for i in range(220, 230))
+    log.write_binary(fresh)
+
+    assert ship(logname) == {'BT-log.1': (len(first), tail), 'BT-log': (0, fresh)}
+    # the compressed generation sent completely is not read again
+    assert ship(logname) == {}
+
+    # second rotation : BT-log.1.gz -> BT-log.2.gz, BT-log -> BT-log.1.gz
+    rotator.rotate()
+    rotator.join()
+    assert tmpdir.join('BT-log.2.gz').check() and tmpdir.join('BT-log.1.gz').check()
+    log.write_binary(line(230))
+    assert ship(logname) == {'BT-log': (0, line(230))}
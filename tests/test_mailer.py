@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import email
+import pytest
+
+from armm.mailer import Attachment, BatchSender, Message, send_mail
+from smtpserver import SmtpServer
+
+#
+# armm.mailer against a local SMTP stand-in, with and without PIPELINING
+#
+
+
+@pytest.fixture(params=[False, True], ids=['lockstep', 'pipelining'])
+def server(request):
+    server = SmtpServer(pipelining=request.param).start()
+    yield server
+    server.stop()
+
+
+def messages(count, size=20000):
+    return [Message('bt-{0}'.format(i), 'log bt-{0}'.format(i), 'log of bt-{0}'.format(i),
+                    [Attachment('bt-{0}.tar.gz'.format(i), bytes([i]) * size)]) for i in range(count)]
+
+
+def attachment(data):
+    message = email.message_from_bytes(data)
+    for part in message.walk():
+        if part.get_filename():
+            return part.get_filename(), part.get_payload(decode=True)
+    return None
+
+
+def test_batch(server):
+    sender = BatchSender('a@example.com', ['b@example.com', 'c@example.com'], '127.0.0.1', server.port)
+    stats = sender.send(messages(5))
+    assert (stats.sent, stats.failed, stats.connections) == (5, 0, 1)
+    assert [message.key for message in sender.delivered] == ['bt-{0}'.format(i) for i in range(5)]
+    assert [attachment(data) for data in server.messages] == \
+        [('bt-{0}.tar.gz'.format(i), bytes([i]) * 20000) for i in range(5)]
+    assert server.violations == []
+    # the envelope is one group only when the server offers PIPELINING
+    assert server.groups == (5 if server.pipelining else 0)
+
+
+def test_batch_retry(server):
+    server.fail = {2}
+    sender = BatchSender('a@example.com', ['b@example.com'], '127.0.0.1', server.port, backoff=0.01)
+    stats = sender.send(messages(4))
+    assert (stats.sent, stats.failed) == (4, 0)
+    assert stats.retries >= 1 and stats.connections == 2
+    assert sorted(attachment(data)[0] for data in server.messages) == \
+        ['bt-{0}.tar.gz'.format(i) for i in range(4)]
+    assert server.violations == []
+
+
+def test_send_mail(server):
+    send_mail('a@example.com', ['b@example.com'], 'subject', 'text',
+              [Attachment('log.bin', b'\x00\x10.\r\n' * 1000)], '127.0.0.1', server.port)
+    assert attachment(server.messages[0]) == ('log.bin', b'\x00\x10.\r\n' * 1000)
+    assert server.violations == []